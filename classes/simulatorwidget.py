@@ -6,6 +6,8 @@ from pyglpainter.classes.painterwidget import PainterWidget
 
 from PyQt5.QtGui import QVector3D
 
+from lib import gcodetools
+
 import OpenGL
 from OpenGL.GL import *
 
@@ -23,6 +25,16 @@ class SimulatorWidget(PainterWidget):
             "G59": (0, 0, 0)
             }
         
+        # maximal distance in mm of drawn arc chords from the true arcs
+        self.arc_tolerance = 0.05
+        
+        # for each drawn line, the index of the G-code line it was made
+        # from, when arcs were linearized
+        self._gcode_source_lines = None
+        
+        # a lib.cache.Cache for the linearized G-code, set by the main window
+        self.cache = None
+        
         
     def draw_heightmap(self, pos_col, dim, origin):
         if "myheightmap" in self.programs["heightmap"].items:
@@ -127,11 +139,31 @@ class SimulatorWidget(PainterWidget):
         self.dirty = True
         
         
-    def draw_gcode(self, gcode, cmpos, ccs, do_fractionize_arcs=True):
+    def draw_gcode(self, gcode, cmpos, ccs, do_fractionize_arcs=True, cache_key=None):
         if "gcode" in self.programs["simple3d"].items:
             # remove old gcode item
             self.item_remove("gcode")
         
+        # arcs are drawn with as many line segments as the tolerance needs
+        self._gcode_source_lines = None
+        if do_fractionize_arcs:
+            if self.cache is None:
+                cache_key = None
+            if cache_key:
+                cache_key = self.cache.key(cache_key, self.arc_tolerance)
+            cached = self.cache.get(cache_key, "linearized") if cache_key else None
+            if cached is not None:
+                gcode = self.cache.decode_lines(cached["lines"])
+                self._gcode_source_lines = np.array(cached["source"])
+                do_fractionize_arcs = False
+            else:
+                result = gcodetools.linearize_arcs(gcode, self.arc_tolerance)
+                if result is not None:
+                    gcode, self._gcode_source_lines = result
+                    do_fractionize_arcs = False
+                    if cache_key:
+                        self.cache.put(cache_key, "linearized", {"lines": self.cache.encode_lines(gcode), "source": self._gcode_source_lines})
+        
         # create a new one
         self.item_create("GcodePath", "gcode", "simple3d", gcode, cmpos, ccs, self.cs_offsets, do_fractionize_arcs)
         #self.programs["simple3d"].items["gcode"] = GcodePath("gcode", self.program, gcode, cwpos, ccs, self.cs_offsets)
@@ -140,13 +172,21 @@ class SimulatorWidget(PainterWidget):
         
     def highlight_gcode_line(self, line_number):
         if "gcode" in self.programs["simple3d"].items:
-            self.programs["simple3d"].items["gcode"].highlight_line(line_number)
+            self.programs["simple3d"].items["gcode"].highlight_line(self._drawn_line(line_number))
         self.dirty = True
+        
+        
+    def _drawn_line(self, line_number):
+        # the last of the lines drawn for the G-code line
+        if self._gcode_source_lines is not None:
+            return int(np.searchsorted(self._gcode_source_lines, line_number, side="right")) - 1
+        return line_number
             
 
     def put_buffer_marker_at_line(self, line_number):
         #print("putting buffermarker at line {}".format(line_number))
         if "gcode" in self.programs["simple3d"].items:
+            line_number = self._drawn_line(line_number)
             if 2 * line_number <= self.programs["simple3d"].items["gcode"].vertexcount:
                 bufferpos = self.programs["simple3d"].items["gcode"].vdata_pos_col["position"][2 * line_number]
                 
@@ -14,7 +14,6 @@ from classes.jogwidget import JogWidget
 from classes.commandlineedit import CommandLineEdit
 from classes.simulatordialog import SimulatorDialog
 from gerbil.gerbil import Gerbil
-from gcode_machine.gcode_machine import GcodeMachine
 from gerbil.callbackloghandler import CallbackLogHandler
 
 from PyQt5 import QtCore, QtGui
@@ -24,7 +23,12 @@ from PyQt5.QtWidgets import QApplication, QHBoxLayout, QMessageBox, QSlider, QLa
 
 from lib.qt.gerbil_gui.ui_mainwindow import Ui_MainWindow
 from lib import gcodetools
+from lib import gcodeparser
+from lib import heightmap
+from lib import planner
 from lib import utility
+from lib import cache
+from lib import validator
 from lib import compiler
 from lib import pixel2laser
 
@@ -266,6 +270,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         
 
         self._add_to_logoutput("=calc_eta()")
+        self._add_to_logoutput("=validate()")
         self._add_to_logoutput("=bbox()")
         self._add_to_logoutput("=remove_tracer()")
         self._add_to_logoutput("=probe_start(100,100)")
@@ -329,8 +334,21 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.job_run_timestamp = time.time()
         self.job_current_eta = 0
         
+        # cumulative estimated line times of the job, see calc_eta()
+        self.job_time_index = None
+        
+        # modal state checkpoints of the job by cache key, see _checkpoints()
+        self.job_checkpoints = (None, None)
+        
         self.current_script_filepath = None
         
+        # (buffer size, content hash) of the job buffer, see _cache_key()
+        self._buffer_hash = None
+        
+        # parsed programs, drawn lines and estimates of job buffers
+        self.cache = cache.Cache(os.path.join(os.path.expanduser("~"), ".cache", "gerbil_gui"))
+        self.sim_dialog.simulator_widget.cache = self.cache
+        
         
     def closeEvent(self, event):
         """
@@ -351,6 +369,8 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         
     def new_job(self):
         self.job_run_timestamp = time.time()
+        self.job_time_index = None
+        self._buffer_hash = None
         self.grbl.job_new()
         self.spinBox_start_line.setValue(0)
         self.sim_dialog.simulator_widget.cleanup_stage()
@@ -600,17 +620,11 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
         if len(self.probe_values) < 4: return # at least 4 for suitable interpol
     
-        # I put this here to not make it a hard requirement
-        # it is difficult to install on Windows
-        from scipy.interpolate import griddata
-        
-        # see http://docs.scipy.org/doc/scipy/reference/generated/scipy.interpolate.griddata.html
-        interpolated_z = griddata(
-            self.probe_points,
-            self.probe_values,
-            self.heightmap_ipolgrid,
-            method='cubic',
-            fill_value=-100)
+        # the same cached surface is later used by gcodetools.bumpify
+        surface = heightmap.get(self.probe_points, self.probe_values)
+        grid_x, grid_y = self.heightmap_ipolgrid
+        grid_xy = np.column_stack((grid_x.ravel(), grid_y.ravel()))
+        interpolated_z = surface(grid_xy, fill_value=-100).reshape(grid_x.shape)
         
         # construct the vertex attributes in the format needed for pyglpainter
         for y in range(0, self.heightmap_dim[1]):
@@ -741,6 +755,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             
             self._current_grbl_buffer_size = int(data[0])
             self.label_bufsize.setText(msg)
+            self._buffer_hash = None
             
             #enabled = self._current_grbl_buffer_size == 0
             #self.lineEdit_cmdline.setEnabled(enabled)
@@ -750,7 +765,9 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             self._rx_buffer_fill = data[0]
             
         elif event == "on_progress_percent":
-            self._progress_percent = data[0]
+            # progress by time is more meaningful when it is known
+            if not self.job_time_index:
+                self._progress_percent = data[0]
             
         elif event == "on_feed_change":
             feed = data[0]
@@ -846,7 +863,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             gcode = data[0]
             ccs = self.cs_names[self.current_cs]
             self.sim_dialog.simulator_widget.cs_offsets = self.state_hash
-            self.sim_dialog.simulator_widget.draw_gcode(gcode, self.mpos, ccs)
+            self.sim_dialog.simulator_widget.draw_gcode(gcode, self.mpos, ccs, cache_key=self._cache_key("simulator"))
             self._current_grbl_line_number = self.grbl._current_line_nr
             self.spinBox_start_line.setValue(self._current_grbl_line_number)
             
@@ -887,7 +904,14 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         
     def on_second_tick(self):
         if self.grbl.job_finished == False:
-            self.label_runningtime.setText(self._secs_to_timestring(time.time() - self.job_run_timestamp))
+            elapsed = time.time() - self.job_run_timestamp
+            self.label_runningtime.setText(self._secs_to_timestring(elapsed))
+            if self.job_time_index:
+                line_nr = self._current_grbl_line_number
+                self.job_time_index.calibrate(line_nr, elapsed)
+                remaining = self.job_time_index.remaining(line_nr)
+                self.job_current_eta = time.time() + remaining
+                self._progress_percent = int(self.job_time_index.progress(line_nr))
             self.label_eta.setText(self._secs_to_timestring(self.job_current_eta - time.time()))
         else:
             self.label_runningtime.setText("---")
@@ -1169,6 +1193,8 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         fpath = filename_tuple[0]
         if fpath == "": return
         self.grbl.load_file(fpath)
+        # recorded now, so that restarting the job later takes no time
+        self._checkpoints(gcodeparser.ModalState(position=self.wpos, cs=53 + self.current_cs))
         self._open_gcode_location = os.path.dirname(fpath)
         self.settings.setValue("open_gcode_location", self._open_gcode_location)
         
@@ -1289,11 +1315,35 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         
         
     def job_run(self):
-        self.job_run_timestamp = time.time()
         line_nr = self.spinBox_start_line.value()
+        if self.current_target == "firmware" and not self.preflight(line_nr):
+            return
+        self.calc_eta(line_nr)
+        self.job_run_timestamp = time.time()
+        if line_nr > 0 and self.current_target == "firmware":
+            line_nr += self.restart(line_nr)
         self.grbl.job_run(line_nr)
     
     
+    def restart(self, line_nr):
+        """
+        Sends the preamble which brings the machine into the modal state
+        before line_nr of the job, so that the job can be run from there.
+        The state is replayed from the nearest checkpoint. All modes are
+        set, since grbl's state may have changed since the job stopped.
+        Returns the number of job lines which the preamble includes.
+        """
+        state = gcodeparser.ModalState(position=self.wpos, cs=53 + self.current_cs)
+        before = self._checkpoints(state).state_at(self.grbl.buffer, line_nr, state.position)
+        # enough lines to find the next move, see restart_preamble()
+        following = self.grbl.buffer[line_nr:line_nr + 100]
+        preamble, consumed = gcodetools.restart_preamble(before, following=following)
+        for line in preamble:
+            self._add_to_loginput("Restart: {}".format(line))
+            self.grbl.send_immediately(line)
+        return consumed
+    
+    
     def job_halt(self):
         self.grbl.job_halt()
         self.grbl.gcode_parser_state_requested = True
@@ -1352,13 +1402,10 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         
 
     def _show_buffer(self):
-        buf = self.grbl.buffer
-        output = ""
-        for i in range(0, len(buf)):
-            output += "L{:06d} {}\n".format(i, buf[i])
-            
+        lines = self.grbl.buffer
+        output = "\n".join(["L{:06d} {}".format(i, line) for i, line in enumerate(lines)])
         self.plainTextEdit_job.setPlainText(output)
- 
+        
     def _secs_to_timestring(self, secs):
         if secs < 0: return ""
         secs = int(secs)
@@ -1502,49 +1549,126 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.state_cs_dirty = True
         
         
-    def calc_eta(self):
-        proc = GcodeMachine()
-        proc.cs_offsets = self.grbl.settings_hash
-        proc.position_m = [0, 0, 0]
+    def calc_eta(self, start_line=None):
+        """
+        Estimates the job time with grbl's planner model, from the
+        machine's settings, and keeps the cumulative line times in
+        job_time_index, from which on_second_tick() reads the ETA and
+        progress of the running job.
+        """
+        if start_line is None:
+            start_line = self.grbl.current_line_number
+        settings = planner.grbl_settings(self.grbl.settings)
+        if self.checkBox_feed_override.isChecked():
+            settings["feed_override"] = self.grbl.preprocessor.request_feed
+        
+        state = gcodeparser.ModalState(position=self.wpos, cs=53 + self.current_cs)
+        key = self._cache_key("estimate", settings, state.position, state.cs)
+        cached = self.cache.get(key, "estimate") if key else None
+        if cached is not None:
+            times = cached["times"]
+        else:
+            times = planner.estimate(self._parsed_buffer(state), **settings)
+            if key:
+                self.cache.put(key, "estimate", {"times": times})
+        self.job_time_index = planner.TimeIndex(times, start_line)
+        secs = self.job_time_index.total()
+
+        self.job_current_eta = time.time() + secs
+        self.label_jobtime.setText(self._secs_to_timestring(secs))
         
-        dists_by_feed = {}
+
+    def _cache_key(self, *parts):
+        """
+        Returns the cache key for results derived from the job buffer: the
+        hash of the preprocessed lines which are sent, the fractionize
+        settings, the offsets of the coordinate systems and the given
+        parts. None if the buffer is empty.
+        """
+        if self.grbl.buffer_size == 0:
+            return None
+        if self._buffer_hash is None or self._buffer_hash[0] != self.grbl.buffer_size:
+            self._buffer_hash = (self.grbl.buffer_size, self.cache.lines_hash(self.grbl.buffer))
+        preprocessor = self.grbl.preprocessor
+        offsets = {name: self.state_hash.get(name) for name in gcodetools.CS_NAMES} if self.state_hash else None
+        return self.cache.key(self._buffer_hash[1], preprocessor.do_fractionize_lines, preprocessor.do_fractionize_arcs,
+                              offsets, *parts)
         
-        g0_feed = float(self.grbl.settings[110]["val"])
-        feed_is_overridden = self.checkBox_feed_override.isChecked()
         
-        for line in self.grbl.buffer[self.grbl.current_line_number:]:
-            proc.set_line(line)
-            proc.parse_state()
-            proc.override_feed()
-            cf = proc.current_feed
-            cmm = proc.current_motion_mode
-            if cmm == None:
-                continue
-            elif cmm == 0:
-                cf = g0_feed
-            else:
-                # G1, G2, G3
-                if feed_is_overridden:
-                    cf = self.grbl.preprocessor.request_feed
-            
-                
-            if cf in dists_by_feed:
-                dists_by_feed[cf] += proc.dist
-            else:
-                dists_by_feed[cf] = proc.dist
-                
-            proc.done()
+    def _parsed_buffer(self, state):
+        key = self._cache_key("buffer")
+        if key:
+            return self.cache.parse(key, self.grbl.buffer, state)
+        return gcodeparser.parse(self.grbl.buffer, state)
+        
+        
+    def _checkpoints(self, state):
+        """
+        Returns the modal state checkpoints of the job buffer, which do not
+        depend on the position of the given state.
+        """
+        key = self._cache_key("checkpoints", state.cs)
+        if key and self.job_checkpoints[0] == key:
+            return self.job_checkpoints[1]
+        cached = self.cache.get(key, "checkpoints") if key else None
+        if cached is not None:
+            checkpoints = gcodeparser.Checkpoints(cached)
+        else:
+            checkpoints = gcodeparser.checkpoints(self._parsed_buffer(state))
+            if key:
+                self.cache.put(key, "checkpoints", checkpoints.arrays())
+        self.job_checkpoints = (key, checkpoints)
+        return checkpoints
+        
 
-        mins = 0
-        for feed, dist in dists_by_feed.items():
-            mins += dist / feed
+    def validate(self, max_reported=50):
+        """
+        Checks the job offline for the errors grbl's parser would report,
+        all lines at once. Unlike check mode ($C), the machine is not needed
+        and the job does not have to be streamed.
+        """
+        state = gcodeparser.ModalState(position=self.wpos, cs=53 + self.current_cs)
+        errors = validator.validate(self.grbl.buffer, state)
+        for i, code, message in errors[:max_reported]:
+            self._add_to_loginput("Line {}: error:{} {}".format(i, code, message), "red")
+        if len(errors) > max_reported:
+            self._add_to_loginput("... {} more errors".format(len(errors) - max_reported), "red")
+        self._add_to_loginput("Validated {} lines, {} errors".format(len(self.grbl.buffer), len(errors)))
+        return errors
+        
 
-        self.job_current_eta = time.time() + mins * 60
-        self.label_jobtime.setText(self._secs_to_timestring(mins * 60))
+    def preflight(self, start_line=0, max_reported=50):
+        """
+        Checks the job against the travel of the machine ($130-$132), in
+        machine coordinates from the offsets of the coordinate systems, and
+        its rapid moves against the probed heightmap if there is one.
+        Mandatory before a job is run on the machine; returns whether the
+        job may run.
+        """
+        if self.state_hash is None or 130 not in self.grbl.settings:
+            self._add_to_loginput("Pre-flight check: settings and offsets not yet read from grbl, the job was not started", "red")
+            return False
+        
+        max_travel = [float(self.grbl.settings[130 + i]["val"]) for i in range(3)]
+        surface = None
+        if self.probe_values is not None and len(self.probe_values) >= 4:
+            surface = heightmap.get(self.probe_points, self.probe_values)
+        
+        state = gcodeparser.ModalState(position=self.wpos, cs=53 + self.current_cs)
+        problems = gcodetools.check_limits(self._parsed_buffer(state), max_travel, self.state_hash, state, surface)
+        problems = [(i, msg) for i, msg in problems if i >= start_line]
+        for i, msg in problems[:max_reported]:
+            self._add_to_loginput("Line {}: {}".format(i, msg), "red")
+        if len(problems) > max_reported:
+            self._add_to_loginput("... {} more lines".format(len(problems) - max_reported), "red")
+        if problems:
+            self._add_to_loginput("Pre-flight check failed, the job was not started", "red")
+        return not problems
         
 
     def bbox(self, move_z=False):
-        lines = gcodetools.bbox_draw(self.grbl.buffer, move_z).split("\n")
+        state = gcodeparser.ModalState(position=self.wpos, cs=53 + self.current_cs)
+        lines = gcodetools.bbox_draw(self.grbl.buffer, move_z, self.state_hash, state).split("\n")
         for line in lines:
             self.grbl.send_immediately(line)
         
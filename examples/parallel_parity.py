@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# Compares the output of the serial gcodetools functions with the parallel
+# ones of lib/parallel on the example files, and how long both take.
+#
+# Run from the top directory:  python3 examples/parallel_parity.py
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lib import gcodetools
+from lib import parallel
+
+
+def operations(lines):
+    bb = gcodetools.bbox(lines)
+    # a tilted surface with a bump in the middle, covering the program
+    # and the origin, where bumpify() starts
+    x0, x1 = min(bb[0][0], 0) - 10, max(bb[0][1], 0) + 10
+    y0, y1 = min(bb[1][0], 0) - 10, max(bb[1][1], 0) + 10
+    xm, ym = (x0 + x1) / 2, (y0 + y1) / 2
+    probe_points = [[x0, y0], [x1, y0], [x1, y1], [x0, y1], [xm, ym]]
+    probe_values = [0, 1, 2, 1, 3]
+    rotation = gcodetools.Transform().rotate(30, [xm, ym])
+    return [
+        ("scale_factor", gcodetools.scale_factor, parallel.scale_factor, (lines, [0.5, 0.8, 1])),
+        ("translate", gcodetools.translate, parallel.translate, (lines, [10, -5, 1])),
+        ("rotate", rotation.apply, lambda l, **kw: parallel.transform(l, rotation, **kw), (lines,)),
+        ("bumpify", gcodetools.bumpify, parallel.bumpify, (lines, [0, 0, 0], probe_points, probe_values)),
+        ("bumpify_subdiv", lambda *a: gcodetools.bumpify(*a, tolerance=0.02),
+            lambda *a, **kw: parallel.bumpify(*a, tolerance=0.02, **kw), (lines, [0, 0, 0], probe_points, probe_values)),
+        ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("files", nargs="*", default=sorted(glob.glob("examples/gcode/*.ngc")))
+    parser.add_argument("--lines", type=int, default=200000, help="Programs are repeated up to this many lines")
+    parser.add_argument("--chunksize", type=int, default=parallel.DEFAULT_CHUNKSIZE // 4)
+    parser.add_argument("--processes", type=int, default=None)
+    args = parser.parse_args()
+
+    failed = False
+    for fname in args.files:
+        with open(fname, "r") as f:
+            program = f.read().splitlines()
+        if not program:
+            continue
+        lines = program * max(1, args.lines // len(program))
+        print("{} ({} lines)".format(fname, len(lines)))
+
+        for name, serial, par, params in operations(lines):
+            start = time.time()
+            expected = serial(*params)
+            serial_time = time.time() - start
+
+            start = time.time()
+            result = par(*params, chunksize=args.chunksize, processes=args.processes)
+            parallel_time = time.time() - start
+
+            same = expected == result
+            failed |= not same
+            print("  {:14s} serial {:7.2f}s  parallel {:7.2f}s  {}".format(
+                name, serial_time, parallel_time, "identical" if same else "DIFFERENT"))
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
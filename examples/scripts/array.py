@@ -8,12 +8,16 @@ self.new_job()
 # os.path.dirname(os.path.realpath(__file__))
 sq = t.read("examples/gcode/square_offset.ngc")
 
+offsets = []
 for i in range(0,200,20):
     for j in range(0, 200, 20):
-        gcode = t.translate(sq, [i, j, 0])
-        grbl.write(gcode)
+        offsets.append([i, j, 0])
+
+# the square is parsed only once, the copies are produced in serpentine order
+for gcode in t.stream_tile(sq, offsets):
+    grbl.write(gcode)
 
 
 # Send the result straight to the simulator window
 grbl.target = "simulator"
-grbl.job_run()
\ No newline at end of file
+grbl.job_run()
@@ -19,7 +19,10 @@ probe_values = [1,200,3,100]
 #probe_points = self.probe_points
 #probe_values = self.probe_values
 
-grbl.buffer = t.bumpify(grbl.buffer, self.wpos, probe_points, probe_values)
+bumped = t.bumpify(grbl.buffer, self.wpos, probe_points, probe_values)
 
-self.set_target("simulator")
-grbl.job_run()
\ No newline at end of file
+# None if the job leaves the probed area
+if bumped is not None:
+    grbl.buffer = bumped
+    self.set_target("simulator")
+    grbl.job_run()
\ No newline at end of file
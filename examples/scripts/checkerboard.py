@@ -10,13 +10,15 @@ cat = t.read("examples/gcode/cat.ngc")
 scaled_origin_cat = t.to_origin(t.scale_factor(cat, [0.2, 0.2, 0]))
 
 
+offsets = []
 for i in range(0,200,25):
     for j in range(0, 200, 25):
         x = 1 if j % 2 == 0 else 0
         if i % 2 == x:
-            gcode = t.translate(scaled_origin_cat, [i, j, 0])
-            print("\nProcessing", i, j)
-            grbl.write("\n".join(gcode))
+            offsets.append([i, j, 0])
+
+for gcode in t.stream_tile(scaled_origin_cat, offsets):
+    grbl.write("\n".join(gcode))
 
 
 grbl.preprocessor.vars = {"1":0}
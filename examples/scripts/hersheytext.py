@@ -4,12 +4,14 @@ c = compiler
 t = gcodetools
 grbl = self.grbl
 
-text_gcodes = t.hersheyToGcode("Hello World!", "scripts")
-
+import math
 
+# the text is rotated around [-100, 0] during layout, no need for rotate2D
 rotated_gcodes = []
 for angle in range(0, 160, 30):
-    rotated_gcodes += t.rotate2D(text_gcodes, [-100, 0], angle)
+    a = math.radians(angle)
+    position = [-100 + 100 * math.cos(a), 100 * math.sin(a)]
+    rotated_gcodes += t.hersheyLayoutToGcode("Hello World!", "scripts", angle=angle, position=position)
 
 self.new_job()
 
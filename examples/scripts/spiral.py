@@ -5,6 +5,9 @@ t = gcodetools
 grbl = self.grbl
 
 import math
+import numpy as np
+
+from lib import gcodewriter
 
 thickness = 1
 steps = 20
@@ -24,7 +27,6 @@ gcodes.append("G1")
 self.new_job()
 
 def spiral(cx, cy, r1, r2, windings, direction):
-    gcode = []
     steps_per_winding = 100
 
     if direction == 1:
@@ -34,14 +36,14 @@ def spiral(cx, cy, r1, r2, windings, direction):
 
     r_inc = direction * (r2 - r1) / windings / steps_per_winding
 
-    for anglestep in range(0, steps_per_winding * windings):
-        r += r_inc
-        angle = (direction + direction * anglestep) * 2 * math.pi / steps_per_winding
-        x = cx + r * math.cos(angle)
-        y = cy + r * math.sin(angle)
-        print(angle)
-        gcode.append("X{:.3f} Y{:.3f} S255".format(x, y))
-    return gcode
+    # all points of the spiral at once
+    anglestep = np.arange(0, steps_per_winding * windings)
+    r = r + r_inc * (anglestep + 1)
+    angle = (direction + direction * anglestep) * 2 * math.pi / steps_per_winding
+    x = cx + r * np.cos(angle)
+    y = cy + r * np.sin(angle)
+    gcode = gcodewriter.serialize([("X", x), ("Y", y), ("S", 255)])
+    return gcode.splitlines()
         
     
 self.grbl.preprocessor.do_fractionize_arcs = False
@@ -16,7 +16,10 @@ from gerbil.gerbil import Gerbil
 from lib import stipple
 from lib import pixel2laser as p2l
 from lib import gcodetools
+from lib import parallel
+from lib import planner
 from lib import utility
+from lib import validator
 
 from classes.window import Ui_MainWindow
 #from gi.repository import Gtk
@@ -105,8 +108,69 @@ def main():
         metavar='GCODE_FILE',
         help='File to find the bounding box for'
         )
+    bbox_parser.add_argument(
+        '--chunksize',
+        metavar='LINES',
+        type=int,
+        default=100000,
+        help='Number of lines processed at a time. Memory usage is bounded by this.'
+        )
     
     
+    # define arguments for the 'estimate' subcommand
+    estimate_parser = subparsers.add_parser("estimate", help="Estimates the execution time of a gcode file with grbl's acceleration planning")
+    estimate_parser.add_argument(
+        'gcodefile',
+        metavar='GCODE_FILE',
+        help='File to estimate'
+        )
+    estimate_parser.add_argument(
+        '--rates',
+        metavar='X,Y,Z',
+        default='500,500,500',
+        help='Max rates of the axes in mm/min (grbl settings $110,$111,$112)'
+        )
+    estimate_parser.add_argument(
+        '--accelerations',
+        metavar='X,Y,Z',
+        default='10,10,10',
+        help='Accelerations of the axes in mm/s^2 (grbl settings $120,$121,$122)'
+        )
+    estimate_parser.add_argument(
+        '--junction-deviation',
+        metavar='MM',
+        type=float,
+        default=0.01,
+        help='Junction deviation (grbl setting $11)'
+        )
+    estimate_parser.add_argument(
+        '--arc-tolerance',
+        metavar='MM',
+        type=float,
+        default=0.002,
+        help='Arc tolerance (grbl setting $12)'
+        )
+    estimate_parser.add_argument(
+        '--buffer',
+        metavar='BLOCKS',
+        type=int,
+        default=16,
+        help='Size of the planner block buffer'
+        )
+    estimate_parser.add_argument(
+        '--per-line',
+        action='store_true',
+        help='Print the time of each line'
+        )
+    
+    # define arguments for the 'validate' subcommand
+    validate_parser = subparsers.add_parser("validate", help="Checks a gcode file for the errors grbl's parser would report, without a machine")
+    validate_parser.add_argument(
+        'gcodefile',
+        metavar='GCODE_FILE',
+        help='File to check'
+        )
+    
     # This parent parser provides args for infile and outfile for less repetition
     parent_parser = argparse.ArgumentParser(add_help=False)
     parent_parser.add_argument(
@@ -119,9 +183,26 @@ def main():
         metavar='GCODE_OUTFILE',
         help='File to write results to'
         )
+    parent_parser.add_argument(
+        '--chunksize',
+        metavar='LINES',
+        type=int,
+        default=100000,
+        help='Number of lines processed at a time. Memory usage is bounded by this.'
+        )
+    
+    # and this one the number of processes, for the subcommands which run in parallel
+    parallel_parser = argparse.ArgumentParser(add_help=False)
+    parallel_parser.add_argument(
+        '--processes',
+        metavar='N',
+        type=int,
+        default=1,
+        help='Number of processes working on chunks in parallel. The whole file is kept in memory then.'
+        )
     
     # define arguments for the 'translate' subcommand
-    translate_parser = subparsers.add_parser("translate", help="Translates gcode by X, Y, Z offsets", parents=[parent_parser])
+    translate_parser = subparsers.add_parser("translate", help="Translates gcode by X, Y, Z offsets", parents=[parent_parser, parallel_parser])
     translate_parser.add_argument(
         'offset_x',
         metavar='OFFSET_X',
@@ -140,7 +221,7 @@ def main():
     
     
     # define arguments for the 'scale_factor' subcommand
-    scalefactor_parser = subparsers.add_parser("scale_factor", help="Scales gcode by X, Y, Z factors", parents=[parent_parser])
+    scalefactor_parser = subparsers.add_parser("scale_factor", help="Scales gcode by X, Y, Z factors", parents=[parent_parser, parallel_parser])
     scalefactor_parser.add_argument(
         'scale_x',
         metavar='SCALE_X',
@@ -180,6 +261,59 @@ def main():
     # define arguments for the 'scale' subcommand
     to_origin_parser = subparsers.add_parser("2origin", help="Moves bottom left extremity of gcode to (0,0), z remains unaffected", parents=[parent_parser])
     
+    # define arguments for the 'optimize_travel' subcommand
+    optimize_travel_parser = subparsers.add_parser("optimize_travel", help="Reorders cutting segments to shorten rapid travel between them", parents=[parent_parser])
+    optimize_travel_parser.add_argument(
+        '--no-reverse',
+        action='store_true',
+        help='Never run segments backwards'
+        )
+    optimize_travel_parser.add_argument(
+        '--passes',
+        metavar='PASSES',
+        type=int,
+        default=2,
+        help='Number of 2-opt improvement passes'
+        )
+    
+    # define arguments for the 'minify' subcommand
+    minify_parser = subparsers.add_parser("minify", help="Strips comments, whitespace and redundant words, and rounds coordinates to machine steps", parents=[parent_parser])
+    minify_parser.add_argument(
+        '--steps',
+        metavar='X,Y,Z',
+        help='steps/mm of the axes (grbl settings $100,$101,$102)'
+        )
+    minify_parser.add_argument(
+        '--precision',
+        metavar='DECIMALS',
+        type=int,
+        default=3,
+        help='Maximal number of decimals'
+        )
+    
+    # define arguments for the 'linearize' subcommand
+    linearize_parser = subparsers.add_parser("linearize", help="Replaces G2/G3 arcs by G1 line segments, for controllers without arc support", parents=[parent_parser])
+    linearize_parser.add_argument(
+        '--tolerance',
+        metavar='MM',
+        type=float,
+        default=0.01,
+        help='Maximal distance of the line segments from the arcs'
+        )
+    
+    # define arguments for the 'pipeline' subcommand
+    pipeline_parser = subparsers.add_parser(
+        "pipeline",
+        help="Runs gcode through several transformations in a single pass",
+        epilog='EXAMPLE: python ./gerbil_gui.py pipeline in.ngc out.ngc "scale=0.5,0.5,1 | origin | translate=10,10,0 | minify"',
+        parents=[parent_parser]
+        )
+    pipeline_parser.add_argument(
+        'stages',
+        metavar='STAGES',
+        help='Stages separated by |: scale=X,Y,Z translate=X,Y,Z origin into=WIDTH,HEIGHT,DEPTH linearize[=TOLERANCE] minify[=STEPS_X,STEPS_Y,STEPS_Z]'
+        )
+    
     # define arguments for the 'gui' subcommand
     gui_parser = subparsers.add_parser("gui", help="Start GUI")
     gui_parser.add_argument(
@@ -222,30 +356,123 @@ def main():
         grbl.send(src)
         
     elif subcmd == "bbox":
-        lines = utility.read_file_to_linearray(args.gcodefile)
+        chunks = utility.read_file_in_chunks(args.gcodefile, args.chunksize)
         
-        bbox = gcodetools.get_bbox(lines)
+        bbox = gcodetools.stream_bbox(chunks)
         print("BBOX: {}".format(bbox))
         
+    elif subcmd == "estimate":
+        with open(args.gcodefile, "r") as f:
+            gcode = f.read().splitlines()
+        times = planner.estimate(
+            gcode,
+            [float(v) for v in args.rates.split(",")],
+            [float(v) for v in args.accelerations.split(",")],
+            args.junction_deviation,
+            args.arc_tolerance,
+            args.buffer)
+        if args.per_line:
+            for i, (secs, line) in enumerate(zip(times.tolist(), gcode)):
+                print("{:8d} {:10.3f}  {}".format(i, secs, line))
+        total = int(round(times.sum()))
+        print("Estimated time: {}:{:02d}:{:02d}".format(total // 3600, total // 60 % 60, total % 60))
+        
+    elif subcmd == "validate":
+        with open(args.gcodefile, "r") as f:
+            gcode = f.read().splitlines()
+        errors = validator.validate(gcode)
+        for i, code, message in errors:
+            print("{}:{}: error:{} {}  {}".format(args.gcodefile, i + 1, code, message, gcode[i].strip()))
+        print("{} errors in {} lines".format(len(errors), len(gcode)))
+        if errors:
+            sys.exit(1)
+        
     elif subcmd == "translate":
-        lines = utility.read_file_to_linearray(args.infile)
-        result = gcodetools.translate(lines, [float(args.offset_x), float(args.offset_y), float(args.offset_z)])
-        utility.write_file_from_linearray(result, args.outfile)
+        offsets = [float(args.offset_x), float(args.offset_y), float(args.offset_z)]
+        if args.processes > 1:
+            with open(args.infile, "r") as f:
+                result = [parallel.translate(f.read().splitlines(), offsets, args.chunksize, args.processes)]
+        else:
+            chunks = utility.read_file_in_chunks(args.infile, args.chunksize)
+            result = gcodetools.stream_translate(chunks, offsets)
+        if not utility.write_file_from_chunks(result, args.outfile):
+            raise SystemExit(1)
         
     elif subcmd == "scale_factor":
-        lines = utility.read_file_to_linearray(args.infile)
-        result = gcodetools.scale_factor(lines, [float(args.scale_x), float(args.scale_y), float(args.scale_z)], False)
-        utility.write_file_from_linearray(result, args.outfile)
+        facts = [float(args.scale_x), float(args.scale_y), float(args.scale_z)]
+        if args.processes > 1:
+            with open(args.infile, "r") as f:
+                result = [parallel.scale_factor(f.read().splitlines(), facts, False, args.chunksize, args.processes)]
+        else:
+            chunks = utility.read_file_in_chunks(args.infile, args.chunksize)
+            result = gcodetools.stream_scale_factor(chunks, facts, False)
+        if not utility.write_file_from_chunks(result, args.outfile):
+            raise SystemExit(1)
         
     elif subcmd == "scale_into":
-        lines = utility.read_file_to_linearray(args.infile)
-        result = gcodetools.scale_into(lines, float(args.width), float(args.height), float(args.depth), False)
-        utility.write_file_from_linearray(result, args.outfile)
+        # two passes over the file, the first one finds the bounding box
+        read_chunks = lambda: utility.read_file_in_chunks(args.infile, args.chunksize)
+        result = gcodetools.stream_scale_into(read_chunks, float(args.width), float(args.height), float(args.depth), False)
+        if not utility.write_file_from_chunks(result, args.outfile):
+            raise SystemExit(1)
         
     elif subcmd == "2origin":
-        lines = utility.read_file_to_linearray(args.infile)
-        result = gcodetools.move_to_origin(lines)
-        utility.write_file_from_linearray(result, args.outfile)
+        read_chunks = lambda: utility.read_file_in_chunks(args.infile, args.chunksize)
+        result = gcodetools.stream_to_origin(read_chunks)
+        if not utility.write_file_from_chunks(result, args.outfile):
+            raise SystemExit(1)
+        
+    elif subcmd == "optimize_travel":
+        # segments are reordered across the whole file, so it is not chunked
+        with open(args.infile, "r") as f:
+            gcode = f.read().splitlines()
+        result = gcodetools.optimize_travel(gcode, not args.no_reverse, args.passes)
+        if result is None:
+            raise SystemExit(1)
+        lines, report = result
+        with open(args.outfile, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        saved = report["travel_before"] - report["travel_after"]
+        print("Segments: {} ({} reversed)".format(report["segments"], report["reversed"]))
+        print("Rapid travel: {:.1f} mm -> {:.1f} mm, saved {:.1f} mm".format(report["travel_before"], report["travel_after"], saved))
+        
+    elif subcmd == "minify":
+        with open(args.infile, "r") as f:
+            gcode = f.read().splitlines()
+        steps = [float(v) for v in args.steps.split(",")] if args.steps else None
+        result = gcodetools.minify(gcode, steps, args.precision)
+        if result is None:
+            raise SystemExit(1)
+        lines, report = result
+        with open(args.outfile, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        print("Removed {} lines and {} bytes".format(report["lines_removed"], report["bytes_removed"]))
+        
+    elif subcmd == "linearize":
+        with open(args.infile, "r") as f:
+            gcode = f.read().splitlines()
+        result = gcodetools.linearize_arcs(gcode, args.tolerance)
+        if result is None:
+            raise SystemExit(1)
+        with open(args.outfile, "w") as f:
+            f.write("\n".join(result[0]) + "\n")
+        
+    elif subcmd == "pipeline":
+        try:
+            stages = gcodetools.pipeline_stages(args.stages)
+        except ValueError as e:
+            pipeline_parser.error(str(e))
+        read_chunks = lambda: utility.read_file_in_chunks(args.infile, args.chunksize)
+        timings = []
+        start = time.time()
+        if not utility.write_file_from_chunks(gcodetools.stream_pipeline(read_chunks, stages, timings), args.outfile):
+            raise SystemExit(1)
+        total = time.time() - start
+        # what is not spent in the stages is spent writing
+        timings.append(("write", total - sum(secs for _, secs in timings)))
+        for label, secs in timings:
+            print("{:8.3f}s  {}".format(secs, label))
+        print("{:8.3f}s  total".format(total))
         
     elif subcmd == "gui":
         app = QApplication(sys.argv)
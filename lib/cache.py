@@ -0,0 +1,185 @@
+"""
+cnctoolbox - Copyright (c) 2016 Michael Franzl
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+
+import numpy as np
+
+from . import gcodeparser
+
+
+class Cache:
+    '''
+    On-disk cache for arrays derived from G-code files, like the parsed
+    program, the lines drawn by the simulator and time estimates.
+
+    Entries are addressed by a key made from the hash of the program (see
+    lines_hash()) and everything else the result depends on (see key()),
+    so a changed program or setting simply leads to a different entry. Each entry is a
+    directory of .npy files, which are memory-mapped when read. When the
+    total size exceeds `max_bytes`, the least recently used entries are
+    removed.
+
+    @param directory
+    Where the entries are kept, created if missing
+
+    @param max_bytes
+    The total size the entries may take
+    '''
+
+    DEFAULT_MAX_BYTES = 4 << 30
+
+    # lines are hashed in blocks of this many
+    HASH_BLOCK_LINES = 100000
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+
+    @classmethod
+    def lines_hash(cls, lines):
+        '''
+        Returns the SHA-1 hex digest of a list of lines, e.g. a job buffer.
+        '''
+        h = hashlib.sha1()
+        for start in range(0, len(lines), cls.HASH_BLOCK_LINES):
+            h.update("\n".join(lines[start:start + cls.HASH_BLOCK_LINES]).encode("utf-8"))
+            h.update(b"\n")
+        return h.hexdigest()
+
+
+    @staticmethod
+    def key(*parts):
+        '''
+        Returns a key for the given parts, e.g. a file hash and a dict of
+        settings. Parts are compared by their repr(), with dict items sorted.
+        '''
+        def canonical(part):
+            if isinstance(part, dict):
+                return sorted((repr(k), canonical(v)) for k, v in part.items())
+            if isinstance(part, (list, tuple)):
+                return [canonical(p) for p in part]
+            if isinstance(part, np.ndarray):
+                return part.tolist()
+            return part
+        return hashlib.sha1(repr([canonical(p) for p in parts]).encode("utf-8")).hexdigest()
+
+
+    def get(self, key, name):
+        '''
+        Returns the arrays stored under `key` and `name` as a dict of
+        read-only memory-mapped arrays, or None if there are none.
+        '''
+        path = self._path(key, name)
+        if not os.path.isdir(path):
+            return None
+        try:
+            arrays = {}
+            for fname in os.listdir(path):
+                if fname.endswith(".npy"):
+                    arrays[fname[:-4]] = np.load(os.path.join(path, fname), mmap_mode="r")
+        except (OSError, ValueError):
+            logging.getLogger('gerbil').warning("Cache: removing unreadable entry {}".format(path))
+            shutil.rmtree(path, ignore_errors=True)
+            return None
+        # the modification time orders the entries by their last use
+        os.utime(path)
+        return arrays
+
+
+    def put(self, key, name, arrays):
+        '''
+        Stores a dict of arrays under `key` and `name`, and evicts the least
+        recently used entries if the cache has grown too big.
+        '''
+        path = self._path(key, name)
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for array_name, array in arrays.items():
+            np.save(os.path.join(tmp, array_name + ".npy"), np.asarray(array))
+        # complete entries appear at once, readers never see partial ones
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp, path)
+        self.evict()
+
+
+    def evict(self):
+        '''
+        Removes the least recently used entries until the total size is
+        within `max_bytes`.
+        '''
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if not entry.is_dir() or entry.name.endswith(".tmp"):
+                continue
+            size = sum(f.stat().st_size for f in os.scandir(entry.path))
+            entries.append((entry.stat().st_mtime, size, entry.path))
+            total += size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            if entry.is_dir():
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+
+    def parse(self, key, lines, state=None):
+        '''
+        Like gcodeparser.parse(), taking the columnar arrays of the program
+        from the cache if they are stored under `key`.
+        '''
+        arrays = self.get(key, "parsed")
+        if arrays is not None and len(arrays["line_lengths"]) == len(lines):
+            return gcodeparser.from_arrays(lines, arrays, state)
+        parsed = gcodeparser.parse(lines, state)
+        self.put(key, "parsed", parsed.arrays())
+        return parsed
+
+
+    def _path(self, key, name):
+        return os.path.join(self.directory, "{}-{}".format(key, name))
+
+
+    @staticmethod
+    def encode_lines(lines):
+        '''
+        Returns a list of lines as an array of UTF-8 bytes, for storing them.
+        '''
+        return np.frombuffer("\n".join(lines).encode("utf-8"), dtype=np.uint8)
+
+
+    @staticmethod
+    def decode_lines(array):
+        return array.tobytes().decode("utf-8").split("\n")
@@ -0,0 +1,728 @@
+"""
+cnctoolbox - Copyright (c) 2016 Michael Franzl
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import re
+import math
+import numpy as np
+
+from . import gcodewriter
+
+
+# G codes of the motion modal group
+MOTION_GCODES = [0, 1, 2, 3, 38.2, 38.3, 38.4, 38.5, 80]
+
+# same tolerance as grbl uses to detect full circles
+ARC_ANGULAR_TRAVEL_EPSILON = 5e-7
+
+# G codes whose axis words are no targets in the work coordinate system
+NON_POSITIONAL_GCODES = [10, 28, 28.1, 30, 30.1, 53, 92, 92.1]
+
+# One regular expression scans the whole program. A token is either a
+# comment (";" until end of line, or a parenthesized comment) or a word
+# consisting of a letter and a number. Words inside comments are never
+# seen because the comment alternative consumes them first. re.split()
+# returns the text between tokens too, so token positions follow from
+# the cumulative lengths of all parts without creating match objects.
+_re_token = re.compile(r"(;[^\n]*|\([^)\n]*\)?|[A-Za-z][ \t]*[-+]?(?:\d+\.?\d*|\.\d+))")
+
+
+# letters of the words which make a line in G2/G3 mode an arc move,
+# as a lookup table indexed by the letter code
+_ARC_LETTERS = np.zeros(256, dtype=bool)
+_ARC_LETTERS[[ord(l) for l in "XYZIJKR"]] = True
+
+
+def parse(lines, state=None):
+    '''
+    Tokenizes a G-code program in a single pass and returns a ParsedGcode.
+
+    @param lines
+    A list of lines (with or without trailing newlines), or a single string.
+
+    @param state
+    The ModalState in effect before the first line. Pass the end_state()
+    of the previous part when a program is processed in parts.
+    '''
+    if isinstance(lines, ParsedGcode):
+        return lines
+
+    if isinstance(lines, str):
+        lines = lines.split("\n")
+    else:
+        lines = list(lines)
+
+    text = "\n".join(lines)
+
+    line_count = len(lines)
+    line_lengths = np.fromiter(map(len, lines), dtype=np.int64, count=line_count)
+    line_starts = np.zeros(line_count, dtype=np.int64)
+    if line_count > 1:
+        line_starts[1:] = np.cumsum(line_lengths + 1)[:-1]
+
+    parts = _re_token.split(text)
+    part_lengths = np.fromiter(map(len, parts), dtype=np.int64, count=len(parts))
+    tokens = parts[1::2]
+    token_ends = np.cumsum(part_lengths)[1::2]
+    token_starts = token_ends - part_lengths[1::2]
+    token_lines = np.searchsorted(line_starts, token_starts, side="right") - 1
+
+    first_chars = np.frombuffer("".join([t[0] for t in tokens]).upper().encode("ascii"), dtype=np.uint8)
+    is_comment = (first_chars == ord(";")) | (first_chars == ord("("))
+    is_word = ~is_comment
+
+    word_lines = token_lines[is_word]
+    comment_lines = token_lines[is_comment]
+    return ParsedGcode(
+        lines,
+        text,
+        line_starts,
+        line_lengths,
+        word_lines.astype(np.int32),
+        first_chars[is_word],
+        np.array([t[1:] for t, c in zip(tokens, is_comment.tolist()) if not c], dtype=np.float64),
+        (token_starts[is_word] - line_starts[word_lines]).astype(np.int32),
+        (token_ends[is_word] - line_starts[word_lines]).astype(np.int32),
+        comment_lines.astype(np.int32),
+        (token_starts[is_comment] - line_starts[comment_lines]).astype(np.int32),
+        (token_ends[is_comment] - line_starts[comment_lines]).astype(np.int32),
+        state,
+        )
+
+
+def from_arrays(lines, arrays, state=None):
+    '''
+    Returns a ParsedGcode made from the lines of a program and the arrays
+    of ParsedGcode.arrays() which were parsed from them before, e.g. kept
+    in a cache.
+    '''
+    lines = list(lines)
+    return ParsedGcode(lines, "\n".join(lines), *[arrays[name] for name in ParsedGcode.ARRAYS], state=state)
+
+
+def format_value(value, precision=3):
+    '''
+    Formats a number for G-code output with at most `precision` decimals
+    and without trailing zeros, e.g. 1.500 -> "1.5", 2.000 -> "2".
+    '''
+    txt = "{:0.{}f}".format(value, precision)
+    if "." in txt:
+        txt = txt.rstrip("0").rstrip(".")
+    if txt == "-0":
+        txt = "0"
+    return txt
+
+
+def format_values(values, precision=3):
+    '''
+    Like format_value(), for a whole array of numbers. Raises ValueError
+    for NaN and infinite values, which are no valid G-code numbers.
+    '''
+    values = np.asarray(values, dtype=np.float64).reshape(-1)
+    finite = np.isfinite(values)
+    if not finite.all():
+        raise ValueError("gcodeparser: Cannot format {} as a G-code number".format(values[~finite][0]))
+    # numbers with too many digits for gcodewriter's character matrix
+    # take the slow path as well
+    if len(values) >= 64 and np.abs(values).max() * 10 ** precision < gcodewriter.MAX_SCALED / 2:
+        return gcodewriter.format_numbers(values, precision)
+    # for a few numbers, this is faster than setting up the arrays
+    return [format_value(v, precision) for v in values.tolist()]
+
+
+def ffill(values, initial=np.nan):
+    '''
+    Forward-fills NaN entries of a per-line column with the last valid
+    value, emulating how a modal word stays in effect on following lines.
+    Leading NaNs are replaced by `initial`.
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    idx = np.where(valid, np.arange(len(values)), -1)
+    np.maximum.accumulate(idx, out=idx)
+    result = values[idx]
+    result[idx < 0] = initial
+    return result
+
+
+class ParsedGcode:
+    '''
+    Columnar representation of a tokenized G-code program.
+
+    All words of all lines are stored in flat parallel arrays:
+
+    word_line    index of the line the word belongs to
+    word_letter  ASCII code of the (uppercased) word letter
+    word_value   numeric value of the word
+    word_start   character offset of the word within its line
+    word_end     character offset after the word within its line
+
+    Comments are stored the same way in comment_line, comment_start and
+    comment_end. The original lines, and the text they were joined to
+    for tokenization, are kept for rendering. `state` is the ModalState
+    before the first line, all modal evaluations start from it.
+    '''
+
+    # the arrays of the constructor, in order
+    ARRAYS = ("line_starts", "line_lengths", "word_line", "word_letter", "word_value", "word_start", "word_end",
+              "comment_line", "comment_start", "comment_end")
+
+    def __init__(self, lines, text, line_starts, line_lengths, word_line, word_letter, word_value, word_start, word_end, comment_line, comment_start, comment_end, state=None):
+        self.lines = lines
+        self.text = text
+        self.line_starts = line_starts
+        self.line_lengths = line_lengths
+        self.word_line = word_line
+        self.word_letter = word_letter
+        self.word_value = word_value
+        self.word_start = word_start
+        self.word_end = word_end
+        self.comment_line = comment_line
+        self.comment_start = comment_start
+        self.comment_end = comment_end
+        self.state = state if state is not None else ModalState()
+
+        # for results derived from the program, like the bounding box
+        self.cache = {}
+
+
+    def __len__(self):
+        return len(self.lines)
+
+
+    def arrays(self):
+        '''
+        Returns the columnar arrays of the program by name, everything but
+        the lines and the state. See from_arrays().
+        '''
+        return {name: getattr(self, name) for name in self.ARRAYS}
+
+
+    def words(self, letter):
+        '''
+        Returns a boolean mask over all words which have the given letter.
+        '''
+        return self.word_letter == ord(letter)
+
+
+    def column(self, letter, fill=np.nan):
+        '''
+        Returns one value per line for the given word letter, or `fill` for
+        lines which do not contain the word. If a word appears more than
+        once on a line, the last occurrence wins.
+        '''
+        result = np.full(len(self.lines), fill, dtype=np.float64)
+        mask = self.words(letter)
+        result[self.word_line[mask]] = self.word_value[mask]
+        return result
+
+
+    def has(self, letter):
+        '''
+        Returns a boolean mask over all lines which contain the word letter.
+        '''
+        result = np.zeros(len(self.lines), dtype=bool)
+        result[self.word_line[self.words(letter)]] = True
+        return result
+
+
+    def has_gcode(self, codes):
+        '''
+        Returns a boolean mask over all lines which contain any of the
+        given G codes, e.g. has_gcode([54, 55]).
+        '''
+        result = np.zeros(len(self.lines), dtype=bool)
+        result[self.word_line[self._gcode_words(codes)]] = True
+        return result
+
+
+    def modal_gcode(self, codes, initial=np.nan):
+        '''
+        Returns the G code of the given modal group which is in effect on
+        each line, e.g. modal_gcode([90, 91], 90) for the distance mode.
+        '''
+        result = np.full(len(self.lines), np.nan, dtype=np.float64)
+        idx = self._gcode_words(codes)
+        result[self.word_line[idx]] = self.word_value[idx]
+        return ffill(result, initial)
+
+
+    def modal_mcode(self, codes, initial=np.nan):
+        '''
+        Returns the M code of the given modal group which is in effect on
+        each line, e.g. modal_mcode([3, 4, 5], 5) for the spindle state.
+        '''
+        result = np.full(len(self.lines), np.nan, dtype=np.float64)
+        idx = np.flatnonzero(self.words("M"))
+        idx = idx[np.isin(self.word_value[idx], codes)]
+        result[self.word_line[idx]] = self.word_value[idx]
+        return ffill(result, initial)
+
+
+    def _gcode_words(self, codes):
+        # indices of the G words with one of the codes, only the G words
+        # are compared against the codes
+        idx = np.flatnonzero(self.words("G"))
+        return idx[np.isin(self.word_value[idx], codes)]
+
+
+    def non_positional(self):
+        '''
+        Returns a boolean mask over all lines whose axis words do not
+        specify a target in the current work coordinate system, like
+        G10 L2 (set CS offsets), G28/G30 (go home), G53 (machine
+        coordinates) and G92 (set offsets).
+        '''
+        return self.has_gcode(NON_POSITIONAL_GCODES)
+
+
+    def unparsed(self):
+        '''
+        Returns a boolean mask over all lines which contain anything else
+        than words and comments, like system commands ($H) or parameters
+        and expressions (Z#1), which are not understood by this parser.
+        '''
+        leftover = _re_token.sub("", self.text).split("\n")
+        return np.array([bool(text.strip()) for text in leftover], dtype=bool)
+
+
+    def positions(self, initial=None):
+        '''
+        Returns an array of shape (lines, 3) containing the XYZ position in
+        the work coordinate system after each line has been executed.
+        Absolute (G90) and relative (G91) distance modes are honored.
+
+        @param initial
+        The position before the first line, defaults to that of the state
+        '''
+        if initial is None:
+            initial = self.state.position
+        relative = self.modal_gcode([90, 91], self.state.distance) == 91
+        ignored = self.non_positional()
+        indices = np.arange(len(self.lines))
+        result = np.empty((len(self.lines), 3), dtype=np.float64)
+
+        for i, axis in enumerate(["X", "Y", "Z"]):
+            values = self.column(axis)
+            values[ignored] = np.nan
+            present = ~np.isnan(values)
+
+            # running sum of relative moves, and the index of the last
+            # absolute move of this axis
+            deltas = np.where(present & relative, values, 0)
+            sums = np.cumsum(deltas)
+            last_absolute = np.where(present & ~relative, indices, -1)
+            np.maximum.accumulate(last_absolute, out=last_absolute)
+
+            base = np.full(len(self.lines), float(initial[i]), dtype=np.float64)
+            has_absolute = last_absolute >= 0
+            k = last_absolute[has_absolute]
+            base[has_absolute] = values[k] - sums[k]
+            result[:, i] = base + sums
+
+        return result
+
+
+    def arcs(self, positions=None, initial=None):
+        '''
+        Returns the geometry of all G2/G3 moves as an Arcs object. Both
+        the center offset (I, J, K) and the radius (R) format are supported,
+        in all planes (G17, G18, G19).
+
+        Radius format arcs which grbl rejects, because start and end point
+        coincide or are further apart than the diameter, are marked in
+        `invalid` and get the geometry of a straight move.
+
+        @param positions
+        The result of positions(), if already available
+
+        @param initial
+        The position before the first line, defaults to that of the state
+        '''
+        if initial is None:
+            initial = self.state.position
+        if positions is None:
+            positions = self.positions(initial)
+
+        motion = self.modal_gcode(MOTION_GCODES, self.state.motion)
+        moves = np.zeros(len(self.lines), dtype=bool)
+        moves[self.word_line[_ARC_LETTERS[self.word_letter]]] = True
+        line = np.nonzero(np.isin(motion, [2, 3]) & moves & ~self.non_positional())[0]
+
+        start = np.vstack([initial, positions[:-1]])[line]
+        end = positions[line]
+        clockwise = motion[line] == 2
+
+        plane = self.modal_gcode([17, 18, 19], self.state.plane)[line]
+        axes = np.empty((len(line), 3), dtype=np.int64)
+        axes[plane == 17] = [0, 1, 2]
+        axes[plane == 18] = [2, 0, 1]
+        axes[plane == 19] = [1, 2, 0]
+        rows = np.arange(len(line))
+
+        s0 = start[rows, axes[:, 0]]
+        s1 = start[rows, axes[:, 1]]
+        e0 = end[rows, axes[:, 0]]
+        e1 = end[rows, axes[:, 1]]
+
+        ijk = np.column_stack([np.nan_to_num(self.column(a)[line]) for a in ["I", "J", "K"]])
+        o0 = ijk[rows, axes[:, 0]]
+        o1 = ijk[rows, axes[:, 1]]
+
+        # radius format, computed like grbl does
+        r = self.column("R")[line]
+        radius_format = ~np.isnan(r)
+        invalid = np.zeros(len(line), dtype=bool)
+        if radius_format.any():
+            x = e0[radius_format] - s0[radius_format]
+            y = e1[radius_format] - s1[radius_format]
+            rr = r[radius_format]
+            d = np.hypot(x, y)
+            discriminant = 4 * rr * rr - x * x - y * y
+            # grbl's errors 33 (same point) and 34 (radius too small)
+            bad = (d == 0) | (discriminant < 0)
+            h = np.zeros(len(rr))
+            h[~bad] = -np.sqrt(discriminant[~bad]) / d[~bad]
+            h = np.where(clockwise[radius_format], h, -h)
+            h = np.where(rr < 0, -h, h)
+            o0[radius_format] = np.where(bad, 0, 0.5 * (x - y * h))
+            o1[radius_format] = np.where(bad, 0, 0.5 * (y + x * h))
+            invalid[radius_format] = bad
+
+        c0 = s0 + o0
+        c1 = s1 + o1
+        radius = np.hypot(o0, o1)
+
+        # angular travel, full circles when start and end coincide
+        r0 = -o0
+        r1 = -o1
+        t0 = e0 - c0
+        t1 = e1 - c1
+        travel = np.arctan2(r0 * t1 - r1 * t0, r0 * t0 + r1 * t1)
+        travel = np.where(clockwise & (travel >= -ARC_ANGULAR_TRAVEL_EPSILON), travel - 2 * np.pi, travel)
+        travel = np.where(~clockwise & (travel <= ARC_ANGULAR_TRAVEL_EPSILON), travel + 2 * np.pi, travel)
+        travel[invalid] = 0
+
+        center = start.copy()
+        center[rows, axes[:, 0]] = c0
+        center[rows, axes[:, 1]] = c1
+
+        return Arcs(line, start, end, center, radius, np.arctan2(-o1, -o0), travel, axes, invalid)
+
+
+    def end_state(self):
+        '''
+        Returns the ModalState after the last line has been executed.
+        '''
+        state = self.state.copy()
+        if len(self.lines) == 0:
+            return state
+
+        state.position = [float(v) for v in self.positions()[-1]]
+        for name, codes in ModalState.GCODE_GROUPS.items():
+            value = float(self.modal_gcode(codes, getattr(state, name))[-1])
+            setattr(state, name, int(value) if value.is_integer() else value)
+        for name, codes in ModalState.MCODE_GROUPS.items():
+            mask = self.words("M") & np.isin(self.word_value, codes)
+            if mask.any():
+                setattr(state, name, int(self.word_value[mask][-1]))
+        for name, letter in [("feed", "F"), ("spindle", "S")]:
+            mask = self.words(letter)
+            if mask.any():
+                setattr(state, name, float(self.word_value[mask][-1]))
+        return state
+
+
+    def contains(self, substring):
+        '''
+        Returns a boolean mask over all lines which contain the substring
+        anywhere, including comments. Used for markers like "_zclear".
+        '''
+        return np.fromiter((substring in l for l in self.lines), dtype=bool, count=len(self.lines))
+
+
+    def render(self, replace_idx=None, replace_values=None, append_line=None, append_text=None, precision=3):
+        '''
+        Returns the program as a new list of lines.
+
+        @param replace_idx
+        Indices of words whose values are to be replaced
+
+        @param replace_values
+        New numeric values for the words given by replace_idx
+
+        @param append_line
+        Line indices to which additional text is to be appended
+
+        @param append_text
+        The text to append for each entry of append_line. It is inserted
+        behind the last word of the line, in front of trailing comments.
+        '''
+        starts = []
+        ends = []
+        texts = []
+
+        if replace_idx is not None and len(replace_idx) > 0:
+            replace_idx = np.asarray(replace_idx)
+            word_lines = self.word_line[replace_idx]
+            offsets = self.line_starts[word_lines]
+            starts.append(offsets + self.word_start[replace_idx])
+            ends.append(offsets + self.word_end[replace_idx])
+            letters = self.word_letter[replace_idx].tobytes().decode("ascii")
+            texts += [l + v for l, v in zip(letters, format_values(replace_values, precision))]
+
+        if append_line is not None and len(append_line) > 0:
+            append_line = np.asarray(append_line)
+            pos = self.line_starts[append_line] + self._append_positions(append_line)
+            starts.append(pos)
+            ends.append(pos)
+            texts += list(append_text)
+
+        if len(texts) == 0:
+            return list(self.lines)
+
+        starts = np.concatenate(starts)
+        ends = np.concatenate(ends)
+        order = np.argsort(starts, kind="stable")
+
+        # splice the replacements into the joined program text in one go
+        text = self.text
+        parts = []
+        pos = 0
+        for i, start, end in zip(order.tolist(), starts[order].tolist(), ends[order].tolist()):
+            parts.append(text[pos:start])
+            parts.append(texts[i])
+            pos = end
+        parts.append(text[pos:])
+        text = "".join(parts)
+
+        # cut the new text back into lines at the shifted line boundaries
+        deltas = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts)) - (ends - starts)
+        edit_lines = np.searchsorted(self.line_starts, starts, side="right") - 1
+        lengths = self.line_lengths + np.bincount(edit_lines, weights=deltas, minlength=len(self.lines)).astype(np.int64)
+        line_ends = np.cumsum(lengths + 1) - 1
+        line_starts = line_ends - lengths
+        return [text[s:e] for s, e in zip(line_starts.tolist(), line_ends.tolist())]
+
+
+    def _append_positions(self, line_idx):
+        # behind the last word of each line, or the line end if it has no words
+        result = np.zeros(len(line_idx), dtype=np.int64)
+        last_word = np.searchsorted(self.word_line, line_idx, side="right") - 1
+        has_word = (last_word >= 0)
+        has_word[has_word] = self.word_line[last_word[has_word]] == line_idx[has_word]
+        result[has_word] = self.word_end[last_word[has_word]]
+        for i in np.nonzero(~has_word)[0].tolist():
+            line = self.lines[line_idx[i]]
+            result[i] = len(line.rstrip())
+        return result
+
+
+class ModalState:
+    '''
+    The modal state of the machine between two lines of a program: the
+    position in the work coordinate system, the active G code of each
+    modal group, and the feed, spindle speed, spindle and coolant state.
+    '''
+    GCODE_GROUPS = {
+        "motion": MOTION_GCODES,
+        "distance": [90, 91],
+        "plane": [17, 18, 19],
+        "units": [20, 21],
+        "cs": [54, 55, 56, 57, 58, 59],
+        "feedmode": [93, 94],
+        }
+
+    MCODE_GROUPS = {
+        "spindle_state": [3, 4, 5],
+        "coolant": [7, 8, 9],
+        }
+
+    def __init__(self, position=(0, 0, 0), motion=0, distance=90, plane=17, units=21, cs=54, feedmode=94, feed=0, spindle=0, spindle_state=5, coolant=9):
+        self.position = [float(v) for v in position]
+        self.motion = motion
+        self.distance = distance
+        self.plane = plane
+        self.units = units
+        self.cs = cs
+        self.feedmode = feedmode
+        self.feed = feed
+        self.spindle = spindle
+        self.spindle_state = spindle_state
+        self.coolant = coolant
+
+
+    def copy(self):
+        state = ModalState()
+        state.__dict__.update(self.__dict__)
+        state.position = list(self.position)
+        return state
+
+
+    def __repr__(self):
+        return "ModalState({})".format(", ".join("{}={}".format(k, v) for k, v in sorted(self.__dict__.items())))
+
+
+def checkpoints(parsed, interval=None):
+    '''
+    Records the modal state before every `interval`-th line of a program,
+    see Checkpoints.
+
+    The positions are recorded independently of the position before the
+    first line, which is given to Checkpoints.state_at() instead: every
+    axis is either at the target of an absolute move, or where it was
+    at the start plus the sum of the relative moves since.
+
+    @param parsed
+    A ParsedGcode, or lines which are parsed
+    '''
+    parsed = parse(parsed)
+    interval = interval or Checkpoints.DEFAULT_INTERVAL
+    # checkpoint k is the state after line k * interval - 1
+    after = np.arange(interval, len(parsed), interval) - 1
+    state = parsed.state
+
+    def sample(values, initial):
+        return np.concatenate(([initial], values[after])).astype(np.float64)
+
+    arrays = {
+        "interval": np.array(interval),
+        "count": np.array(len(parsed)),
+        "absolute": np.vstack(([[np.nan] * 3], parsed.positions([np.nan] * 3)[after])),
+        "relative": np.vstack(([[0.0] * 3], parsed.positions([0, 0, 0])[after])),
+        }
+    for name, codes in ModalState.GCODE_GROUPS.items():
+        arrays[name] = sample(parsed.modal_gcode(codes, getattr(state, name)), getattr(state, name))
+    for name, codes in ModalState.MCODE_GROUPS.items():
+        arrays[name] = sample(parsed.modal_mcode(codes, getattr(state, name)), getattr(state, name))
+    for name, letter in [("feed", "F"), ("spindle", "S")]:
+        arrays[name] = sample(ffill(parsed.column(letter), getattr(state, name)), getattr(state, name))
+    return Checkpoints(arrays)
+
+
+class Checkpoints:
+    '''
+    The modal state before every `interval`-th line of a program, so that
+    the state before any line is found by replaying at most `interval`
+    lines instead of the whole program before it. Made by checkpoints(),
+    or from the arrays() kept in a cache.
+    '''
+
+    DEFAULT_INTERVAL = 10000
+
+    def __init__(self, arrays):
+        self._arrays = arrays
+        self.interval = int(arrays["interval"])
+        self.count = int(arrays["count"])
+
+
+    def arrays(self):
+        return dict(self._arrays)
+
+
+    def state_at(self, lines, line, position=(0, 0, 0)):
+        '''
+        Returns the ModalState before a line of the program.
+
+        @param lines
+        The program the checkpoints were recorded from
+
+        @param line
+        The line number, up to the number of lines for the end state
+
+        @param position
+        The position before the first line of the program
+        '''
+        if not 0 <= line <= self.count:
+            raise IndexError("line {} is not in the program".format(line))
+        k = min(line // self.interval, len(self._arrays["cs"]) - 1)
+
+        state = ModalState()
+        absolute = self._arrays["absolute"][k]
+        relative = self._arrays["relative"][k]
+        state.position = np.where(np.isnan(absolute), np.add(position, relative), absolute).tolist()
+        for name in list(ModalState.GCODE_GROUPS) + list(ModalState.MCODE_GROUPS) + ["feed", "spindle"]:
+            value = float(self._arrays[name][k])
+            setattr(state, name, int(value) if value.is_integer() else value)
+
+        start = k * self.interval
+        if start == line:
+            return state
+        return parse(lines[start:line], state).end_state()
+
+
+class Arcs:
+    '''
+    Geometry of the arc moves of a program, as returned by
+    ParsedGcode.arcs(). All attributes are arrays with one entry per arc:
+
+    line         index of the line
+    start        start point (n, 3)
+    end          end point (n, 3)
+    center       center point (n, 3), the linear axis coordinate is that of start
+    radius       radius
+    start_angle  angle of the start point as seen from the center
+    travel       signed angular travel, negative for clockwise arcs
+    axes         plane axis indices (n, 3), the third one is the linear axis
+    invalid      True for arcs which grbl rejects, with zero radius and travel
+    '''
+    def __init__(self, line, start, end, center, radius, start_angle, travel, axes, invalid):
+        self.line = line
+        self.start = start
+        self.end = end
+        self.center = center
+        self.radius = radius
+        self.start_angle = start_angle
+        self.travel = travel
+        self.axes = axes
+        self.invalid = invalid
+
+
+    def __len__(self):
+        return len(self.line)
+
+
+    def select(self, which):
+        '''
+        Returns the arcs selected by a boolean mask or an index array.
+        '''
+        return Arcs(self.line[which], self.start[which], self.end[which], self.center[which],
+                    self.radius[which], self.start_angle[which], self.travel[which], self.axes[which], self.invalid[which])
+
+
+    def extremes(self):
+        '''
+        Returns the points (n, 4, 3) where each arc reaches its extreme
+        extents in the plane (angles 0, 90, 180, 270 degrees), and a
+        boolean mask (n, 4) telling which of them lie on the arc.
+        '''
+        angles = np.array([0, 0.5, 1, 1.5]) * np.pi
+        rows = np.arange(len(self.line))
+        points = np.repeat(self.center[:, None, :], 4, axis=1)
+        for k, angle in enumerate(angles):
+            points[rows, k, self.axes[:, 0]] += self.radius * math.cos(angle)
+            points[rows, k, self.axes[:, 1]] += self.radius * math.sin(angle)
+
+        # angular distance from the start point in direction of travel
+        direction = np.sign(self.travel)[:, None]
+        delta = np.mod(direction * (angles - self.start_angle[:, None]), 2 * np.pi)
+        inside = delta <= np.abs(self.travel)[:, None]
+        return points, inside
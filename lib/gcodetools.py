@@ -22,12 +22,22 @@ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 OTHER DEALINGS IN THE SOFTWARE.
 """
 
+import itertools
 import logging
 import re
+import time
 import numpy as np
 import math
 
-from . import hersheydata
+from . import gcodeparser
+from . import heightmap
+from . import hershey
+from . import gcodewriter
+from . import travel
+
+
+CS_GCODES = [54, 55, 56, 57, 58, 59]
+CS_NAMES = ["G54", "G55", "G56", "G57", "G58", "G59"]
 
 
 def read(fname):
@@ -39,21 +49,26 @@ def write(fname, contents):
         f.write(contents)
 
 def to_origin(gcode):
-    bb = bbox(gcode)
+    parsed = gcodeparser.parse(gcode)
+    bb = bbox(parsed)
     xmin = bb[0][0]
     ymin = bb[1][0]
-    translated_gcode = translate(gcode, [-xmin, -ymin, 0])
+    translated_gcode = translate(parsed, [-xmin, -ymin, 0])
     return translated_gcode
 
 def scale_into(gcode, width, height, depth, scale_zclear=False):
-    bb = bbox(gcode)
+    parsed = gcodeparser.parse(gcode)
+    transform = _scale_into_transform(bbox(parsed), width, height, depth)
+    skip_marker = None if scale_zclear else "_zclear"
+    return transform.apply(parsed, skip_marker)
+
+def _scale_into_transform(bb, width, height, depth):
     xmin = bb[0][0]
     xmax = bb[0][1]
     ymin = bb[1][0]
     ymax = bb[1][1]
     zmin = bb[2][0]
     zmax = bb[2][1]
-    translated_gcode = translate(gcode, [-xmin, -ymin, 0])
     
     if width > 0:
         w = xmax - xmin
@@ -69,14 +84,464 @@ def scale_into(gcode, width, height, depth, scale_zclear=False):
         d = zmax - zmin
         fac_z = depth / d
     
-    scaled_gcode = scale_factor(translated_gcode, [fac_x, fac_y, fac_z], scale_zclear)
-    return scaled_gcode
+    # translation and scaling are applied in one pass
+    return Transform().translate([-xmin, -ymin, 0]).scale([fac_x, fac_y, fac_z])
+
+
+# The stream_* functions take the program as an iterable of lists of lines
+# (see utility.read_file_in_chunks) and are generators of lists of lines,
+# so that only one chunk is in memory at a time. The modal state is
+# carried from one chunk to the next. Lines are yielded without line
+# breaks, like the lines which the transformations add. A chunk of None
+# aborts the stream, so that utility.write_file_from_chunks() discards
+# what was written so far.
+
+def stream_transform(chunks, transform, skip_marker=None, state=None):
+    for chunk in chunks:
+        if chunk is None:
+            yield None
+            return
+        parsed = gcodeparser.parse([line.rstrip("\n") for line in chunk], state)
+        yield transform.apply(parsed, skip_marker)
+        state = parsed.end_state()
+
+def stream_translate(chunks, offsets=[0, 0, 0]):
+    logger = logging.getLogger('gerbil')
+    for chunk in chunks:
+        parsed = gcodeparser.parse([line.rstrip("\n") for line in chunk])
+        relative = parsed.has_gcode([91])
+        if relative.any():
+            line = parsed.lines[np.argmax(relative)]
+            logger.error("gcodetools.stream_translate: It does not make sense to translate movements in G91 distance mode. Aborting at line {}".format(line))
+            yield None
+            return
+        # without G91, translation does not depend on the modal state
+        yield Transform().translate(offsets).apply(parsed)
+
+def stream_scale_factor(chunks, facts=[1, 1, 1], scale_zclear=False):
+    facts = [1 if f == 0 else f for f in facts]
+    skip_marker = None if scale_zclear else "_zclear"
+    return stream_transform(chunks, Transform().scale(facts), skip_marker)
+
+def stream_scale_into(read_chunks, width, height, depth, scale_zclear=False):
+    '''
+    Two passes: the first one finds the bounding box, the second one
+    transforms. `read_chunks` is called once per pass and must return
+    a new iterable of chunks each time.
+    '''
+    transform = _scale_into_transform(stream_bbox(read_chunks()), width, height, depth)
+    skip_marker = None if scale_zclear else "_zclear"
+    return stream_transform(read_chunks(), transform, skip_marker)
+
+def stream_to_origin(read_chunks):
+    bb = stream_bbox(read_chunks())
+    return stream_translate(read_chunks(), [-bb[0][0], -bb[1][0], 0])
+
+
+# stages of stream_pipeline(), with the numbers of values they may take
+PIPELINE_STAGES = {
+    "scale": (3,),
+    "translate": (3,),
+    "origin": (0,),
+    "into": (3,),
+    "linearize": (0, 1),
+    "minify": (0, 3),
+    }
+
+def pipeline_stages(spec):
+    '''
+    Parses a pipeline like "scale=0.5,0.5,1 | origin | translate=10,10,0 | minify"
+    into a list of (name, values) tuples for stream_pipeline(). The stages
+    are like the command line subcommands scale_factor, translate,
+    2origin, scale_into, linearize (with the tolerance) and minify (with
+    the steps/mm of the axes).
+    '''
+    stages = []
+    for part in spec.split("|"):
+        name, _, values = part.partition("=")
+        name = name.strip()
+        if name not in PIPELINE_STAGES:
+            raise ValueError("Unknown pipeline stage '{}', the stages are {}".format(name, ", ".join(PIPELINE_STAGES)))
+        values = [float(v) for v in values.split(",")] if values.strip() else []
+        if len(values) not in PIPELINE_STAGES[name]:
+            raise ValueError("Pipeline stage '{}' takes {} values, not {}".format(name, " or ".join(map(str, PIPELINE_STAGES[name])), len(values)))
+        stages.append((name, values))
+    return stages
+
+def stream_pipeline(read_chunks, stages, timings=None):
+    '''
+    Runs a program through several stages in one pass: every chunk goes
+    through all stages in memory before the next one is read, so the file
+    is read, parsed and written only once instead of once per stage.
+
+    Consecutive scale, translate, origin and into stages are fused into a
+    single Transform, as far as they skip the same lines (scale and into
+    leave "_zclear" lines alone). The bounding box which origin and into
+    need is found in one read-only pass before, and carried through the
+    transformations of the stages before them.
+
+    @param read_chunks
+    Returns a new iterable of chunks of lines each time it is called,
+    see stream_scale_into()
+
+    @param stages
+    List of (name, values) tuples, see pipeline_stages()
+
+    @param timings
+    A list which receives a (label, seconds) tuple for reading, for the
+    bounding box pass and for each fused stage, in order
+    '''
+    timings = timings if timings is not None else []
+
+    # groups of fused stages: [labels, transform, skip marker], or
+    # [labels, stage] for the others
+    groups = []
+    transform = Transform()
+    bb = None
+    for name, values in stages:
+        if name in ("origin", "into"):
+            if bb is None:
+                start = time.time()
+                bb = stream_bbox(read_chunks())
+                timings.append(("bbox", time.time() - start))
+            # the bounding box after the transformations so far
+            corners = transform.apply_points(list(itertools.product(*bb)))
+            current = [[lo, hi] for lo, hi in zip(corners.min(axis=0).tolist(), corners.max(axis=0).tolist())]
+
+        if name == "scale":
+            step, skip_marker = Transform().scale([1 if f == 0 else f for f in values]), "_zclear"
+        elif name == "translate":
+            step, skip_marker = Transform().translate(values), None
+        elif name == "origin":
+            step, skip_marker = Transform().translate([-current[0][0], -current[1][0], 0]), None
+        elif name == "into":
+            step, skip_marker = _scale_into_transform(current, *values), "_zclear"
+        else:
+            groups.append([[name], (name, values)])
+            continue
+
+        transform = transform.then(step)
+        label = name + ("=" + ",".join("{:g}".format(v) for v in values) if values else "")
+        if groups and len(groups[-1]) == 3 and groups[-1][2] == skip_marker:
+            groups[-1][0].append(label)
+            groups[-1][1] = groups[-1][1].then(step)
+        else:
+            groups.append([[label], step, skip_marker])
+
+    first = len(timings)
+    timings.append(("read", 0))
+    chunks = _timed(read_chunks(), timings, first)
+    for group in groups:
+        if len(group) == 3:
+            chunks = stream_transform(chunks, group[1], group[2])
+        else:
+            chunks = _stream_stage(chunks, *group[1])
+        timings.append((" | ".join(group[0]), 0))
+        chunks = _timed(chunks, timings, len(timings) - 1)
+
+    yield from chunks
+
+    # the times were measured including the steps before
+    for i in range(len(timings) - 1, first, -1):
+        timings[i] = (timings[i][0], timings[i][1] - timings[i - 1][1])
+
+def _stream_stage(chunks, name, values, state=None):
+    for chunk in chunks:
+        if chunk is None:
+            yield None
+            return
+        parsed = gcodeparser.parse(chunk, state)
+        if name == "linearize":
+            result = linearize_arcs(parsed, *values)
+        else:
+            result = minify(parsed, values or None)
+        if result is None:
+            yield None
+            return
+        yield result[0]
+        state = parsed.end_state()
+
+def _timed(chunks, timings, i):
+    # adds the time spent in producing the chunks to timings[i], which
+    # includes the time of all steps the chunks come from
+    chunks = iter(chunks)
+    end = object()
+    while True:
+        start = time.time()
+        chunk = next(chunks, end)
+        timings[i] = (timings[i][0], timings[i][1] + time.time() - start)
+        if chunk is end:
+            return
+        yield chunk
+
+
+def stream_tile(gcode, offsets, serpentine=True):
+    '''
+    Generator of one translated copy of the program (as a list of lines)
+    per entry of `offsets`.
+
+    The program is parsed only once. Its text is cut into a template
+    around all absolute X/Y/Z words, so that producing a copy only means
+    adding the offsets to the coordinate array, formatting the numbers
+    and joining the template.
+
+    @param gcode
+    A list of lines or a ParsedGcode
+
+    @param offsets
+    List of [x, y] or [x, y, z] offsets, one per copy
+
+    @param serpentine
+    Whether to emit the copies row by row (by Y), alternating the X
+    direction from one row to the next, to keep travel moves between
+    copies short. Otherwise they are emitted in the given order.
+    '''
+    logger = logging.getLogger('gerbil')
+
+    parsed = gcodeparser.parse(gcode)
+    relative = parsed.has_gcode([91])
+    if relative.any():
+        line = parsed.lines[np.argmax(relative)]
+        logger.error("gcodetools.stream_tile: It does not make sense to translate movements in G91 distance mode. Aborting at line {}".format(line))
+        return
+
+    if len(offsets) == 0:
+        return
+    offsets = np.asarray(offsets, dtype=np.float64)
+    if offsets.shape[1] < 3:
+        offsets = np.column_stack([offsets, np.zeros((len(offsets), 3 - offsets.shape[1]))])
+    if serpentine:
+        offsets = offsets[serpentine_order(offsets)]
+
+    # axes which are offset in none of the copies are left untouched
+    moved_axes = [a for a in range(3) if np.any(offsets[:, a] != 0)]
+    letters = np.array([ord(l) for l in "XYZ"], dtype=np.uint8)
+    idx = np.nonzero(np.isin(parsed.word_letter, letters[moved_axes]) & ~parsed.non_positional()[parsed.word_line])[0]
+    axis = np.searchsorted(letters, parsed.word_letter[idx])
+    values = parsed.word_value[idx]
+
+    # the template: text pieces in between the words, each ending with the
+    # letter of the word that follows
+    line_offsets = parsed.line_starts[parsed.word_line[idx]]
+    starts = (line_offsets + parsed.word_start[idx]).tolist()
+    ends = (line_offsets + parsed.word_end[idx]).tolist()
+    text = parsed.text
+    template = []
+    pos = 0
+    for start, end, letter in zip(starts, ends, parsed.word_letter[idx].tobytes().decode("ascii")):
+        template.append(text[pos:start] + letter)
+        pos = end
+    template.append(text[pos:])
+
+    parts = [None] * (2 * len(template) - 1)
+    parts[0::2] = template
+    for offset in offsets:
+        parts[1::2] = gcodeparser.format_values(values + offset[axis])
+        yield "".join(parts).split("\n")
+
+def tile(gcode, offsets, serpentine=True):
+    '''
+    Like stream_tile(), but returns all copies as a single list of lines.
+    '''
+    result = []
+    for copy in stream_tile(gcode, offsets, serpentine):
+        result += copy
+    return result
+
+def serpentine_order(offsets):
+    '''
+    Returns the indices which sort 2D/3D offsets row by row (ascending Y),
+    with ascending X in every other row and descending X in between.
+    '''
+    offsets = np.asarray(offsets, dtype=np.float64)
+    if len(offsets) == 0:
+        return np.zeros(0, dtype=int)
+    rows = np.unique(np.round(offsets[:, 1], 6), return_inverse=True)[1].reshape(-1)
+    x = np.where(rows % 2 == 0, offsets[:, 0], -offsets[:, 0])
+    return np.lexsort((x, rows))
+    
     
+class Transform:
+    '''
+    A composable affine transformation of G-code.
+    
+    Every method returns a new Transform which applies the given operation
+    after all previous ones, so that operations can be chained:
+    
+    t = Transform().scale([0.2, 0.2, 1]).rotate(30, [0, 0]).translate([10, 0, 0])
+    gcode = t.apply(gcode)
+    
+    All operations are collected in a single 4x4 matrix, which is applied
+    to all X/Y/Z/I/J/K/R words of a program in one vectorized pass. Arcs
+    in planes which would not stay circular, e.g. when scaling X and Y
+    differently, are linearized within `arc_tolerance` before.
+    '''
+    def __init__(self, matrix=None, arc_tolerance=0.01):
+        if matrix is None:
+            matrix = np.identity(4)
+        self.matrix = np.asarray(matrix, dtype=np.float64)
+        # arcs which would become ellipses are replaced by line segments
+        # deviating at most this much from them
+        self.arc_tolerance = arc_tolerance
+        
+    def then(self, other):
+        matrix = other.matrix if isinstance(other, Transform) else other
+        return Transform(np.dot(matrix, self.matrix), self.arc_tolerance)
+        
+    def translate(self, offsets):
+        m = np.identity(4)
+        m[:3, 3] = offsets
+        return self.then(m)
+    
+    def scale(self, facts, anchor=[0, 0, 0]):
+        m = np.identity(4)
+        m[:3, :3] = np.diag(facts)
+        return self.translate(np.negative(anchor)).then(m).translate(anchor)
+    
+    def rotate(self, angle, anchor=[0, 0]):
+        '''
+        Rotates counterclockwise by `angle` degrees around the Z axis going
+        through the XY point `anchor`.
+        '''
+        angle = math.radians(angle)
+        m = np.identity(4)
+        m[0, 0] = math.cos(angle)
+        m[0, 1] = -math.sin(angle)
+        m[1, 0] = math.sin(angle)
+        m[1, 1] = math.cos(angle)
+        anchor = [anchor[0], anchor[1], 0]
+        return self.translate(np.negative(anchor)).then(m).translate(anchor)
+    
+    def mirror(self, axis, at=0):
+        '''
+        Mirrors at the plane perpendicular to `axis` ("X", "Y" or "Z")
+        going through the coordinate `at`. Arc directions are reversed.
+        '''
+        i = ["X", "Y", "Z"].index(axis.upper())
+        facts = [1, 1, 1]
+        facts[i] = -1
+        anchor = [0, 0, 0]
+        anchor[i] = at
+        return self.scale(facts, anchor)
+    
+    def apply_points(self, points):
+        '''
+        Transforms an array of shape (n, 3) of absolute points.
+        '''
+        points = np.asarray(points, dtype=np.float64)
+        return np.dot(points, self.matrix[:3, :3].T) + self.matrix[:3, 3]
+    
+    # returns list
+    def apply(self, gcode, skip_marker=None, position=None):
+        '''
+        @param gcode
+        A list of lines or a ParsedGcode
+        
+        @param skip_marker
+        Lines containing this string (e.g. "_zclear") are not transformed
+        
+        @param position
+        The position of the machine before the first line, defaults to
+        that of the state of the ParsedGcode
+        '''
+        parsed = gcodeparser.parse(gcode)
+        linear = self.matrix[:3, :3]
+        if position is None:
+            position = parsed.state.position
+        
+        # arcs only stay arcs in planes which are scaled uniformly, rotated
+        # or mirrored, and not tilted. Others are linearized first.
+        distorted = []
+        for plane, axes in [(17, [0, 1]), (18, [0, 2]), (19, [1, 2])]:
+            m = linear[np.ix_(axes, axes)]
+            other = [i for i in range(3) if i not in axes][0]
+            gram = np.dot(m.T, m)
+            conformal = np.allclose(gram, np.identity(2) * gram[0, 0], rtol=1e-9, atol=1e-12) and \
+                        np.allclose(linear[other, axes], 0) and np.allclose(linear[axes, other], 0)
+            if not conformal:
+                distorted.append(plane)
+        if distorted and len(parsed.arcs()):
+            # the tolerance applies to the transformed arcs
+            stretch = np.linalg.norm(linear, 2)
+            result = linearize_arcs(parsed, self.arc_tolerance / stretch, planes=distorted)
+            if result is not None:
+                parsed = gcodeparser.parse(result[0], parsed.state)
+        
+        skip = parsed.non_positional()
+        if skip_marker:
+            skip |= parsed.contains(skip_marker)
+        relative = parsed.modal_gcode([90, 91], parsed.state.distance) == 91
+        
+        # absolute targets are transformed with the full matrix, relative
+        # ones only with the linear part. A coordinate which is not on a
+        # line but changes because of rotation must be added to it.
+        positions = parsed.positions(position)
+        new_positions = self.apply_points(positions)
+        previous = np.vstack([self.apply_points([position]), new_positions[:-1]])
+        
+        xyz = np.column_stack([parsed.column(a) for a in ["X", "Y", "Z"]])
+        present = ~np.isnan(xyz)
+        new_deltas = np.dot(np.nan_to_num(xyz), linear.T)
+        
+        targets = np.where(relative[:, None], new_deltas, new_positions)
+        changed = np.where(relative[:, None], new_deltas, new_positions - previous)
+        emit = present | (present.any(axis=1)[:, None] & (np.abs(changed) > 1e-9))
+        emit[skip] = False
+        
+        # arc center offsets are always relative
+        ijk = np.column_stack([parsed.column(a) for a in ["I", "J", "K"]])
+        ijk_present = ~np.isnan(ijk)
+        new_ijk = np.dot(np.nan_to_num(ijk), linear.T)
+        ijk_emit = ijk_present | (ijk_present.any(axis=1)[:, None] & (np.abs(new_ijk) > 1e-9))
+        ijk_emit[skip] = False
+        
+        replace_idx = []
+        replace_values = []
+        append_line = []
+        append_text = []
+        
+        columns = [("X", targets, emit, 0), ("Y", targets, emit, 1), ("Z", targets, emit, 2),
+                   ("I", new_ijk, ijk_emit, 0), ("J", new_ijk, ijk_emit, 1), ("K", new_ijk, ijk_emit, 2)]
+        for word, values, mask, i in columns:
+            idx = np.nonzero(parsed.words(word))[0]
+            lines = parsed.word_line[idx]
+            new_values = values[lines, i]
+            keep = mask[lines, i] & (np.abs(new_values - parsed.word_value[idx]) > 1e-9)
+            replace_idx.append(idx[keep])
+            replace_values.append(new_values[keep])
+            
+            missing = np.nonzero(mask[:, i] & ~parsed.has(word))[0]
+            append_line.append(missing)
+            append_text += [word + v for v in gcodeparser.format_values(values[missing, i])]
+        
+        # the radius of an arc scales with the area scale factor of the XY plane
+        radius_factor = math.sqrt(abs(np.linalg.det(linear[:2, :2])))
+        if abs(radius_factor - 1) > 1e-9:
+            idx = np.nonzero(parsed.words("R") & ~skip[parsed.word_line])[0]
+            replace_idx.append(idx)
+            replace_values.append(parsed.word_value[idx] * radius_factor)
+        
+        # mirroring reverses the direction of arcs in the affected plane
+        planes = parsed.modal_gcode([17, 18, 19], parsed.state.plane)
+        motion = parsed.words("G") & np.isin(parsed.word_value, [2, 3]) & ~skip[parsed.word_line]
+        for plane, axes in [(17, [0, 1]), (18, [0, 2]), (19, [1, 2])]:
+            if np.linalg.det(linear[np.ix_(axes, axes)]) < 0:
+                idx = np.nonzero(motion & (planes[parsed.word_line] == plane))[0]
+                replace_idx.append(idx)
+                replace_values.append(5 - parsed.word_value[idx])
+        
+        return parsed.render(
+            np.concatenate(replace_idx),
+            np.concatenate(replace_values),
+            np.concatenate(append_line),
+            append_text)
+
+
 # returns string
-def bbox_draw(gcode, move_z=False):
+def bbox_draw(gcode, move_z=False, cs_offsets=None, state=None):
     result = ""
     
-    bb = bbox(gcode)
+    bb = bbox(gcode, cs_offsets, state)
     xmin = bb[0][0]
     xmax = bb[0][1]
     ymin = bb[1][0]
@@ -109,361 +574,1239 @@ def bbox_draw(gcode, move_z=False):
 def translate(lines, offsets=[0, 0, 0]):
     logger = logging.getLogger('gerbil')
     
-    result = []
+    parsed = gcodeparser.parse(lines)
     
-    axes = ["X", "Y", "Z"]
-    contains_regexps = []
-    replace_regexps = []
-    for i in range(0, 3):
-        axis = axes[i]
-        contains_regexps.append(re.compile(".*" + axis + "([-.\d]+)"))
-        replace_regexps.append(re.compile(r"" + axis + "[-.\d]+"))
+    relative = parsed.has_gcode([91])
+    if relative.any():
+        line = parsed.lines[np.argmax(relative)]
+        logger.error("gcodetools.translate: It does not make sense to translate movements in G91 distance mode. Aborting at line {}".format(line))
+        return
     
-    for line in lines:
-        
-        if "G91" in line:
-            logger.error("gcodetools.translate: It does not make sense to translate movements in G91 distance mode. Aborting at line {}".format(line))
-            return
-        
-        for i in range(0, 3):
-            axis = axes[i]
-            cr = contains_regexps[i]
-            rr = replace_regexps[i]
-            ofst = offsets[i]
-            
-            m = re.match(cr, line)
-            if m and offsets[i] != 0:
-                a = float(m.group(1))
-                a += ofst
-                rep = "{}{:0.3f}".format(axis, a)
-                rep = rep.rstrip("0").rstrip(".")
-                line = re.sub(rr, rep, line)
-
-        result.append(line)
-    return result
+    return Transform().translate(offsets).apply(parsed)
 
 
 def rotate2D(lines, anchor, angle):
+    return Transform().rotate(angle, anchor).apply(lines)
     
-    angle = math.radians(angle)
-    
-    result = []
-    _re_motion_mode = re.compile("(G[0123])([^\d]|$)")
-    _current_motion_mode = None
     
-    re_allcomments_remove = re.compile(";.*")
-    
-    words = ["X", "Y", "I", "J"]
-    contains_regexps = []
-    replace_regexps = []
-    for i in range(0, 3):
-        word = words[i]
-        contains_regexps.append(re.compile(".*" + word + "([-.\d]+)"))
-        replace_regexps.append(re.compile(r"" + word + "[-.\d]+"))
-    
-    x = 0
-    y = 0
-    for line in lines:
-        line = re.sub(re_allcomments_remove, "", line) # replace comments
-        
-        m = re.match(_re_motion_mode, line)
-        if m:
-            _current_motion_mode = m.group(1)
-        
-        match_x = re.match(contains_regexps[0], line)
-        if match_x:
-            x = float(match_x.group(1))
-            
-        match_y = re.match(contains_regexps[1], line)
-        if match_y:
-            y = float(match_y.group(1))
-        
-        rot_x = math.cos(angle) * (x-anchor[0]) - math.sin(angle) * (y-anchor[1]) + anchor[0]
-        rot_y = math.sin(angle) * (x-anchor[0]) + math.cos(angle) * (y-anchor[1]) + anchor[1]
-        
-        rep_x = "X{:0.3f}".format(rot_x)
-        rep_y = "Y{:0.3f}".format(rot_y)
-        
-        rep_x = rep_x.rstrip("0").rstrip(".")
-        rep_y = rep_y.rstrip("0").rstrip(".")
-        
-        line = re.sub(replace_regexps[0], rep_x, line)
-        line = re.sub(replace_regexps[1], rep_y, line)
 
-        if not match_x: line += rep_x
-        if not match_y: line += rep_y
+# returns list
+def scale_factor(lines, facts=[1, 1, 1], scale_zclear=False):
+    # a factor of 0 leaves the axis alone. Arcs in planes with differing
+    # factors are linearized by Transform.apply().
+    facts = [1 if f == 0 else f for f in facts]
+    skip_marker = None if scale_zclear else "_zclear"
+    return Transform().scale(facts).apply(lines, skip_marker)
 
-        result.append(line)
-    return result
+
+# returns list
+def bbox(gcode, cs_offsets=None, state=None):
+    '''
+    Returns the bounding box [[xmin, xmax], [ymin, ymax], [zmin, zmax]] of
+    all moves, including the extents of arcs. G91 moves are followed, and
+    if `cs_offsets` (a dict like {"G54": (x, y, z), ...}) is given, moves in
+    other coordinate systems (G54-G59) are converted into the coordinate
+    system active at the start of the program.
+    
+    The result is cached in the ParsedGcode, so pass one to compute the
+    bounding box only once for several operations.
     
+    @param state
+    The gcodeparser.ModalState before the first line (position and CS).
+    Only used if `gcode` is not parsed yet.
+    '''
+    parsed = gcodeparser.parse(gcode, state)
     
+    key = ("bbox", _offsets_key(cs_offsets))
+    if key not in parsed.cache:
+        mins, maxs = _bbox_extents(parsed, cs_offsets)
+        parsed.cache[key] = [[m, n] for m, n in zip(np.nan_to_num(mins).tolist(), np.nan_to_num(maxs).tolist())]
+    return [list(axis) for axis in parsed.cache[key]]
 
-# returns list
-def scale_factor(lines, facts=[1, 1, 1], scale_zclear=False):
-    result = []
+
+def stream_bbox(chunks, cs_offsets=None, state=None):
+    '''
+    Like bbox(), for a program given as an iterable of lists of lines. Only
+    one chunk is kept in memory at a time.
+    '''
+    state = state if state is not None else gcodeparser.ModalState()
+    reference_cs = state.cs
+    mins = np.full(3, np.nan)
+    maxs = np.full(3, np.nan)
+    for chunk in chunks:
+        parsed = gcodeparser.parse(chunk, state)
+        chunk_mins, chunk_maxs = _bbox_extents(parsed, cs_offsets, reference_cs)
+        mins = np.fmin(mins, chunk_mins)
+        maxs = np.fmax(maxs, chunk_maxs)
+        state = parsed.end_state()
+        if cs_offsets and len(parsed):
+            # the next chunk starts out in the last coordinate system, also
+            # on the axes not moved since switching to it
+            offsets = _offsets_array(cs_offsets)
+            shift = _axis_offsets(parsed, offsets)[-1] - offsets[CS_GCODES.index(state.cs)]
+            state.position = [float(v) for v in np.asarray(state.position) + shift]
+    return [[m, n] for m, n in zip(np.nan_to_num(mins).tolist(), np.nan_to_num(maxs).tolist())]
+
+
+def _bbox_extents(parsed, cs_offsets, reference_cs=None):
+    # returns arrays of minima and maxima, NaN for axes without moves
+    positions = parsed.positions()
+    arcs = parsed.arcs(positions)
+    points, inside = arcs.extremes()
     
-    logger = logging.getLogger('gerbil')
+    if cs_offsets:
+        if reference_cs is None:
+            reference_cs = parsed.state.cs
+        offsets = _offsets_array(cs_offsets)
+        shifts = _axis_offsets(parsed, offsets) - offsets[CS_GCODES.index(reference_cs)]
+        positions = positions + shifts
+        points = points + shifts[arcs.line][:, None, :]
     
-    if facts[0] != facts[1] or facts[0] != facts[2] or facts[1] != facts[2]:
-        logger.warning("gcodetools.scale_factor: Circles will stay circles even with inhomogeous scale factor ".format(facts))
-    
-    _re_motion_mode = re.compile("(G[0123])([^\d]|$)")
-    _current_motion_mode = None
-    
-    words = ["X", "Y", "Z", "I", "J", "K", "R"]
-    contains_regexps = []
-    replace_regexps = []
-    for i in range(0, 7):
-        word = words[i]
-        contains_regexps.append(re.compile(".*" + word + "([-.\d]+)"))
-        replace_regexps.append(re.compile(r"" + word + "[-.\d]+"))
-    
-    for line in lines:
-        for i in range(0, 7):
-            m = re.match(_re_motion_mode, line)
-            if m:
-                _current_motion_mode = m.group(1)
-            
-            word = words[i]
-            cr = contains_regexps[i]
-            rr = replace_regexps[i]
-            factor = facts[(i % 3)]
-            
-            m = re.match(cr, line)
-            if m and facts[i % 3] != 0 and not ("_zclear" in line and scale_zclear == False):
-                val = float(m.group(1))
-                val *= factor
-                rep = "{}{:0.3f}".format(word, val)
-                rep = rep.rstrip("0").rstrip(".")
-                line = re.sub(rr, rep, line)
-
-        result.append(line)
+    # an axis only counts from the line on where it is first mentioned,
+    # the initial position is unknown for programs
+    moves = (parsed.has("X") | parsed.has("Y") | parsed.has("Z")) & ~parsed.non_positional()
+    known = np.empty((len(parsed), 3), dtype=bool)
+    for i, axis in enumerate(["X", "Y", "Z"]):
+        known[:, i] = np.logical_or.accumulate(parsed.has(axis) & moves)
+    valid = known & moves[:, None]
+    arc_valid = inside[:, :, None] & known[arcs.line][:, None, :]
+    
+    mins = np.full(3, np.nan)
+    maxs = np.full(3, np.nan)
+    for i in range(0, 3):
+        values = np.concatenate([positions[valid[:, i], i], points[:, :, i][arc_valid[:, :, i]]])
+        if len(values) > 0:
+            mins[i] = values.min()
+            maxs[i] = values.max()
+    return mins, maxs
+
+
+def _offsets_array(cs_offsets):
+    # one row of offsets per entry of CS_GCODES
+    return np.array([cs_offsets.get("G{:g}".format(c), (0, 0, 0)) for c in CS_GCODES], dtype=np.float64)
+
+
+def _axis_offsets(parsed, offsets):
+    '''
+    Returns for each line and axis the offset of the coordinate system in
+    which the axis was last moved to, `offsets` having one row per entry of
+    CS_GCODES. grbl keeps the machine position of the axes which a move
+    leaves out, so when the coordinate system is switched, they keep the
+    offset of the old one until they are moved.
+    '''
+    cs = parsed.modal_gcode(CS_GCODES, parsed.state.cs)
+    line_offsets = offsets[np.searchsorted(CS_GCODES, cs)]
+    initial = offsets[CS_GCODES.index(parsed.state.cs)]
+    # relative moves go on from the machine position
+    absolute = ~parsed.non_positional() & (parsed.modal_gcode([90, 91], parsed.state.distance) == 90)
+    result = np.empty((len(parsed), 3), dtype=np.float64)
+    for i, axis in enumerate(["X", "Y", "Z"]):
+        moved = np.where(parsed.has(axis) & absolute, line_offsets[:, i], np.nan)
+        result[:, i] = gcodeparser.ffill(moved, initial[i])
     return result
 
 
-# returns list
-def bbox(gcode):
-    bb = []
+def _offsets_key(cs_offsets):
+    if not cs_offsets:
+        return None
+    return tuple(sorted((k, tuple(v)) for k, v in cs_offsets.items() if k in CS_NAMES))
+
+
+# number of points at which rapid moves are checked against the surface
+SURFACE_SAMPLES = 8
+
+def check_limits(gcode, max_travel, cs_offsets, state=None, surface=None, tolerance=0.001):
+    '''
+    Pre-flight check of a program against the work envelope of the machine,
+    like grbl's soft limits: machine coordinates range from -$130..-$132 to
+    0 after homing. Moves are converted into machine coordinates by the
+    offsets of their coordinate system (G54-G59), where axes which a move
+    leaves out keep their machine position, G53 targets are taken as
+    they are, and arcs are checked at their extreme points, not only at
+    their endpoints. Axes are only checked from the line on where they are
+    first mentioned, the position before is that of the machine.
+
+    If a probed heightmap.HeightMap is given as `surface`, rapid (G0) moves
+    are also checked against it, at SURFACE_SAMPLES points along each move.
+    The surface is in the coordinate system active at the start of the
+    program.
+
+    @param max_travel
+    The max travel of the X, Y and Z axes in mm (grbl settings $130-$132)
+
+    @param cs_offsets
+    A dict like {"G54": (x, y, z), ...}, as reported by grbl's $#
+
+    @param state
+    The gcodeparser.ModalState before the first line (position and CS).
+    Only used if `gcode` is not parsed yet.
+
+    @returns
+    A list of (line index, message) tuples, ordered by line
+    '''
+    parsed = gcodeparser.parse(gcode, state)
+    state = parsed.state
+    count = len(parsed)
+    positions = parsed.positions()
+    arcs = parsed.arcs(positions)
+    points, inside = arcs.extremes()
+
+    offsets = _offsets_array(cs_offsets)
+    line_offsets = _axis_offsets(parsed, offsets)
+    machine = positions + line_offsets
+
+    has = np.column_stack([parsed.has(axis) for axis in ["X", "Y", "Z"]])
+    moves = has.any(axis=1) & ~parsed.non_positional()
+    known = np.logical_or.accumulate(has & moves[:, None], axis=0)
+
+    # the lowest and highest machine coordinate each line reaches
+    low = np.where(known & moves[:, None], machine, np.nan)
+    high = low.copy()
+    if len(arcs):
+        arc_points = points + line_offsets[arcs.line][:, None, :]
+        arc_points[~(inside[:, :, None] & known[arcs.line][:, None, :])] = np.nan
+        low[arcs.line] = np.fmin(low[arcs.line], np.fmin.reduce(arc_points, axis=1))
+        high[arcs.line] = np.fmax(high[arcs.line], np.fmax.reduce(arc_points, axis=1))
+    machine_moves = parsed.has_gcode([53])
+    if machine_moves.any():
+        for i, axis in enumerate(["X", "Y", "Z"]):
+            target = machine_moves & has[:, i]
+            low[target, i] = high[target, i] = parsed.column(axis)[target]
+
+    max_travel = np.abs(np.asarray(max_travel, dtype=np.float64))
+    with np.errstate(invalid="ignore"):
+        below = low < -max_travel - tolerance
+        above = high > tolerance
+
+    problems = {}
+    for i, j in zip(*np.nonzero(below | above)):
+        i, j = int(i), int(j)
+        value = low[i, j] if below[i, j] else high[i, j]
+        problems.setdefault(i, []).append("{} {:0.3f} is outside of the travel -{:0.3f}..0".format("XYZ"[j], value, max_travel[j]))
+
+    if surface is not None:
+        motion = parsed.modal_gcode(gcodeparser.MOTION_GCODES, state.motion)
+        rapid = np.flatnonzero(moves & (motion == 0) & known.all(axis=1))
+        rapid = rapid[rapid > 0]
+        # in the coordinate system of the surface
+        work = machine - offsets[CS_GCODES.index(state.cs)]
+        start = work[rapid - 1]
+        end = work[rapid]
+        # retracting straight up out of the material is what rapids are for
+        retract = np.all(start[:, 0:2] == end[:, 0:2], axis=1) & (end[:, 2] >= start[:, 2])
+        rapid, start, end = rapid[~retract], start[~retract], end[~retract]
+        t = np.linspace(0, 1, SURFACE_SAMPLES + 1)[1:]
+        samples = start[:, None, :] + t[None, :, None] * (end - start)[:, None, :]
+        z = surface(samples[:, :, 0:2].reshape(-1, 2)).reshape(len(rapid), SURFACE_SAMPLES)
+        with np.errstate(invalid="ignore"):
+            depth = np.max(np.where(samples[:, :, 2] < z - tolerance, z - samples[:, :, 2], 0), axis=1, initial=0)
+        for i, d in zip(rapid.tolist(), depth.tolist()):
+            if d > 0:
+                problems.setdefault(i, []).append("Rapid move {:0.3f} below the probed surface".format(d))
+
+    return [(i, ", ".join(problems[i])) for i in sorted(problems)]
+
+
+def restart_preamble(state, current=None, z_safe=-1, plunge_feed=None, following=()):
+    '''
+    Returns the lines which bring the machine into the modal state before
+    the line at which a job is restarted: the tool is lifted in machine
+    coordinates, travels over the position, the spindle and coolant are
+    switched on, the tool is fed down to the position, and the distance
+    mode, motion mode and feed of the program are set. Words are only
+    emitted where the machine is not already in the state.
+
+    grbl sets the arc and probe motion modes (G2, G3, G38.x) only together
+    with a move. In these modes, the motion word is put in front of the
+    next line of the program which moves, and the lines up to it become
+    part of the preamble.
+
+    @param state
+    The gcodeparser.ModalState before the restart line, e.g. from
+    gcodeparser.Checkpoints.state_at()
+
+    @param current
+    The ModalState of the machine, or None if it is not known, then all
+    modes are set
+
+    @param z_safe
+    Machine Z coordinate in mm to which the tool is lifted
+
+    @param plunge_feed
+    Feed of the move down to the position, defaults to the feed of the
+    state if it is in units per minute (G94)
+
+    @param following
+    The lines of the program from the restart line on, as far as the
+    motion word may have to be carried
+
+    @returns
+    The lines of the preamble, and the number of lines of `following`
+    they include
+    '''
+    if current is None:
+        names = list(gcodeparser.ModalState.GCODE_GROUPS) + list(gcodeparser.ModalState.MCODE_GROUPS) + ["feed", "spindle"]
+        machine = gcodeparser.ModalState(**{name: None for name in names})
+    else:
+        machine = current.copy()
+
+    def modes(**target):
+        words = []
+        for name, value in target.items():
+            if getattr(machine, name) != value:
+                words.append("G{:g}".format(value))
+                setattr(machine, name, value)
+        return words
+
+    result = []
+    result.append(" ".join(modes(units=21) + ["G53 G0 Z" + gcodeparser.format_value(z_safe)]))
+    machine.motion = 0
+
+    words = modes(units=state.units, plane=state.plane, cs=state.cs, distance=90, feedmode=94)
+    x, y, z = state.position
+    axes = ["{}{}".format(axis, gcodeparser.format_value(v)) for axis, v in zip("XY", (x, y)) if not np.isnan(v)]
+    if axes:
+        words += ["G0"] + axes
+    if words:
+        result.append(" ".join(words))
+
+    words = []
+    if machine.spindle != state.spindle:
+        words.append("S" + gcodeparser.format_value(state.spindle))
+    for name in ["spindle_state", "coolant"]:
+        if getattr(machine, name) != getattr(state, name):
+            words.append("M{:g}".format(getattr(state, name)))
+    if words:
+        result.append(" ".join(words))
+
+    if plunge_feed is None and state.feedmode == 94 and state.feed:
+        plunge_feed = state.feed
+    if not np.isnan(z):
+        if plunge_feed:
+            result.append("G1 Z{} F{}".format(gcodeparser.format_value(z), gcodeparser.format_value(plunge_feed)))
+            machine.motion = 1
+            machine.feed = plunge_feed
+        else:
+            logging.getLogger('gerbil').warning("Restart: no feed for the move down to Z{}, the tool stays lifted".format(gcodeparser.format_value(z)))
+
+    settable = state.motion in (0, 1, 80)
+    words = modes(distance=state.distance, feedmode=state.feedmode)
+    if settable:
+        words = modes(motion=state.motion) + words
+    if machine.feed != state.feed:
+        words.append("F" + gcodeparser.format_value(state.feed))
+    if words:
+        result.append(" ".join(words))
+
+    consumed = 0
+    if not settable and machine.motion != state.motion:
+        parsed = gcodeparser.parse(following)
+        moves = parsed.has("X") | parsed.has("Y") | parsed.has("Z")
+        sets_motion = parsed.has_gcode(gcodeparser.MOTION_GCODES)
+        candidates = np.flatnonzero(moves | sets_motion)
+        if len(candidates) == 0:
+            logging.getLogger('gerbil').warning("Restart: motion mode G{:g} could not be set".format(state.motion))
+        elif not sets_motion[candidates[0]]:
+            consumed = int(candidates[0]) + 1
+            result += list(following[:consumed - 1])
+            result.append("G{:g} {}".format(state.motion, following[consumed - 1]))
+    return result, consumed
+
+
+
+def bumpify(gcode_list, cwpos, probe_points, probe_values, surface=None, tolerance=None, min_length=0.5):
+    '''
+    Adds the probed surface height to all Z coordinates.
     
-    axes = ["X", "Y", "Z"]
-    contains_regexps = []
+    The height map built from `probe_points` and `probe_values` is cached,
+    so bumpifying several jobs with the same probe data interpolates the
+    surface only once. Alternatively, pass a prebuilt heightmap.HeightMap
+    as `surface`.
     
-    for i in range(0, 3):
-        axis = axes[i]
-        contains_regexps.append(re.compile(".*" + axis + "([-.\d]+)"))
-        bb.append([9999, -9999])
-    
-    for line in gcode:
-        for i in range(0, 3):
-            axis = axes[i]
-            cr = contains_regexps[i]
-            m = re.match(cr, line)
-            if m:
-                a = float(m.group(1))
-                min = bb[i][0]
-                max = bb[i][1]
-                min = a if a < min else min
-                max = a if a > max else max
-                bb[i][0] = min
-                bb[i][1] = max
-    return bb
-
-
-
-def bumpify(gcode_list, cwpos, probe_points, probe_values):
+    By default only the endpoints are corrected, so the result has one
+    line per input line. When a `tolerance` is given, G1 moves along which
+    the surface deviates more than `tolerance` from the straight line
+    between the endpoints get intermediate points inserted, but no closer
+    than `min_length` to each other. This changes the number of lines.
+    '''
     print("bumpify start")
     logger = logging.getLogger('gerbil')
     
-    position = list(cwpos)
-
-    axes = ["X", "Y", "Z"]
-    re_allcomments_remove = re.compile(";.*")
-    re_axis_values = []
-    re_axis_replace = []
+    parsed = gcodeparser.parse(gcode_list)
     
-    # precompile regular expressions for speed increase
-    for i in range(0, 3):
-        axis = axes[i]
-        re_axis_values.append(re.compile(".*" + axis + "([-.\d]+)"))
-        re_axis_replace.append(re.compile(r"" + axis + "[-.\d]+"))
+    relative = parsed.has_gcode([91])
+    if relative.any():
+        line = parsed.lines[np.argmax(relative)]
+        logger.error("gcodetools.bumpify: G91 distance mode is not supported. Aborting at line {}".format(line))
+        return
+    
+    cs_switch = parsed.has_gcode(CS_GCODES)
+    if cs_switch.any():
+        line = parsed.lines[np.argmax(cs_switch)]
+        logger.error("gcodetools.bumpify: Switching coordinate systems is not supported. Aborting at line {}".format(line))
+        return
     
     # first, collect xy coords per line, because all of them will be interpolated at once
-    coords_xy = [None]*len(gcode_list)
-    for nr in range(0, len(gcode_list)):
-        line = gcode_list[nr]
-        line = re.sub(re_allcomments_remove, "", line) # replace comments
-        
-        if "G91" in line:
-            logger.error("gcodetools.bumpify: G91 distance mode is not supported. Aborting at line {}".format(line))
-            return
-        
-        if re.match("G(5[4-9]).*", line): 
-            logger.error("gcodetools.bumpify: Switching coordinate systems is not supported. Aborting at line {}".format(line))
-            return
-        
-        for i in range(0, 2): # only loop over x and y
-            axis = axes[i]
-            rv = re_axis_values[i]
-            m = re.match(rv, line)
-            if m:
-                a = float(m.group(1))
-                position[i] = a
-                
-        coords_xy[nr] = [position[0], position[1]]
-                
-    #print("parsed coords", coords_xy)
-                
+    coords_xy = np.column_stack([
+        gcodeparser.ffill(parsed.column("X"), cwpos[0]),
+        gcodeparser.ffill(parsed.column("Y"), cwpos[1])
+        ])
     
     print("bumpify interpol")
     
-    # I put this here to not make it a hard requirement
-    # it is difficult to install on Windows
-    from scipy.interpolate import griddata
-        
-    # see http://docs.scipy.org/doc/scipy/reference/generated/scipy.interpolate.griddata.html
-    interpolated_z = griddata(
-        probe_points,
-        probe_values,
-        coords_xy,
-        method='cubic')
+    if surface is None:
+        surface = heightmap.get(probe_points, probe_values)
     
-    z_at_xy_origin = griddata(
-        probe_points,
-        probe_values,
-        [0,0],
-        method='cubic')[0]
-    
-    #print("interpolated", interpolated_z)
+    interpolated_z = surface(coords_xy)
+    z_at_xy_origin = surface.z_at(0, 0)
+    if np.isnan(z_at_xy_origin):
+        logger.error("gcodetools.bumpify: The origin X0 Y0 is outside of the probed area. Aborting")
+        return
     
     # next add/substitute Z values
-    current_z = cwpos[2]
-    for nr in range(0, len(gcode_list)):
-        line = gcode_list[nr]
-        line = re.sub(re_allcomments_remove, "", line) # remove comments
-        
-        axis = axes[2]
-        rv = re_axis_values[2]
-        rr = re_axis_replace[2]
-        m = re.match(rv, line)
-        if m:
-            # contains Z, replace
-            current_z = float(m.group(1))
-            new_z = current_z + interpolated_z[nr] - z_at_xy_origin
-            rep = "{}{:0.3f}".format(axis, new_z)
-            rep = rep.rstrip("0").rstrip(".")
-            line = re.sub(rr, rep, line)
-        elif "X" in line or "Y" in line:
-            # add Z
-            new_z = current_z + interpolated_z[nr] - z_at_xy_origin
-            line += "{}{:0.3f}".format(axis, new_z)
-                    
-        gcode_list[nr] = line
-    
-    #print("FINI", gcode_list)
+    idx_z = np.nonzero(parsed.words("Z"))[0]
+    lines_z = parsed.word_line[idx_z]
+    
+    # nothing is extrapolated beyond the probed area, all lines which get
+    # a Z written must be inside of it
+    outside = np.isnan(interpolated_z) & (parsed.has("X") | parsed.has("Y") | parsed.has("Z"))
+    if outside.any():
+        i = int(np.argmax(outside))
+        logger.error("gcodetools.bumpify: X{} Y{} is outside of the probed area. Aborting at line {}".format(
+            *gcodeparser.format_values(coords_xy[i]), parsed.lines[i]))
+        return
+    
+    replace_values = parsed.word_value[idx_z] + interpolated_z[lines_z] - z_at_xy_origin
+    
+    # lines moving in XY without Z word get the current Z added
+    current_z = gcodeparser.ffill(parsed.column("Z"), cwpos[2])
+    add_z = np.nonzero((parsed.has("X") | parsed.has("Y")) & ~parsed.has("Z"))[0]
+    new_z = current_z[add_z] + interpolated_z[add_z] - z_at_xy_origin
+    append_text = ["Z" + gcodeparser.format_value(v) for v in new_z]
+    
+    result = parsed.render(idx_z, replace_values, add_z, append_text)
+    
+    if tolerance is not None:
+        result = _bumpify_subdivide(parsed, result, cwpos, coords_xy, current_z, surface, z_at_xy_origin, tolerance, min_length)
+    
     print("bumpify done")
-    return gcode_list
+    return result
 
 
+# words which may appear on a G1 line that is split into several moves
+_SUBDIVIDE_LETTERS = [ord(l) for l in "GXYZFSN"]
 
-"""
-Fonts available in hershedata.py:
-
-standard    Standard
-
-futural     Sans 1-stroke
-futuram     Sans bold
-
-gothiceng   Gothic English
-gothicger   Gothic German
-gothicita   Gothic Italian
-
-greek       Greek 1-stroke
-timesg      Greek medium
-japanese    Japanese
-cyrillic    Cyrillic
-
-astrology   Astrology
-markers     Markers
-mathlow     Math (lower)
-mathupp     Math (upper)
-meteorology Meteorology
-music       Music
-symbolic    Symbolic
-
-cursive     Script 1-stroke (alt)
-scriptc     Script medium
-scripts     Script 1-stroke
-
-timesi      Serif medium italic
-timesib     Serif bold italic
-timesr      Serif medium
-timesrb     Serif bold
-"""
+def _bumpify_subdivide(parsed, rendered, cwpos, coords_xy, current_z, surface, z_at_xy_origin, tolerance, min_length):
+    # only plain G1 moves in XY are split, anything else stays as it is
+    motion = parsed.modal_gcode(gcodeparser.MOTION_GCODES, parsed.state.motion)
+    other_word = ~np.isin(parsed.word_letter, _SUBDIVIDE_LETTERS) | (parsed.words("G") & (parsed.word_value != 1))
+    has_other = np.bincount(parsed.word_line[other_word], minlength=len(parsed)) > 0
+    candidates = np.flatnonzero((motion == 1) & (parsed.has("X") | parsed.has("Y")) & ~has_other)
+    if len(candidates) == 0:
+        return rendered
+    
+    start_xy = np.vstack((cwpos[0:2], coords_xy[:-1]))
+    start_z = np.concatenate(([cwpos[2]], current_z[:-1]))
+    seg, t, surface_z = surface.subdivide(start_xy[candidates], coords_xy[candidates], tolerance, min_length)
+    if len(seg) == 0:
+        return rendered
+    
+    line = candidates[seg]
+    xy = start_xy[line] + t[:, None] * (coords_xy[line] - start_xy[line])
+    z = start_z[line] + t * (current_z[line] - start_z[line]) + surface_z - z_at_xy_origin
+    
+    # the feed rate and laser power of the split line apply from its first new point on
+    first = np.ones(len(line), dtype=bool)
+    first[1:] = line[1:] != line[:-1]
+    feed = parsed.column("F")[line]
+    power = parsed.column("S")[line]
+    
+    xs = gcodeparser.format_values(xy[:, 0])
+    ys = gcodeparser.format_values(xy[:, 1])
+    zs = gcodeparser.format_values(z)
+    inserted = ["G1 X{} Y{} Z{}".format(*xyz) for xyz in zip(xs, ys, zs)]
+    for i in np.flatnonzero(first & (~np.isnan(feed) | ~np.isnan(power))):
+        if not np.isnan(feed[i]):
+            inserted[i] += " F" + gcodeparser.format_value(feed[i])
+        if not np.isnan(power[i]):
+            inserted[i] += " S" + gcodeparser.format_value(power[i])
+    
+    # new points go before the line they split, which then completes the move
+    all_lines = np.empty(len(rendered) + len(inserted), dtype=object)
+    all_lines[:len(rendered)] = rendered
+    all_lines[len(rendered):] = inserted
+    order = np.argsort(np.concatenate((np.arange(len(rendered)) * 2 + 1, line * 2)), kind="stable")
+    return all_lines[order].tolist()
 
-def hersheyToGcode(string, font='standard', z_depth=0, z_safe=3):
-    fontdata = eval('hersheydata.' + font)
+
+
+# M codes across which optimize_travel() does not move anything: program
+# stops and ends, spindle, tool and coolant changes
+TRAVEL_BARRIER_MCODES = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 30]
+
+# G codes of modal groups which optimize_travel() does not restore
+TRAVEL_BARRIER_GCODES = [17, 18, 19, 20, 21, 90, 91, 93, 94] + CS_GCODES
+
+# words which may appear on a G1 line of a segment that is to be reversed
+_REVERSIBLE_LETTERS = [ord(l) for l in "GXYZFSN"]
+
+def optimize_travel(gcode, reverse=True, two_opt_passes=2):
+    '''
+    Reorders the cutting segments of a program so that less time is spent
+    on rapid travel between them.
+    
+    The program is split into segments at its rapid (G0) moves. The
+    segments are ordered by nearest neighbour and 2-opt (see
+    travel.order_segments). With `reverse`, segments which are plain G1
+    polylines at a constant Z, with F and S set at most on their first
+    line, may also be run backwards.
+    
+    Before each segment, the tool is raised to the highest Z of the
+    original rapid moves, moved to the start of the segment and lowered
+    to where it originally started, and F and S are restored.
+    Program stops, spindle, tool and coolant changes, and switches of
+    units, plane, distance or feed mode and coordinate system are
+    barriers: segments are only reordered between them.
+    
+    @returns
+    Tuple (lines, report), report being a dict with the number of
+    "segments", how many were "reversed", and the rapid XY travel in mm
+    "travel_before" and "travel_after"
+    '''
+    logger = logging.getLogger('gerbil')
+    
+    parsed = gcodeparser.parse(gcode)
+    relative = parsed.has_gcode([91])
+    if relative.any():
+        line = parsed.lines[np.argmax(relative)]
+        logger.error("gcodetools.optimize_travel: G91 distance mode is not supported. Aborting at line {}".format(line))
+        return
+    
+    count = len(parsed)
+    lines = parsed.lines
+    positions = parsed.positions()
+    state = parsed.state
+    motion = parsed.modal_gcode(gcodeparser.MOTION_GCODES, state.motion)
+    non_positional = parsed.non_positional()
+    axes = np.column_stack([parsed.has(letter) for letter in "XYZ"])
+    moving = axes.any(axis=1) & ~non_positional
+    feed = gcodeparser.ffill(parsed.column("F"), state.feed)
+    power = gcodeparser.ffill(parsed.column("S"), state.spindle)
+    
+    barrier = parsed.has_gcode(TRAVEL_BARRIER_GCODES) | non_positional
+    mcodes = parsed.words("M") & np.isin(parsed.word_value, TRAVEL_BARRIER_MCODES)
+    barrier[parsed.word_line[mcodes | parsed.words("T")]] = True
+    rapid = moving & (motion == 0) & ~barrier
+    
+    rapid_z = rapid & parsed.has("Z")
+    z_safe = positions[rapid_z, 2].max() if rapid_z.any() else None
+    
+    # lines which can be part of a reversed segment
+    other_word = ~np.isin(parsed.word_letter, _REVERSIBLE_LETTERS) | (parsed.words("G") & (parsed.word_value != 1))
+    has_other = np.bincount(parsed.word_line[other_word], minlength=count) > 0
+    has_comment = np.bincount(parsed.comment_line, minlength=count) > 0
+    plain = moving & (motion == 1) & ~has_other & ~has_comment
+    sets_state = parsed.has("F") | parsed.has("S")
+    previous_z = np.concatenate(([state.position[2]], positions[:-1, 2]))
+    z_change = positions[:, 2] != previous_z
+    not_plain_sum = np.concatenate(([0], np.cumsum(~plain)))
+    sets_state_sum = np.concatenate(([0], np.cumsum(sets_state)))
+    z_change_sum = np.concatenate(([0], np.cumsum(z_change)))
+    
+    # runs of lines of the same kind: 0 rapid, 1 other, 2 barrier. Lines
+    # without moves (comments, blank lines ...) go with the run before them.
+    kind = np.where(barrier, 2, np.where(rapid, 0, 1)).astype(np.float64)
+    kind[~moving & ~barrier] = np.nan
+    kind = gcodeparser.ffill(kind, 1).astype(int)
+    run_starts = np.flatnonzero(np.concatenate(([True], kind[1:] != kind[:-1])))
+    run_ends = np.concatenate((run_starts[1:], [count])) - 1
+    run_kinds = kind[run_starts]
     
-    #regexp = re.compile("([ML].+?)")
+    # the position on an axis is only known once a move has set it
+    xy_known = np.logical_or.accumulate(axes[:, :2].any(axis=1) & moving)
     
-    letter_vals = [ord(q) - 32 for q in string]
+    def position_before(i):
+        return positions[i - 1] if i > 0 else np.asarray(state.position, dtype=np.float64)
     
-    gcodelist = []
-    offset_x = 0
+    def state_before(i):
+        return (feed[i - 1], power[i - 1]) if i > 0 else (state.feed, state.spindle)
     
-    for i in letter_vals:
-        # Ignore unavailable Letters except german umlaute
-        #if (q == 164 or q == 182 or q == 188 or q == 191 or q == 196 or q == 214 or q == 220 or 0 <= q < 93):
-        char_path = fontdata[i]
+    result = []
+    report = {"segments": 0, "reversed": 0}
+    run = 0
+    while run < len(run_starts):
+        if run_kinds[run] == 2:
+            result += lines[run_starts[run]:run_ends[run] + 1]
+            run += 1
+            continue
         
-        size_match = re.match('^([-0-9.]+) ([-0-9.]+)', char_path)
-        size1 = float(size_match.groups(0)[0])
-        size2 = float(size_match.groups(0)[1])
-        print("SIZE", size1, size2)
-            
+        # a block of runs up to the next barrier
+        block_end = run
+        while block_end < len(run_starts) and run_kinds[block_end] != 2:
+            block_end += 1
+        
+        # the head before the first rapid move stays where it is
+        if run_kinds[run] == 1:
+            result += lines[run_starts[run]:run_ends[run] + 1]
+            run += 1
         
-        offset_x -= size1
+        # rapid moves at the end of the block stay as well
+        tail = block_end
+        if tail > run and run_kinds[tail - 1] == 0:
+            tail -= 1
         
-        parts = re.findall('[ML][-0-9. ]+', char_path)
-        current_motion_mode = None
-        for cmd in parts:
-            gcode = ""
+        segments = [r for r in range(run, tail) if run_kinds[r] == 1]
+        if segments:
+            a = run_starts[segments]
+            b = run_ends[segments]
+            starts = np.array([position_before(i) for i in a.tolist()])
+            ends = positions[b]
+            reversible = np.zeros(len(a), dtype=bool)
+            if reverse:
+                reversible = ((not_plain_sum[b + 1] - not_plain_sum[a]) == 0) & \
+                             ((sets_state_sum[b + 1] - sets_state_sum[a + 1]) == 0) & \
+                             ((z_change_sum[b + 1] - z_change_sum[a]) == 0)
             
-            m = re.match('([ML]) ([-0-9.]+) ([-0-9.]+)', cmd)
-            print(m, m.groups(0))
-            mm = m.groups(0)[0]
-            x = float(m.groups(0)[1])
-            y = float(m.groups(0)[2])
+            current = position_before(run_starts[run]).copy()
+            current_state = state_before(run_starts[run])
+            order, flipped = travel.order_segments(starts[:, :2], ends[:, :2], reversible, current[:2], two_opt_passes)
+            # where the machine is before the first move is not known
+            unknown = run_starts[run] == 0 or not xy_known[run_starts[run] - 1]
             
-            if mm == "M":
-                if current_motion_mode != 0:
-                    if z_depth != 0:
-                        g_z_safe = "G0S0Z{}; z_safe".format(z_safe)
-                        gcodelist.append(g_z_safe)
-                    
-                    gcode += "G0S0"
-                current_motion_mode = 0
-                
-            else:
-                if current_motion_mode != 1:
-                    if z_depth != 0:
-                        g_plunge = "G1Z{}; plunge".format(z_depth)
-                        gcodelist.append(g_plunge)
-                    
-                    gcode += "G1S255"
-                current_motion_mode = 1
-                
-            mv_x = "X{:0.3f}".format(x + offset_x)
-            mv_x = mv_x.rstrip("0").rstrip(".")
-            gcode += mv_x
+            for k, flip in zip(order.tolist(), flipped.tolist()):
+                first, last = int(a[k]), int(b[k])
+                entry = ends[k] if flip else starts[k]
+                target_state = (feed[first], power[first]) if flip else state_before(first)
+                # comments between the rapid moves stay before the segment
+                comments = range(run_starts[segments[k] - 1], first)
+                result += [lines[i] for i in comments if not moving[i]]
+                result += _travel_lines(current, entry, current_state, target_state, z_safe, unknown)
+                unknown = False
+                if flip:
+                    points = np.vstack((starts[k:k + 1], positions[first:last]))[::-1]
+                    first_row = np.full(len(points), np.nan)
+                    first_row[0] = 1
+                    result += gcodewriter.serialize([
+                        ("G", first_row),
+                        ("X", points[:, 0]),
+                        ("Y", points[:, 1]),
+                        ("F", np.where(first_row == 1, feed[first], np.nan)),
+                        ("S", np.where(first_row == 1, power[first], np.nan)),
+                        ], drop_unchanged=False).splitlines()
+                else:
+                    result += lines[first:last + 1]
+                current = (starts[k] if flip else ends[k]).copy()
+                current_state = (feed[last], power[last])
+            report["segments"] += len(segments)
+            report["reversed"] += int(flipped.sum())
             
-            mv_y = "Y{:0.3f}".format(-y)
-            mv_y = mv_y.rstrip("0").rstrip(".")
-            gcode += mv_y
+            # the program continues in the original state, and from the
+            # original XY position on the axes which its next move leaves
+            # out. Z is only restored by rapids up to the safe height, the
+            # tool never rapids down towards the work.
+            segments_last = run_ends[tail - 1]
+            original_state = (feed[segments_last], power[segments_last])
+            original = positions[segments_last].copy()
+            following = np.flatnonzero(moving[segments_last + 1:])
+            given = axes[segments_last + 1 + following[0]] if len(following) else np.ones(3, dtype=bool)
+            original[:2][given[:2]] = current[:2][given[:2]]
+            raised = current[2]
+            if z_safe is not None and current[2] < z_safe - 1e-9 and \
+                    (abs(current[0] - original[0]) > 1e-9 or abs(current[1] - original[1]) > 1e-9):
+                raised = z_safe
+            if given[2] or z_safe is None or original[2] < z_safe - 1e-9:
+                original[2] = raised
+            result += _travel_lines(current, original, current_state, original_state, z_safe)
+        
+        for r in range(tail, block_end):
+            result += lines[run_starts[r]:run_ends[r] + 1]
+        run = block_end
+    
+    report["travel_before"] = rapid_length(parsed)
+    report["travel_after"] = rapid_length(result)
+    if report["travel_after"] >= report["travel_before"]:
+        # nothing gained, the program stays as it is
+        report["travel_after"] = report["travel_before"]
+        report["reversed"] = 0
+        result = list(lines)
+    return result, report
 
-            gcodelist.append(gcode)
-            
-        offset_x += size2
-    return gcodelist
+def rapid_length(gcode):
+    '''
+    Returns the total XY distance of the rapid (G0) moves of a program.
+    '''
+    parsed = gcodeparser.parse(gcode)
+    positions = parsed.positions()
+    previous = np.vstack(([parsed.state.position], positions[:-1]))
+    motion = parsed.modal_gcode(gcodeparser.MOTION_GCODES, parsed.state.motion)
+    rapid = (motion == 0) & (parsed.has("X") | parsed.has("Y")) & ~parsed.non_positional()
+    return float(np.sum(np.hypot(*(positions[rapid, :2] - previous[rapid, :2]).T)))
+
+def _travel_lines(current, target, current_state, target_state, z_safe, force=False):
+    # with `force`, the XY move is written even when it does not go
+    # anywhere from `current`
+    result = []
+    state = _state_words(current_state, target_state)
+    if force or abs(current[0] - target[0]) > 1e-9 or abs(current[1] - target[1]) > 1e-9:
+        if z_safe is not None and current[2] < z_safe - 1e-9:
+            result.append("G0 Z" + gcodeparser.format_value(z_safe))
+            current[2] = z_safe
+        line = "G0 X{} Y{}".format(*gcodeparser.format_values(target[:2]))
+        result.append(line + " " + state if state else line)
+    elif state:
+        result.append(state)
+    if abs(current[2] - target[2]) > 1e-9:
+        result.append("G0 Z" + gcodeparser.format_value(target[2]))
+    return result
+
+def _state_words(current_state, target_state):
+    words = []
+    for letter, current, target in zip("FS", current_state, target_state):
+        if not np.isnan(target) and current != target:
+            words.append(letter + gcodeparser.format_value(target))
+    return " ".join(words)
+
+
+def simplify(gcode, tolerance=0.01):
+    '''
+    Removes points of G1 polylines which deviate less than `tolerance`
+    from the simplified path, using the Douglas-Peucker algorithm on all
+    polylines of the program at once.
+    
+    Only points whose lines carry nothing but G1 and axis words are
+    removed. Changes of Z, F or S, other words and comments are kept, as
+    are the lines before and after them.
+    
+    @returns
+    Tuple (lines, report), report being a dict with the number of
+    "lines_removed" and "bytes_removed"
+    '''
+    logger = logging.getLogger('gerbil')
+    
+    parsed = gcodeparser.parse(gcode)
+    if parsed.has_gcode([91]).any():
+        logger.error("gcodetools.simplify: G91 distance mode is not supported.")
+        return
+    
+    chain, points, removable = _polyline_points(parsed)
+    
+    # the runs of removable points, between the points before and after them
+    edges = np.diff(np.concatenate(([0], removable.astype(np.int8), [0])))
+    lo = np.flatnonzero(edges == 1) - 1
+    hi = np.flatnonzero(edges == -1)
+    
+    keep = ~removable
+    while len(lo):
+        count = hi - lo - 1
+        offsets = np.concatenate(([0], np.cumsum(count)[:-1]))
+        interval = np.repeat(np.arange(len(lo)), count)
+        idx = lo[interval] + 1 + np.arange(len(interval)) - offsets[interval]
+        distance = _segment_distance(points[idx + 1], points[lo[interval] + 1], points[hi[interval] + 1])
+        
+        # the farthest point of each interval splits it, if it is too far
+        farthest = np.maximum.reduceat(distance, offsets)
+        split = farthest > tolerance
+        candidates = np.flatnonzero(split[interval] & (distance == farthest[interval]))
+        _, first = np.unique(interval[candidates], return_index=True)
+        k = idx[candidates[first]]
+        keep[k] = True
+        lo, hi = np.concatenate((lo[split], k)), np.concatenate((k, hi[split]))
+        wide = hi - lo > 1
+        lo, hi = lo[wide], hi[wide]
+    
+    removed = chain[~keep]
+    result = np.delete(np.array(parsed.lines, dtype=object), removed).tolist()
+    report = {
+        "lines_removed": len(removed),
+        "bytes_removed": int(np.sum(parsed.line_lengths[removed] + 1)),
+        }
+    return result, report
+
+# the largest radius of arcs created by fit_arcs()
+MAX_ARC_RADIUS = 10000
+
+def fit_arcs(gcode, tolerance=0.01, min_lines=3, precision=3):
+    '''
+    Replaces runs of G1 moves whose points lie on a circle by G2/G3 arcs
+    in I/J format.
+    
+    Runs are grown greedily along each polyline. A candidate arc goes
+    through the first, middle and last point of a run, and is accepted
+    only if all original points and the midpoints of all original
+    segments lie within `tolerance` of it, with the center rounded to
+    `precision` decimals as it will be written. The same lines as in
+    simplify() can be replaced, in the G17 plane only.
+    
+    @param min_lines
+    The minimal number of G1 lines an arc replaces
+    
+    @returns
+    Tuple (lines, report), report being a dict with the number of "arcs",
+    "lines_removed", "bytes_removed" and the "max_deviation" of an arc
+    from the original points and segments
+    '''
+    logger = logging.getLogger('gerbil')
+    
+    parsed = gcodeparser.parse(gcode)
+    if parsed.has_gcode([91]).any():
+        logger.error("gcodetools.fit_arcs: G91 distance mode is not supported.")
+        return
+    
+    chain, points, removable = _polyline_points(parsed)
+    # arcs are only possible in the XY plane, with F being a rate
+    arc_plane = (parsed.modal_gcode([17, 18, 19], parsed.state.plane) == 17) & \
+                (parsed.modal_gcode([93, 94], parsed.state.feedmode) == 94)
+    
+    edges = np.diff(np.concatenate(([0], removable.astype(np.int8), [0])))
+    run_lo = np.flatnonzero(edges == 1) - 1
+    run_hi = np.flatnonzero(edges == -1)
+    
+    arcs = []
+    max_deviation = 0.0
+    for lo, hi in zip(run_lo.tolist(), run_hi.tolist()):
+        # indices into points are one more than those into chain. Arcs can
+        # end on the removable points lo + 1 .. hi - 1 only.
+        a = lo
+        while a + min_lines <= hi - 1:
+            fit = None
+            step = min_lines
+            # grow the arc exponentially, then bisect its end
+            good, bad = None, None
+            while a + step <= hi - 1:
+                candidate = _fit_arc(points[a + 1:a + step + 2], tolerance, precision)
+                if candidate is None:
+                    bad = a + step
+                    break
+                good, fit = a + step, candidate
+                step *= 2
+            if good is None:
+                a += 1
+                continue
+            if bad is None:
+                bad = hi
+            while bad - good > 1:
+                middle = (good + bad) // 2
+                candidate = _fit_arc(points[a + 1:middle + 2], tolerance, precision)
+                if candidate is None:
+                    bad = middle
+                else:
+                    good, fit = middle, candidate
+            if arc_plane[chain[good]]:
+                arcs.append((a, good) + fit)
+                max_deviation = max(max_deviation, fit[-1])
+                a = good
+            else:
+                a += 1
+    
+    lines = np.array(parsed.lines, dtype=object)
+    removed = np.zeros(len(chain), dtype=bool)
+    ends = np.zeros(len(chain), dtype=bool)
+    if arcs:
+        a, b, clockwise, i, j, _ = [np.array(column) for column in zip(*arcs)]
+        for start, end in zip(a.tolist(), b.tolist()):
+            removed[start + 1:end] = True
+        ends[b] = True
+        x, y = points[b + 1, 0], points[b + 1, 1]
+        words = gcodeparser.format_values(np.concatenate((x, y, i, j)), precision)
+        n = len(b)
+        lines[chain[b]] = ["G{} X{} Y{} I{} J{}".format(2 if cw else 3, *w) for cw, w in
+                           zip(clockwise.tolist(), zip(words[:n], words[n:2 * n], words[2 * n:3 * n], words[3 * n:]))]
+        
+        # lines continuing with G1 after an arc need the motion word again
+        has_g1 = np.bincount(parsed.word_line[parsed.words("G") & (parsed.word_value == 1)], minlength=len(parsed)) > 0
+        after = b + 1
+        after = after[(after < len(chain))]
+        after = after[~removed[after] & ~ends[after]]
+        after = after[~has_g1[chain[after]]]
+        lines[chain[after]] = ["G1 " + line for line in lines[chain[after]].tolist()]
+    
+    result = np.delete(lines, chain[removed]).tolist()
+    report = {
+        "arcs": len(arcs),
+        "lines_removed": int(removed.sum()),
+        "bytes_removed": int(np.sum(parsed.line_lengths + 1) - sum(len(line) + 1 for line in result)),
+        "max_deviation": max_deviation,
+        }
+    return result, report
+
+def _fit_arc(points, tolerance, precision):
+    '''
+    Returns (clockwise, i, j, deviation) of the arc through the first,
+    middle and last of the points (n, 3), if all points and the midpoints
+    of the segments between them are within `tolerance` of it, or None.
+    '''
+    xy = points[:, :2]
+    if points[0, 2] != points[-1, 2]:
+        return
+    p0, p1, p2 = xy[0], xy[len(xy) // 2], xy[-1]
+    d = 2 * ((p1[0] - p0[0]) * (p2[1] - p0[1]) - (p1[1] - p0[1]) * (p2[0] - p0[0]))
+    if d == 0:
+        return
+    b = p1 - p0
+    c = p2 - p0
+    b2 = b.dot(b)
+    c2 = c.dot(c)
+    offset = np.array([c[1] * b2 - b[1] * c2, b[0] * c2 - c[0] * b2]) / d
+    # the center as written in the I and J words
+    offset = np.round(offset, precision)
+    center = p0 + offset
+    radius = math.hypot(*offset)
+    
+    # nearly straight runs are left to simplify()
+    if radius > MAX_ARC_RADIUS:
+        return
+    # the arc has to sweep monotonically in one direction, less than a
+    # full circle
+    r = xy - center
+    cross = r[:-1, 0] * r[1:, 1] - r[:-1, 1] * r[1:, 0]
+    dot = np.einsum("ij,ij->i", r[:-1], r[1:])
+    steps = np.arctan2(cross, dot)
+    clockwise = steps[0] < 0
+    if (np.any(steps >= 0) if clockwise else np.any(steps <= 0)) or abs(steps.sum()) >= 2 * math.pi - 1e-3:
+        return
+    
+    midpoints = (xy[:-1] + xy[1:]) / 2
+    deviation = max(
+        np.abs(np.hypot(*r.T) - radius).max(),
+        np.abs(np.hypot(*(midpoints - center).T) - radius).max())
+    if deviation > tolerance:
+        return
+    return bool(clockwise), offset[0], offset[1], float(deviation)
+
+def linearize_arcs(gcode, tolerance=0.01, precision=3, planes=(17, 18, 19)):
+    '''
+    Replaces all G2/G3 moves by G1 moves whose chords deviate at most
+    `tolerance` from the arcs. Helical arcs and all planes (G17, G18,
+    G19) are supported. The points of all arcs are computed at once.
+    
+    @param planes
+    Only the arcs in these planes are replaced
+    
+    Each arc line becomes the first G1 move of its arc and keeps its
+    other words in their order, so that they take effect before the arc
+    is run; the further moves are inserted after it. The moves give the
+    axes of the plane, and the linear axis only if the arc line does, so
+    that no move on an axis is added which the program does not make.
+    
+    @returns
+    Tuple (lines, source), source being an array telling for each of the
+    new lines the index of the line it was made from
+    '''
+    logger = logging.getLogger('gerbil')
+    
+    parsed = gcodeparser.parse(gcode)
+    if parsed.has_gcode([91]).any():
+        logger.error("gcodetools.linearize_arcs: G91 distance mode is not supported.")
+        return
+    
+    count = len(parsed)
+    arcs = parsed.arcs()
+    # the plane follows from the linear axis: Z for G17, Y for G18, X for G19
+    arc_planes = np.array([19, 18, 17])[arcs.axes[:, 2]]
+    arcs = arcs.select(np.isin(arc_planes, planes))
+    if len(arcs) == 0:
+        return list(parsed.lines), np.arange(count)
+    
+    # the angle of a chord whose distance to the arc is the tolerance
+    with np.errstate(divide="ignore", invalid="ignore"):
+        angle = 2 * np.arccos(np.clip(1 - tolerance / arcs.radius, -1, 1))
+    segments = np.maximum(np.ceil(np.abs(arcs.travel) / np.maximum(angle, 1e-9)), 1).astype(np.int64)
+    segments = np.where(np.isfinite(arcs.travel), segments, 1)
+    
+    # the end points of all segments, the last one being the arc's end
+    arc = np.repeat(np.arange(len(arcs)), segments)
+    offsets = np.concatenate(([0], np.cumsum(segments)[:-1]))
+    k = np.arange(len(arc)) - offsets[arc] + 1
+    fraction = k / segments[arc]
+    theta = arcs.start_angle[arc] + arcs.travel[arc] * fraction
+    rows = np.arange(len(arc))
+    axes = arcs.axes[arc]
+    points = arcs.start[arc] + (arcs.end[arc] - arcs.start[arc]) * fraction[:, None]
+    points[rows, axes[:, 0]] = arcs.center[arc, axes[:, 0]] + arcs.radius[arc] * np.cos(theta)
+    points[rows, axes[:, 1]] = arcs.center[arc, axes[:, 1]] + arcs.radius[arc] * np.sin(theta)
+    points[offsets + segments - 1] = arcs.end
+    
+    # the axes which the moves give
+    given = np.column_stack([parsed.has(axis) for axis in "XYZ"])[arcs.line]
+    arc_rows = np.arange(len(arcs))
+    given[arc_rows, arcs.axes[:, 0]] = True
+    given[arc_rows, arcs.axes[:, 1]] = True
+    
+    def moves(targets, axes):
+        words = gcodeparser.format_values(targets.reshape(-1), precision)
+        flags = axes.reshape(-1).tolist()
+        return ["G1 " + " ".join(letter + words[i + j] for j, letter in enumerate("XYZ") if flags[i + j])
+                for i in range(0, len(words), 3)]
+    
+    segment_moves = np.array(moves(points, given[arc]), dtype=object)
+    is_first = np.zeros(len(arc), dtype=bool)
+    is_first[offsets] = True
+    heads = segment_moves[is_first].tolist()
+    inserted = segment_moves[~is_first]
+    
+    # The arc lines become the first segments. The move takes the place of
+    # the first motion or axis word, the other words and comments stay in
+    # their order, so that e.g. units, coordinate system, spindle and feed
+    # are set before the segments run.
+    lines = np.array(parsed.lines, dtype=object)
+    dropped = np.isin(parsed.word_letter, [ord(l) for l in "XYZIJKR"]) | \
+              (parsed.words("G") & np.isin(parsed.word_value, gcodeparser.MOTION_GCODES))
+    is_arc = np.zeros(count, dtype=bool)
+    is_arc[arcs.line] = True
+    anchor = np.full(count, np.iinfo(np.int64).max)
+    on_arc = is_arc[parsed.word_line] & dropped
+    np.minimum.at(anchor, parsed.word_line[on_arc], parsed.word_start[on_arc])
+    kept = np.flatnonzero(is_arc[parsed.word_line] & ~dropped)
+    comments = np.flatnonzero(is_arc[parsed.comment_line])
+    texts = heads + \
+            [lines[l][a:b] for l, a, b in zip(parsed.word_line[kept].tolist(), parsed.word_start[kept].tolist(), parsed.word_end[kept].tolist())] + \
+            [lines[l][a:b] for l, a, b in zip(parsed.comment_line[comments].tolist(), parsed.comment_start[comments].tolist(), parsed.comment_end[comments].tolist())]
+    text_lines = np.concatenate((arcs.line, parsed.word_line[kept], parsed.comment_line[comments]))
+    text_starts = np.concatenate((anchor[arcs.line], parsed.word_start[kept], parsed.comment_start[comments]))
+    order = np.lexsort((text_starts, text_lines))
+    for line, group in itertools.groupby(zip(text_lines[order].tolist(), order.tolist()), key=lambda item: item[0]):
+        lines[line] = " ".join([texts[i] for _, i in group])
+    
+    # the other segments follow their arc lines
+    inserted_lines = arcs.line[arc[~is_first]]
+    all_lines = np.concatenate((lines, inserted))
+    source = np.concatenate((np.arange(count), inserted_lines))
+    order = np.argsort(np.concatenate((np.arange(count) * 2, inserted_lines * 2 + 1)), kind="stable")
+    return all_lines[order].tolist(), source[order]
+
+
+# words which may be on a line that simplify() and fit_arcs() remove
+_POLYLINE_LETTERS = [ord(l) for l in "GXYZN"]
+
+def _polyline_points(parsed):
+    '''
+    Returns the indices of the lines which contain words, their positions
+    with the initial position prepended, and a mask telling which of these
+    lines are G1 points that can be removed from a polyline without
+    changing anything but the geometry.
+    '''
+    count = len(parsed)
+    chain = np.flatnonzero(np.bincount(parsed.word_line, minlength=count) > 0)
+    positions = parsed.positions()
+    points = np.vstack(([parsed.state.position], positions[chain]))
+    
+    motion = parsed.modal_gcode(gcodeparser.MOTION_GCODES, parsed.state.motion)
+    has_x, has_y = parsed.has("X"), parsed.has("Y")
+    linear = (motion == 1) & (has_x | has_y | parsed.has("Z")) & ~parsed.non_positional()
+    other_word = ~np.isin(parsed.word_letter, _POLYLINE_LETTERS) | (parsed.words("G") & (parsed.word_value != 1))
+    plain = linear & (np.bincount(parsed.word_line[other_word], minlength=count) == 0) & \
+            (np.bincount(parsed.comment_line, minlength=count) == 0)
+    
+    plain, linear, full = plain[chain], linear[chain], (has_x & has_y)[chain]
+    previous_motion = np.concatenate(([parsed.state.motion], motion[chain][:-1]))
+    same_z = points[1:, 2] == points[:-1, 2]
+    # the following line must be part of the polyline and must not depend
+    # on the coordinates of the removed one
+    next_ok = np.concatenate((linear[1:] & full[1:], [False]))
+    removable = plain & (previous_motion == 1) & same_z & next_ok
+    return chain, points, removable
+
+def _segment_distance(p, a, b):
+    '''
+    Returns the distances of the points p to the line segments from a to b.
+    '''
+    ab = b - a
+    length2 = np.einsum("ij,ij->i", ab, ab)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = np.clip(np.einsum("ij,ij->i", p - a, ab) / length2, 0, 1)
+    t[length2 == 0] = 0
+    return np.linalg.norm(p - a - t[:, None] * ab, axis=1)
+
+
+# modal groups of G codes whose repetition minify() drops, besides motion
+MINIFY_MODAL_GROUPS = [[17, 18, 19], [20, 21], [90, 91], [93, 94], CS_GCODES]
+
+def minify(gcode, steps_per_mm=None, precision=3):
+    '''
+    Makes a program as short as possible without changing what it does.
+    
+    Comments and whitespace are stripped. G codes, F and S words that
+    repeat the modal state are dropped, and so are X, Y and Z words of
+    G0 and G1 moves which repeat the current position. Lines left
+    without words, e.g. moves which became zero-length, are removed.
+    Motion G codes are only written on the moves which need them.
+    Lines which are not plain words and comments, like system commands
+    or parameters, are kept as they are.
+    
+    @param steps_per_mm
+    The steps/mm of the X, Y and Z axes (grbl settings $100 to $102).
+    When given, coordinates of G0 and G1 moves are rounded to whole steps,
+    except where an arc starts. Note that this is done in work
+    coordinates, it is exact only when the offsets of the coordinate
+    system are whole steps as well.
+    
+    @returns
+    Tuple (lines, report), report being a dict with the number of
+    "lines_removed" and "bytes_removed"
+    '''
+    logger = logging.getLogger('gerbil')
+    
+    parsed = gcodeparser.parse(gcode)
+    if parsed.has_gcode([91]).any():
+        logger.error("gcodetools.minify: G91 distance mode is not supported.")
+        return
+    
+    count = len(parsed)
+    state = parsed.state
+    letter = parsed.word_letter
+    value = parsed.word_value.copy()
+    line = parsed.word_line
+    keep = np.ones(len(value), dtype=bool)
+    is_g = parsed.words("G")
+    
+    # Lines with anything which is not a word or a comment, like system
+    # commands ($H) or parameters (Z#1), are kept as they are. Nothing is
+    # known about the state after them.
+    verbatim = parsed.unparsed()
+    keep &= ~verbatim[line]
+    
+    def previous(values):
+        # the value in effect before each line, inf when it is not known
+        values = values.copy()
+        values[verbatim] = np.inf
+        return np.concatenate(([np.inf], gcodeparser.ffill(values)[:-1]))
+    
+    # repeated modal G codes. The state of the machine before the program
+    # is not known either, so the first word of each group is always kept.
+    for codes in MINIFY_MODAL_GROUPS:
+        before = previous(np.where(parsed.has_gcode(codes), parsed.modal_gcode(codes), np.nan))
+        in_group = is_g & np.isin(value, codes)
+        keep[in_group & (value == before[line])] = False
+    
+    # repeated F and S, except for F in inverse time mode
+    inverse_time = parsed.modal_gcode([93, 94], state.feedmode) == 93
+    for letter_ in "FS":
+        before = previous(parsed.column(letter_))
+        words = parsed.words(letter_)
+        redundant = words & (value == before[line])
+        if letter_ == "F":
+            redundant &= ~inverse_time[line]
+        keep[redundant] = False
+    
+    # coordinates are rounded to steps, and dropped from straight moves
+    # if they do not change. After moves and offsets in other coordinates
+    # (G28, G53, G92 ...) nothing is known about the position.
+    non_positional = parsed.non_positional()
+    motion = parsed.modal_gcode(gcodeparser.MOTION_GCODES, state.motion)
+    axis_words = np.isin(letter, [ord(l) for l in "XYZ"])
+    straight = np.isin(motion, [0, 1]) & ~non_positional
+    arc_lines = np.flatnonzero(np.isin(motion, [2, 3]) & ~non_positional)
+    for i, axis in enumerate("XYZ"):
+        words = parsed.words(axis) & ~non_positional[line]
+        if steps_per_mm is not None:
+            # The start and end points of arcs must stay on the circle
+            # their I, J, K or R describe, so neither arcs nor the
+            # coordinates they start from are rounded.
+            snap = words & straight[line]
+            word_at = np.full(count, np.nan)
+            word_at[line[words]] = np.flatnonzero(words)
+            start_words = np.concatenate(([np.nan], gcodeparser.ffill(word_at)[:-1]))[arc_lines]
+            snap[start_words[~np.isnan(start_words)].astype(np.int64)] = False
+            value[snap] = np.round(value[snap] * steps_per_mm[i]) / steps_per_mm[i]
+        known = np.full(count, np.nan)
+        known[line[words]] = value[words]
+        known[non_positional] = np.inf
+        before = previous(known)
+        keep[words & straight[line] & (np.round(value, precision) == np.round(before[line], precision))] = False
+    
+    # motion G codes go on the lines which still move, when they change
+    is_motion = is_g & np.isin(value, gcodeparser.MOTION_GCODES)
+    keep[is_motion] = False
+    moves = np.zeros(count, dtype=bool)
+    moves[line[keep & axis_words]] = True
+    moves &= ~non_positional
+    arc_words = np.isin(letter, [ord(l) for l in "IJKR"])
+    moves[line[arc_words]] |= ~straight[line[arc_words]]
+    moves &= ~verbatim
+    move_lines = np.flatnonzero(moves | verbatim)
+    move_motion = np.where(verbatim[move_lines], np.inf, motion[move_lines])
+    changed = moves[move_lines] & (move_motion != np.concatenate(([np.inf], move_motion[:-1])))
+    motion_lines = move_lines[changed]
+    motion_values = move_motion[changed]
+    
+    texts = np.concatenate((
+        [chr(c) for c in letter[keep].tolist()],
+        ["G"] * len(motion_lines),
+        ))
+    numbers = np.concatenate((value[keep], motion_values))
+    word_lines = np.concatenate((line[keep], motion_lines))
+    # motion words come first on their lines
+    order = np.argsort(np.concatenate((line[keep] * 2 + 1, motion_lines * 2)), kind="stable")
+    words = np.char.add(texts[order].astype(str), np.array(gcodeparser.format_values(numbers[order], precision), dtype=str))
+    word_lines = word_lines[order]
+    
+    result = np.full(count, "", dtype=object)
+    if len(words):
+        ends = np.concatenate((word_lines[1:] != word_lines[:-1], [True]))
+        joined = "".join(np.where(ends, np.char.add(words, "\n"), words).tolist()).split("\n")[:-1]
+        result[word_lines[ends]] = joined
+    result[verbatim] = [text.strip() for text in np.array(parsed.lines, dtype=object)[verbatim].tolist()]
+    result = [text for text in result.tolist() if text]
+    
+    report = {
+        "lines_removed": count - len(result),
+        "bytes_removed": int(np.sum(parsed.line_lengths + 1)) - sum(len(text) + 1 for text in result),
+        }
+    return result, report
+
+
+def hersheyToGcode(string, font='standard', z_depth=0, z_safe=3):
+    '''
+    Returns G-code lines which write `string` in a Hershey font (see
+    hershey.FONTS for the available fonts). Moves are done with S0 and
+    strokes with S255. With a `z_depth` other than 0, the tool is raised
+    to `z_safe` before moves and plunged to `z_depth` before strokes.
+    '''
+    points, pen_down, glyph_start = hershey.load(font).layout(string)
+    return _strokes_to_gcode(points, pen_down, glyph_start, z_depth, z_safe)
+
+def hersheyLayoutToGcode(text, font='standard', z_depth=0, z_safe=3, **kwargs):
+    '''
+    Like hersheyToGcode(), for multi-line, aligned, fitted, bent or
+    rotated text. See hershey.layout() for the keyword arguments.
+    '''
+    points, pen_down, glyph_start = hershey.layout(text, font, **kwargs)
+    return _strokes_to_gcode(points, pen_down, glyph_start, z_depth, z_safe)
+
+def hersheyPlateToGcode(template, records, font='standard', z_depth=0, z_safe=3, **kwargs):
+    '''
+    Returns a single job engraving one label per record, e.g. serial
+    number plates. See hershey.plate() for the keyword arguments.
+    '''
+    points, pen_down, glyph_start = hershey.plate(template, records, font=font, **kwargs)
+    return _strokes_to_gcode(points, pen_down, glyph_start, z_depth, z_safe)
+
+def _strokes_to_gcode(points, pen_down, glyph_start, z_depth, z_safe):
+    if len(points) == 0:
+        return []
+    
+    # motion mode and S are set at the start of every glyph and at every change
+    switch = glyph_start.copy()
+    switch[1:] |= pen_down[1:] != pen_down[:-1]
+    text = gcodewriter.serialize([
+        ("G", np.where(switch, pen_down, np.nan)),
+        ("S", np.where(switch, pen_down * 255, np.nan)),
+        ("X", points[:, 0]),
+        ("Y", points[:, 1]),
+        ], drop_unchanged=False, separator="")
+    gcodelist = text.split("\n")[:-1]
+    
+    if z_depth == 0:
+        return gcodelist
+    
+    # raise or plunge in front of every switch
+    idx = np.nonzero(switch)[0]
+    z_lines = ["G1Z{}; plunge".format(z_depth) if down else "G0S0Z{}; z_safe".format(z_safe) for down in pen_down[idx]]
+    all_lines = np.empty(len(gcodelist) + len(z_lines), dtype=object)
+    all_lines[:len(gcodelist)] = gcodelist
+    all_lines[len(gcodelist):] = z_lines
+    order = np.argsort(np.concatenate((np.arange(len(gcodelist)) * 2 + 1, idx * 2)), kind="stable")
+    return all_lines[order].tolist()
         
 
 
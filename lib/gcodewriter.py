@@ -0,0 +1,239 @@
+"""
+cnctoolbox - Copyright (c) 2016 Michael Franzl
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import io
+
+import numpy as np
+
+
+# Words whose values stay in effect until changed, so that repeating an
+# unchanged value can be dropped. This only holds for X/Y/Z in absolute
+# (G90) distance mode; for G91 programs pass modal="GFS".
+MODAL_LETTERS = "GXYZFS"
+
+# lines formatted at a time
+CHUNK_LINES = 1 << 20
+
+# numbers are formatted as integers of their digits, which must fit
+MAX_SCALED = 2 ** 63
+
+
+def serialize(columns, out=None, precision=3, drop_unchanged=True, modal=MODAL_LETTERS, initial=None, separator=" "):
+    '''
+    Turns columns of numbers into G-code text, one line per row.
+
+    All numbers are formatted at once into a byte matrix (digits, sign,
+    decimal point), from which the characters to keep are selected with a
+    mask, so there is no Python string handling per line or per number.
+    Numbers get at most `precision` decimals, without trailing zeros.
+
+    @param columns
+    Ordered list of (letter, values) tuples or a dict, e.g.
+    {"G": motion, "X": x, "Y": y, "S": power}. All arrays have one entry
+    per line, NaN means that the word is not on that line.
+
+    @param out
+    None to return the text as a string, a filename to write it to, or a
+    text or binary file object (file, io.StringIO, io.BytesIO ...)
+
+    @param drop_unchanged
+    Whether to leave out words of the letters in `modal` whose value is
+    the same as the previously emitted one. Lines without any words left
+    are dropped entirely.
+
+    @param initial
+    Dict of the values which are in effect before the first line, e.g.
+    {"S": 0}, so that they are not repeated
+
+    @param separator
+    Text between the words of a line, "" for the most compact output
+    '''
+    if isinstance(columns, dict):
+        columns = list(columns.items())
+    letters = [c[0] for c in columns]
+    values = [np.asarray(c[1], dtype=np.float64).reshape(-1) for c in columns]
+    count = max([len(v) for v in values]) if values else 0
+    values = [np.broadcast_to(v, (count,)) if len(v) == 1 else v for v in values]
+
+    emit = []
+    for letter, vals in zip(letters, values):
+        present = ~np.isnan(vals)
+        if drop_unchanged and letter in modal:
+            previous = np.nan if initial is None else initial.get(letter, np.nan)
+            present &= _changed(np.round(vals, precision), round(previous, precision))
+        emit.append(present)
+
+    if out is None:
+        buffer = io.BytesIO()
+        _write_chunks(buffer, letters, values, emit, precision, separator)
+        return buffer.getvalue().decode("ascii")
+
+    if isinstance(out, str):
+        with open(out, "wb") as f:
+            _write_chunks(f, letters, values, emit, precision, separator)
+        return
+
+    if isinstance(out, io.TextIOBase):
+        for chunk in _format_chunks(letters, values, emit, precision, separator):
+            out.write(chunk.decode("ascii"))
+    else:
+        _write_chunks(out, letters, values, emit, precision, separator)
+
+
+def format_numbers(values, precision=3):
+    '''
+    Returns the numbers formatted with at most `precision` decimals and
+    without trailing zeros, as a list of strings.
+    '''
+    values = np.asarray(values, dtype=np.float64).reshape(-1)
+    if len(values) == 0:
+        return []
+    chars, keep = _number_matrix(values, precision)
+    chars = np.column_stack((chars, np.full(len(values), ord("\n"), dtype=np.uint8)))
+    keep = np.column_stack((keep, np.ones(len(values), dtype=bool)))
+    return chars[keep].tobytes().decode("ascii").split("\n")[:-1]
+
+
+def _changed(values, previous):
+    # whether each present value differs from the last present one before it
+    present = ~np.isnan(values)
+    idx = np.where(present, np.arange(len(values)), -1)
+    np.maximum.accumulate(idx, out=idx)
+    before = np.full(len(values), previous, dtype=np.float64)
+    before[1:] = np.where(idx[:-1] >= 0, values[np.maximum(idx[:-1], 0)], previous)
+    return present & (values != before)
+
+
+def _write_chunks(f, letters, values, emit, precision, separator):
+    for chunk in _format_chunks(letters, values, emit, precision, separator):
+        f.write(chunk)
+
+
+def _format_chunks(letters, values, emit, precision, separator):
+    count = len(values[0]) if values else 0
+    for start in range(0, count, CHUNK_LINES):
+        stop = min(start + CHUNK_LINES, count)
+        yield _format_block(
+            letters,
+            [v[start:stop] for v in values],
+            [e[start:stop] for e in emit],
+            precision, separator)
+
+
+def _format_block(letters, values, emit, precision, separator):
+    count = len(values[0])
+    sep = np.frombuffer(separator.encode("ascii"), dtype=np.uint8)
+    words_before = np.zeros(count, dtype=bool)
+
+    blocks = []
+    masks = []
+    for letter, vals, em in zip(letters, values, emit):
+        chars = np.zeros((count, len(sep) + 1), dtype=np.uint8)
+        keep = np.zeros((count, len(sep) + 1), dtype=bool)
+        chars[:, :len(sep)] = sep
+        keep[:, :len(sep)] = (em & words_before)[:, None]
+        chars[:, len(sep)] = ord(letter)
+        keep[:, len(sep)] = em
+        blocks.append(chars)
+        masks.append(keep)
+
+        number_chars = np.zeros((count, 0), dtype=np.uint8)
+        number_keep = np.zeros((count, 0), dtype=bool)
+        idx = np.nonzero(em)[0]
+        if len(idx):
+            c, k = _number_matrix(vals[idx], precision)
+            number_chars = np.zeros((count, c.shape[1]), dtype=np.uint8)
+            number_keep = np.zeros((count, c.shape[1]), dtype=bool)
+            number_chars[idx] = c
+            number_keep[idx] = k
+        blocks.append(number_chars)
+        masks.append(number_keep)
+        words_before |= em
+
+    blocks.append(np.full((count, 1), ord("\n"), dtype=np.uint8))
+    masks.append(words_before[:, None])
+
+    chars = np.hstack(blocks)
+    keep = np.hstack(masks)
+    return chars[keep].tobytes()
+
+
+def _number_matrix(values, precision):
+    '''
+    Returns a matrix of ASCII characters with one row per number
+    (sign, integer digits, decimal point, decimals) and a mask of the
+    characters which make up the compact representation.
+    '''
+    finite = np.isfinite(values)
+    if not finite.all():
+        raise ValueError("gcodewriter: Cannot format {} as a G-code number".format(values[~finite][0]))
+
+    scale = 10 ** precision
+    magnitude = np.abs(values) * scale
+    scaled = np.floor(magnitude + 0.5)
+    # "%.3f" rounds the exact binary value, which the product above only
+    # approximates. Numbers close to a tie, or too large for the product
+    # to have a fraction, are rounded by Python instead.
+    close = (np.abs(magnitude - np.floor(magnitude) - 0.5) < 1e-6) | (magnitude >= 2 ** 51)
+    for i in np.flatnonzero(close).tolist():
+        scaled[i] = float("{:.{}f}".format(abs(values[i]), precision).replace(".", ""))
+    negative = (values < 0) & (scaled != 0)
+    largest = int(scaled.max())
+    if largest >= MAX_SCALED:
+        raise ValueError("gcodewriter: Cannot format {} with {} decimals".format(values[np.argmax(scaled)], precision))
+    scaled = scaled.astype(np.uint32 if largest < 2 ** 32 else np.uint64)
+
+    int_digits = max(len(str(largest)) - precision, 1)
+    digit_count = int_digits + precision
+    width = 1 + digit_count + 1
+    chars = np.empty((len(values), width), dtype=np.uint8)
+    keep = np.zeros((len(values), width), dtype=bool)
+
+    chars[:, 0] = ord("-")
+    keep[:, 0] = negative
+
+    # all digits, from the last one to the first, into columns
+    # 1 .. int_digits and int_digits + 2 ..
+    columns = list(range(1, 1 + int_digits)) + list(range(2 + int_digits, width))
+    rest = scaled
+    for column in reversed(columns):
+        rest, digit = np.divmod(rest, 10)
+        chars[:, column] = digit
+    chars[:, 1:] += ord("0")
+
+    # leading zeros are dropped, but one integer digit is always kept
+    integer = scaled // scale
+    powers = 10 ** np.arange(1, int_digits, dtype=np.uint64)
+    used_digits = np.searchsorted(powers, integer, side="right") + 1
+    keep[:, 1:1 + int_digits] = np.arange(int_digits) >= (int_digits - used_digits)[:, None]
+
+    if precision > 0:
+        # decimals up to the last non-zero one
+        fraction = scaled % scale
+        significant = np.full(len(values), precision)
+        for i in range(1, precision + 1):
+            significant[fraction % (10 ** i) == 0] = precision - i
+        chars[:, 1 + int_digits] = ord(".")
+        keep[:, 1 + int_digits] = significant > 0
+        keep[:, 2 + int_digits:] = np.arange(precision) < significant[:, None]
+
+    return chars, keep
@@ -0,0 +1,237 @@
+"""
+cnctoolbox - Copyright (c) 2016 Michael Franzl
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import math
+import hashlib
+import collections
+
+import numpy as np
+
+
+class HeightMap:
+    '''
+    Surface interpolated from probe points, built once and evaluated many
+    times.
+
+    The probe points are triangulated once and the piecewise cubic
+    (Clough-Tocher) surface, the same one scipy's griddata(method='cubic')
+    computes, is kept. For fast evaluation it is additionally resampled
+    onto a regular grid, which is then interpolated bilinearly.
+    Positions outside of the convex hull of the probe points evaluate to
+    `fill_value`.
+    '''
+
+    # the resampled grid never gets more nodes than this
+    MAX_GRID_NODES = 4000000
+
+    def __init__(self, probe_points, probe_values, resolution=1.0, method="bilinear"):
+        '''
+        @param probe_points
+        List or array of XY probe coordinates
+
+        @param probe_values
+        Probed Z value for each of the probe points
+
+        @param resolution
+        Grid spacing in mm for the resampled surface
+
+        @param method
+        "bilinear" evaluates the resampled grid, "cubic" evaluates the
+        triangulated surface exactly
+        '''
+        # I put this here to not make it a hard requirement
+        # it is difficult to install on Windows
+        from scipy.interpolate import CloughTocher2DInterpolator
+
+        self.probe_points = np.asarray(probe_points, dtype=np.float64)
+        self.probe_values = np.asarray(probe_values, dtype=np.float64)
+        self.method = method
+        self.interpolator = CloughTocher2DInterpolator(self.probe_points, self.probe_values)
+
+        self.llc = self.probe_points.min(axis=0)
+        urc = self.probe_points.max(axis=0)
+        extent = np.maximum(urc - self.llc, 1e-9)
+        nodes = np.prod(extent / resolution + 1)
+        if nodes > self.MAX_GRID_NODES:
+            resolution *= math.sqrt(nodes / self.MAX_GRID_NODES)
+        self.resolution = resolution
+        self.dim = (np.floor(extent / resolution).astype(int) + 2)
+
+        xs = self.llc[0] + np.arange(self.dim[0]) * resolution
+        ys = self.llc[1] + np.arange(self.dim[1]) * resolution
+        grid_x, grid_y = np.meshgrid(xs, ys, indexing="ij")
+        self.grid = self.interpolator(grid_x, grid_y)
+
+
+    def __call__(self, xy, fill_value=np.nan, unique=True):
+        '''
+        Returns the interpolated Z for an array of XY positions of shape
+        (n, 2). Every distinct position is evaluated only once, unless
+        `unique` is False, e.g. because the positions are known to be
+        distinct anyway.
+        '''
+        xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+        if len(xy) == 0:
+            return np.zeros(0)
+
+        if unique:
+            # viewed as complex numbers, XY pairs sort and compare as one
+            # value, which is much faster than np.unique(axis=0)
+            keys = np.ascontiguousarray(xy).view(np.complex128).ravel()
+            unique_keys, inverse = np.unique(keys, return_inverse=True)
+            unique_xy = np.column_stack((unique_keys.real, unique_keys.imag))
+            z = self._evaluate(unique_xy)[inverse.reshape(-1)]
+        else:
+            z = self._evaluate(xy)
+        z[np.isnan(z)] = fill_value
+        return z
+
+
+    def z_at(self, x, y):
+        return float(self([[x, y]])[0])
+
+
+    def subdivide(self, start_xy, end_xy, tolerance=0.02, min_length=0.5):
+        '''
+        Finds the points at which straight XY segments have to be split so
+        that the linearly interpolated surface height between consecutive
+        points deviates no more than `tolerance` from the surface.
+
+        Intervals are bisected level by level, each level evaluating the
+        surface at three inner points of all intervals at once. Intervals
+        shorter than 2 * `min_length` are not split any further.
+
+        @param start_xy
+        Array of shape (n, 2) with the segment start points
+
+        @param end_xy
+        Array of shape (n, 2) with the segment end points
+
+        @returns
+        Tuple (segment, t, z), sorted by segment and t, of the index of the
+        segment each new point belongs to, its fraction of the way from
+        start to end, and the surface height at it
+        '''
+        start_xy = np.asarray(start_xy, dtype=np.float64).reshape(-1, 2)
+        end_xy = np.asarray(end_xy, dtype=np.float64).reshape(-1, 2)
+        delta = end_xy - start_xy
+        lengths = np.hypot(delta[:, 0], delta[:, 1])
+        fractions = np.array([0.25, 0.5, 0.75])
+
+        seg = np.flatnonzero(lengths >= 2 * min_length)
+        t0 = np.zeros(len(seg))
+        t1 = np.ones(len(seg))
+        z0 = self(start_xy[seg])
+        z1 = self(end_xy[seg])
+
+        result_seg = []
+        result_t = []
+        result_z = []
+        while len(seg):
+            ts = t0[:, None] + (t1 - t0)[:, None] * fractions
+            points = start_xy[seg][:, None, :] + ts[:, :, None] * delta[seg][:, None, :]
+            zs = self(points.reshape(-1, 2), unique=False).reshape(-1, 3)
+            chord = z0[:, None] + (z1 - z0)[:, None] * fractions
+            # positions off the probed area are NaN and never split
+            deviation = np.abs(zs - chord)
+            split = np.any(deviation > tolerance, axis=1)
+
+            seg, t0, t1, z0, z1 = seg[split], t0[split], t1[split], z0[split], z1[split]
+            t_mid = ts[split, 1]
+            z_mid = zs[split, 1]
+            result_seg.append(seg)
+            result_t.append(t_mid)
+            result_z.append(z_mid)
+
+            # both halves continue, if they are still long enough
+            seg = np.concatenate((seg, seg))
+            t0, t1 = np.concatenate((t0, t_mid)), np.concatenate((t_mid, t1))
+            z0, z1 = np.concatenate((z0, z_mid)), np.concatenate((z_mid, z1))
+            longer = (t1 - t0) * lengths[seg] >= 2 * min_length
+            seg, t0, t1, z0, z1 = seg[longer], t0[longer], t1[longer], z0[longer], z1[longer]
+
+        if not result_seg:
+            return np.zeros(0, dtype=int), np.zeros(0), np.zeros(0)
+        seg = np.concatenate(result_seg)
+        t = np.concatenate(result_t)
+        z = np.concatenate(result_z)
+        order = np.lexsort((t, seg))
+        return seg[order], t[order], z[order]
+
+
+    def _evaluate(self, xy):
+        if self.method == "cubic":
+            return self.interpolator(xy)
+        return self._bilinear(xy)
+
+
+    def _bilinear(self, xy):
+        gx = (xy[:, 0] - self.llc[0]) / self.resolution
+        gy = (xy[:, 1] - self.llc[1]) / self.resolution
+        ix = np.clip(np.floor(gx).astype(int), 0, self.dim[0] - 2)
+        iy = np.clip(np.floor(gy).astype(int), 0, self.dim[1] - 2)
+        fx = gx - ix
+        fy = gy - iy
+
+        g = self.grid
+        z = (g[ix, iy] * (1 - fx) * (1 - fy) +
+             g[ix + 1, iy] * fx * (1 - fy) +
+             g[ix, iy + 1] * (1 - fx) * fy +
+             g[ix + 1, iy + 1] * fx * fy)
+
+        # like griddata, nothing is extrapolated
+        outside = (gx < 0) | (gy < 0) | (gx > self.dim[0] - 1) | (gy > self.dim[1] - 1)
+        z[outside] = np.nan
+
+        # grid nodes off the probed area are NaN, so cells at its edge
+        # are evaluated exactly
+        edge = np.isnan(z) & ~outside
+        if edge.any():
+            z[edge] = self.interpolator(xy[edge])
+        return z
+
+
+# Recently used height maps, so that re-bumpifying with the same probe
+# data does not triangulate and resample again.
+_cache = collections.OrderedDict()
+_cache_size = 8
+
+def get(probe_points, probe_values, resolution=1.0, method="bilinear"):
+    '''
+    Returns a HeightMap for the probe data, reusing a previously built one
+    for identical data.
+    '''
+    points = np.ascontiguousarray(probe_points, dtype=np.float64)
+    values = np.ascontiguousarray(probe_values, dtype=np.float64)
+    h = hashlib.sha1(points.tobytes())
+    h.update(values.tobytes())
+    key = (h.hexdigest(), resolution, method)
+
+    if key in _cache:
+        _cache.move_to_end(key)
+        return _cache[key]
+
+    heightmap = HeightMap(points, values, resolution, method)
+    _cache[key] = heightmap
+    if len(_cache) > _cache_size:
+        _cache.popitem(last=False)
+    return heightmap
@@ -0,0 +1,376 @@
+"""
+cnctoolbox - Copyright (c) 2016 Michael Franzl
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+"""
+Fonts available in hershedata.py:
+
+standard    Standard
+
+futural     Sans 1-stroke
+futuram     Sans bold
+
+gothiceng   Gothic English
+gothicger   Gothic German
+gothicita   Gothic Italian
+
+greek       Greek 1-stroke
+timesg      Greek medium
+japanese    Japanese
+cyrillic    Cyrillic
+
+astrology   Astrology
+markers     Markers
+mathlow     Math (lower)
+mathupp     Math (upper)
+meteorology Meteorology
+music       Music
+symbolic    Symbolic
+
+cursive     Script 1-stroke (alt)
+scriptc     Script medium
+scripts     Script 1-stroke
+
+timesi      Serif medium italic
+timesib     Serif bold italic
+timesr      Serif medium
+timesrb     Serif bold
+"""
+
+import os
+import re
+import csv
+import math
+import logging
+import functools
+
+import numpy as np
+
+
+FONTS = ["standard", "futural", "futuram", "gothiceng", "gothicger",
+         "gothicita", "greek", "timesg", "japanese", "cyrillic", "astrology",
+         "markers", "mathlow", "mathupp", "meteorology", "music", "symbolic",
+         "cursive", "scriptc", "scripts", "timesi", "timesib", "timesr",
+         "timesrb"]
+
+# compiled fonts are kept here, one .npz file per font
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "gerbil_gui", "hershey")
+
+_re_glyph_token = re.compile(r"[ML]|[-+]?[0-9.]+")
+
+# fonts which have been loaded in this session
+_fonts = {}
+
+
+class Font:
+    '''
+    A Hershey font compiled into arrays.
+
+    The points of all glyphs are stored one after the other in `points`,
+    glyph i being points[starts[i]:starts[i + 1]]. `pen_down` tells for
+    every point whether it is reached by drawing (L) or by moving (M).
+    `sizes` holds the left and right extents of every glyph.
+    '''
+
+    def __init__(self, name, points, pen_down, starts, sizes):
+        self.name = name
+        self.points = points
+        self.pen_down = pen_down
+        self.starts = starts
+        self.sizes = sizes
+
+        # the fonts use different units, so their metrics are taken from H
+        reference, _ = self.glyph(ord("H") - 32) if len(sizes) > ord("H") - 32 else (points, None)
+        if len(reference) == 0:
+            reference = points
+        self.cap_top = float(reference[:, 1].min()) if len(reference) else 0.0
+        self.baseline = float(reference[:, 1].max()) if len(reference) else 0.0
+        self.cap_height = (self.baseline - self.cap_top) or 1.0
+
+
+    def __len__(self):
+        return len(self.sizes)
+
+
+    def glyph(self, i):
+        '''
+        Returns the points (shape (n, 2)) and pen states of glyph i.
+        '''
+        return (self.points[self.starts[i]:self.starts[i + 1]],
+                self.pen_down[self.starts[i]:self.starts[i + 1]])
+
+
+    def width(self, string):
+        '''
+        Returns the advance width of `string` in font units.
+        '''
+        glyphs = np.array([ord(c) - 32 for c in string], dtype=np.int64)
+        glyphs = glyphs[(glyphs >= 0) & (glyphs < len(self))]
+        return float(np.sum(self.sizes[glyphs, 1] - self.sizes[glyphs, 0]))
+
+
+    def layout(self, string):
+        '''
+        Returns the points and pen states of all glyphs of `string` set one
+        after the other, with the glyph origins on the baseline at Y=0 and
+        Y pointing upwards, and a mask of the first point of every glyph.
+        Characters not in the font are skipped.
+        '''
+        glyphs = np.array([ord(c) - 32 for c in string], dtype=np.int64)
+        available = (glyphs >= 0) & (glyphs < len(self))
+        if not available.all():
+            logging.getLogger('gerbil').warning("hershey: Font {} has no glyphs for some characters of '{}'".format(self.name, string))
+            glyphs = glyphs[available]
+        if len(glyphs) == 0:
+            return np.zeros((0, 2)), np.zeros(0, dtype=bool), np.zeros(0, dtype=bool)
+
+        # each glyph starts where the previous one ended, minus its own left extent
+        lefts = self.sizes[glyphs, 0]
+        rights = self.sizes[glyphs, 1]
+        advance = np.cumsum(rights - lefts)
+        origins = np.concatenate(([0], advance[:-1])) - lefts
+
+        counts = self.starts[glyphs + 1] - self.starts[glyphs]
+        idx = np.repeat(self.starts[glyphs] - np.concatenate(([0], np.cumsum(counts)[:-1])), counts) + np.arange(counts.sum())
+        points = self.points[idx].copy()
+        points[:, 0] += np.repeat(origins, counts)
+        points[:, 1] *= -1
+        first = np.zeros(len(idx), dtype=bool)
+        first[(np.cumsum(counts) - counts)[counts > 0]] = True
+        return points, self.pen_down[idx], first
+
+
+def load(name):
+    '''
+    Returns the compiled Font of the given name.
+
+    Fonts are compiled from hersheydata on first use and written to the
+    on-disk cache, from which later sessions load them directly.
+    '''
+    if name in _fonts:
+        return _fonts[name]
+    if name not in FONTS:
+        raise ValueError("hershey: Unknown font {}".format(name))
+
+    cache_file = os.path.join(CACHE_DIR, name + ".npz")
+    source_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "hersheydata.py")
+    result = None
+    if os.path.exists(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(source_file):
+        try:
+            with np.load(cache_file) as data:
+                result = Font(name, data["points"], data["pen_down"], data["starts"], data["sizes"])
+        except (OSError, KeyError, ValueError):
+            result = None
+
+    if result is None:
+        result = _compile(name)
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            np.savez(cache_file, points=result.points, pen_down=result.pen_down, starts=result.starts, sizes=result.sizes)
+        except OSError as e:
+            logging.getLogger('gerbil').warning("hershey: Could not write font cache {}: {}".format(cache_file, e))
+
+    _fonts[name] = result
+    return result
+
+
+def _compile(name):
+    # the font data is big, it is only imported when a font is not cached
+    from . import hersheydata
+    glyphs = getattr(hersheydata, name)
+
+    points = []
+    pen_down = []
+    starts = [0]
+    sizes = []
+    for glyph in glyphs:
+        tokens = _re_glyph_token.findall(glyph)
+        if len(tokens) < 2:
+            # some fonts have empty placeholder glyphs
+            tokens = ["0", "0"]
+        sizes.append([_to_float(tokens[0]), _to_float(tokens[1])])
+        i = 2
+        while i + 2 < len(tokens):
+            if tokens[i] in ("M", "L"):
+                points.append([_to_float(tokens[i + 1]), _to_float(tokens[i + 2])])
+                pen_down.append(tokens[i] == "L")
+                i += 3
+            else:
+                # stray numbers in the data are skipped
+                i += 1
+        starts.append(len(points))
+
+    return Font(
+        name,
+        np.array(points, dtype=np.float64).reshape(-1, 2),
+        np.array(pen_down, dtype=bool),
+        np.array(starts, dtype=np.int64),
+        np.array(sizes, dtype=np.float64).reshape(-1, 2))
+
+
+def _to_float(txt):
+    try:
+        return float(txt)
+    except ValueError:
+        return 0.0
+
+
+@functools.lru_cache(maxsize=1024)
+def _line_layout(font, string):
+    # lines which recur across records, e.g. in labels, are laid out once
+    f = load(font)
+    points, pen_down, first = f.layout(string)
+    points.flags.writeable = False
+    return points, pen_down, first, f.width(string)
+
+
+def layout(text, font="standard", height=None, align="left", line_spacing=1.6, box=None, radius=None, angle=0, position=(0, 0)):
+    '''
+    Lays out a (multi-line) text and returns the points, pen states and
+    glyph start mask like Font.layout(), in mm.
+
+    The baseline of the first line is at Y=0, the following lines go
+    downwards. Lines are aligned relative to X=0.
+
+    @param height
+    Height of the capital letters in mm. None keeps the font units.
+
+    @param align
+    "left", "center" or "right"
+
+    @param line_spacing
+    Distance from baseline to baseline, as a multiple of `height`
+
+    @param box
+    (width, height) in mm. The text is scaled to fit into this box, whose
+    lower left corner is at `position`, overriding `height`. The block is
+    aligned horizontally within the box and centered vertically.
+
+    @param radius
+    Bend the baselines along a circle of this radius in mm. Positive
+    radii set the text on the top of the circle, negative ones on the
+    bottom, both reading from left to right.
+
+    @param angle
+    Rotation counterclockwise in degrees, around `position`
+
+    @param position
+    XY offset applied last
+    '''
+    f = load(font)
+    lines = text.split("\n")
+    scale = 1.0 if height is None else height / f.cap_height
+    pitch = line_spacing * f.cap_height
+
+    all_points = []
+    all_pen_down = []
+    all_first = []
+    widths = []
+    for i, line in enumerate(lines):
+        points, pen_down, first, width = _line_layout(font, line)
+        widths.append(width)
+        if len(points) == 0:
+            continue
+        shift = {"left": 0, "center": -width / 2, "right": -width}[align]
+        # the font Y axis points down, layout() already flipped it
+        all_points.append(points + [shift, f.baseline - i * pitch])
+        all_pen_down.append(pen_down)
+        all_first.append(first)
+
+    if not all_points:
+        return np.zeros((0, 2)), np.zeros(0, dtype=bool), np.zeros(0, dtype=bool)
+    points = np.concatenate(all_points)
+    pen_down = np.concatenate(all_pen_down)
+    first = np.concatenate(all_first)
+
+    if box is not None:
+        # the drawn extents of the block are fitted, not the font metrics
+        low = points.min(axis=0)
+        high = points.max(axis=0)
+        size = np.maximum(high - low, 1e-9)
+        scale = min(box[0] / size[0], box[1] / size[1])
+        x_anchor = {"left": -low[0], "center": (box[0] / scale - (low[0] + high[0])) / 2, "right": box[0] / scale - high[0]}[align]
+        y_anchor = (box[1] / scale - (low[1] + high[1])) / 2
+        points = (points + [x_anchor, y_anchor]) * scale
+    else:
+        points = points * scale
+
+    if radius is not None and radius != 0:
+        theta = points[:, 0] / radius
+        r = radius + points[:, 1]
+        points = np.column_stack((r * np.sin(theta), r * np.cos(theta) - radius))
+
+    if angle != 0:
+        a = math.radians(angle)
+        rotation = np.array([[math.cos(a), -math.sin(a)], [math.sin(a), math.cos(a)]])
+        points = np.dot(points, rotation.T)
+
+    return points + np.asarray(position, dtype=np.float64), pen_down, first
+
+
+def plate(template, records, columns=1, pitch=(60, 20), font="standard", **kwargs):
+    '''
+    Lays out one label per record on a grid and returns the points, pen
+    states and glyph start mask of all labels like layout().
+
+    @param template
+    Text with fields in str.format() syntax, e.g. "SN {serial}"
+
+    @param records
+    List of dicts providing the field values, e.g. from read_records()
+
+    @param columns
+    Labels per row. Rows go downwards by pitch[1].
+
+    @param pitch
+    (x, y) distance between the label positions in mm
+
+    The labels are engraved row by row, reversing the direction in every
+    other row, to keep the travel between labels short. All other
+    keyword arguments are passed to layout().
+    '''
+    position = np.asarray(kwargs.pop("position", (0, 0)), dtype=np.float64)
+    count = len(records)
+    rows = np.arange(count) // columns
+    cols = np.arange(count) % columns
+    order = np.lexsort((np.where(rows % 2 == 0, cols, -cols), rows))
+
+    all_points = []
+    all_pen_down = []
+    all_first = []
+    for i in order.tolist():
+        offset = position + [cols[i] * pitch[0], -rows[i] * pitch[1]]
+        points, pen_down, first = layout(template.format(**records[i]), font, position=offset, **kwargs)
+        all_points.append(points)
+        all_pen_down.append(pen_down)
+        all_first.append(first)
+
+    if not all_points:
+        return np.zeros((0, 2)), np.zeros(0, dtype=bool), np.zeros(0, dtype=bool)
+    return np.concatenate(all_points), np.concatenate(all_pen_down), np.concatenate(all_first)
+
+
+def read_records(filename):
+    '''
+    Reads template field values from a CSV file with a header row.
+    '''
+    with open(filename, newline="") as f:
+        return list(csv.DictReader(f))
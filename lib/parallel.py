@@ -0,0 +1,205 @@
+"""
+cnctoolbox - Copyright (c) 2016 Michael Franzl
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from . import gcodeparser
+from . import gcodetools
+from . import heightmap
+
+
+DEFAULT_CHUNKSIZE = 100000
+
+# the modal state which a chunk may leave unchanged
+_STATE_NAMES = list(gcodeparser.ModalState.GCODE_GROUPS) + list(gcodeparser.ModalState.MCODE_GROUPS) + ["feed", "spindle"]
+
+
+def map_chunks(func, lines, args=(), state=None, chunksize=DEFAULT_CHUNKSIZE, processes=None):
+    '''
+    Runs func(parsed, *args) over consecutive chunks of a program in a pool
+    of processes and returns the concatenated results, the same lines the
+    serial path gives for the lines without line breaks.
+
+    The program is copied into shared memory once, from where the processes
+    read their chunks. Every chunk needs the modal state at its first line,
+    which depends on all lines before. So in a first round, each process
+    summarizes how its chunk changes the state whatever it was before,
+    these summaries are chained in order to the states at the chunk
+    boundaries, and in the second round the chunks are processed.
+
+    @param func
+    A module level function (processes receive it by name), taking a
+    ParsedGcode whose state is that before its first line, and returning
+    a list of lines or None to abort
+
+    @param state
+    The ModalState before the first line
+
+    @param processes
+    Number of processes, defaults to the number of CPUs
+
+    @returns
+    List of lines, or None if `func` returned None for any chunk
+    '''
+    # lines which the transformations add have no line breaks either
+    lines = [line.rstrip("\n") for line in lines]
+    state = state if state is not None else gcodeparser.ModalState()
+    bounds = list(range(0, len(lines), chunksize)) + [len(lines)]
+    if len(bounds) <= 2 or processes == 1:
+        return func(gcodeparser.parse(lines, state), *args)
+
+    text = "\n".join(lines).encode("utf-8")
+    # byte offsets at which the lines start, and one behind the end
+    separators = np.flatnonzero(np.frombuffer(text, dtype=np.uint8) == ord("\n"))
+    starts = np.concatenate(([0], separators + 1, [len(text) + 1])).astype(np.int64)
+
+    blocks = []
+    try:
+        names = []
+        for data in (np.frombuffer(text, dtype=np.uint8), starts):
+            block = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+            np.ndarray(data.shape, dtype=data.dtype, buffer=block.buf)[:] = data
+            blocks.append(block)
+            names.append(block.name)
+        shared = (tuple(names), len(text), len(lines))
+
+        chunks = list(zip(bounds[:-1], bounds[1:]))
+        with multiprocessing.Pool(processes) as pool:
+            summaries = pool.map(_summarize, [(shared, a, b) for a, b in chunks])
+            states = _chain(state, summaries)
+            results = pool.map(_process, [(shared, a, b, s, func, args) for (a, b), s in zip(chunks, states)])
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    if any(r is None for r in results):
+        return None
+    return [line for r in results for line in r]
+
+
+def transform(lines, transform, skip_marker=None, state=None, chunksize=DEFAULT_CHUNKSIZE, processes=None):
+    '''
+    Parallel gcodetools.Transform.apply().
+    '''
+    return map_chunks(_apply_transform, lines, (transform, skip_marker), state, chunksize, processes)
+
+
+def translate(lines, offsets=[0, 0, 0], chunksize=DEFAULT_CHUNKSIZE, processes=None):
+    '''
+    Parallel gcodetools.translate().
+    '''
+    return map_chunks(_translate, lines, (offsets,), None, chunksize, processes)
+
+
+def scale_factor(lines, facts=[1, 1, 1], scale_zclear=False, chunksize=DEFAULT_CHUNKSIZE, processes=None):
+    '''
+    Parallel gcodetools.scale_factor().
+    '''
+    facts = [1 if f == 0 else f for f in facts]
+    skip_marker = None if scale_zclear else "_zclear"
+    return transform(lines, gcodetools.Transform().scale(facts), skip_marker, None, chunksize, processes)
+
+
+def bumpify(lines, cwpos, probe_points, probe_values, tolerance=None, min_length=0.5, chunksize=DEFAULT_CHUNKSIZE, processes=None):
+    '''
+    Parallel gcodetools.bumpify().
+    '''
+    # built before the processes are forked, so that they find it cached
+    heightmap.get(probe_points, probe_values)
+    state = gcodeparser.ModalState(position=cwpos)
+    return map_chunks(_bumpify, lines, (probe_points, probe_values, tolerance, min_length), state, chunksize, processes)
+
+
+def _apply_transform(parsed, transform, skip_marker):
+    return transform.apply(parsed, skip_marker)
+
+
+def _translate(parsed, offsets):
+    # translate() does not depend on the modal state
+    return gcodetools.translate(parsed, offsets)
+
+
+def _bumpify(parsed, probe_points, probe_values, tolerance, min_length):
+    return gcodetools.bumpify(parsed, parsed.state.position, probe_points, probe_values, tolerance=tolerance, min_length=min_length)
+
+
+def _read_chunk(shared, a, b):
+    '''
+    Returns lines a..b of the program in shared memory.
+    '''
+    (text_name, starts_name), size, count = shared
+    blocks = [shared_memory.SharedMemory(name=name) for name in (text_name, starts_name)]
+    starts = np.ndarray((count + 1,), dtype=np.int64, buffer=blocks[1].buf)
+    begin, end = int(starts[a]), int(starts[b]) - 1
+    text = bytes(blocks[0].buf[begin:end])
+    # the arrays must not refer to the buffers when they are closed
+    del starts
+    for block in blocks:
+        block.close()
+    return text.decode("utf-8").split("\n")
+
+
+def _summarize(job):
+    '''
+    Returns how a chunk changes the modal state: the values it leaves
+    behind (NaN if unchanged), and for an initial distance mode of G90 and
+    G91 each, the end position if it does not depend on the start (NaN
+    otherwise) and the relative movement from the start.
+    '''
+    shared, a, b = job
+    unknown = gcodeparser.ModalState(**{name: np.nan for name in _STATE_NAMES})
+    parsed = gcodeparser.parse(_read_chunk(shared, a, b), unknown)
+    end = parsed.end_state()
+    values = {name: getattr(end, name) for name in _STATE_NAMES}
+
+    positions = {}
+    for distance in (90, 91):
+        parsed.state = unknown.copy()
+        parsed.state.distance = distance
+        positions[distance] = (parsed.positions([np.nan] * 3)[-1], parsed.positions([0, 0, 0])[-1])
+    return values, positions
+
+
+def _chain(state, summaries):
+    '''
+    Returns the states at the starts of the chunks.
+    '''
+    result = []
+    for values, positions in summaries:
+        result.append(state)
+        following = state.copy()
+        for name, value in values.items():
+            if not (isinstance(value, float) and np.isnan(value)):
+                setattr(following, name, value)
+        absolute, relative = positions[state.distance]
+        following.position = np.where(np.isnan(absolute), np.add(state.position, relative), absolute).tolist()
+        state = following
+    return result
+
+
+def _process(job):
+    shared, a, b, state, func, args = job
+    return func(gcodeparser.parse(_read_chunk(shared, a, b), state), *args)
@@ -1,6 +1,9 @@
 from PIL import Image
 import math
 import logging
+import numpy as np
+
+from . import gcodewriter
 
 def find_row_ranges(pix, width, height):
     '''
@@ -89,13 +92,16 @@ def do(filename_in, dpmm=1, x_bleed=10, xcorr=0):
     # contains grayscale values depending on pixel coordinates, lazy-loaded
     pix = im.load()
     
+    # the same as an array of rows
+    pixels = np.asarray(im)
+    
     width = im.size[0]
     height = im.size[1]
     logging.info("Image is %ix%i", width, height)
     
     row_ranges = find_row_ranges(pix, width, height)
 
-    result = ""
+    result = []
     
     first_x = None
     first_y = None
@@ -107,10 +113,10 @@ def do(filename_in, dpmm=1, x_bleed=10, xcorr=0):
         first_direction = row_ranges[j][2]
         if first_x != None: break
     
-    result += "S0\n"
-    result += "G0 X{:f} Y{:f}\n".format(first_x * unit_length - first_direction * x_bleed, first_y * unit_length)
-    result += "G0\n"
-    result += "X{:f}\n".format(first_x * unit_length + xcorr * first_direction)
+    result.append("S0\n")
+    result.append("G0 X{:f} Y{:f}\n".format(first_x * unit_length - first_direction * x_bleed, first_y * unit_length))
+    result.append("G0\n")
+    result.append("X{:f}\n".format(first_x * unit_length + xcorr * first_direction))
     
     last_x = first_x
     last_y = first_y
@@ -133,41 +139,35 @@ def do(filename_in, dpmm=1, x_bleed=10, xcorr=0):
         
         #print("\n\n==========\nProcessing line", y, "start_x", start_x, "end_x", end_x, "direction", direction)
         
-        for cx in range(start_x, end_x, direction):
-            s = pix[cx, y] # get intensity from pixel
-            s = 255 - s # invert, black pixels (0) are highest intensity (255) for laser
-            
-            #print(" Pixel", cx, pix[cx, y], 255 - pix[cx, y])
-
-            if cx > 0 and cx < (width - 1) and pix[cx, y] == pix[cx + direction, y]:
-                # This is gcode optimzation for consecutive pixels of the
-                # same intensity. This reduces gcode lines, because gcode coordinates
-                # remain in the state machine of the CNC controller.
-                continue
-            
-            x = cx + x_shift
-            
-            new_x = x
-            new_y = cy
-            new_z = 0
-            new_s = s
+        # all pixels of the row at once
+        row = pixels[y]
+        cxs = np.arange(start_x, end_x, direction)
+        
+        # This is gcode optimzation for consecutive pixels of the
+        # same intensity. This reduces gcode lines, because gcode coordinates
+        # remain in the state machine of the CNC controller.
+        inner = (cxs > 0) & (cxs < (width - 1))
+        same = np.zeros(len(cxs), dtype=bool)
+        same[inner] = row[cxs[inner]] == row[cxs[inner] + direction]
+        cxs = cxs[~same]
+        
+        if len(cxs) > 0:
+            new_x = cxs + x_shift
+            new_s = 255 - row[cxs].astype(int) # invert, black pixels (0) are highest intensity (255) for laser
             
-            gcodeline = ""
             # Only write changes to coords
-            x2 = new_x * unit_length + direction * xcorr
-            y2 = new_y * unit_length
-            z2 = new_z * unit_length
-            if last_x != new_x: gcodeline += "X{:g} ".format(x2)
-            if last_y != new_y: gcodeline += "Y{:g} ".format(y2)
-            if last_z != new_z: gcodeline += "Z{:g} ".format(z2)
-            if last_s != new_s: gcodeline += "S{:g} ".format(new_s)
-            gcodeline += "\n"
-            result += gcodeline
+            initial = {"Y": last_y * unit_length}
+            if last_x is not None: initial["X"] = last_x * unit_length + direction * xcorr
+            if last_s is not None: initial["S"] = last_s
+            result.append(gcodewriter.serialize([
+                ("X", new_x * unit_length + direction * xcorr),
+                ("Y", cy * unit_length),
+                ("S", new_s),
+                ], initial=initial))
             
-            last_x = new_x
-            last_y = new_y
-            last_z = new_z
-            last_s = new_s
+            last_x = int(new_x[-1])
+            last_y = cy
+            last_s = int(new_s[-1])
 
         # After lasering the last pixel, continue going into the same direction for
         # the distance of x_bleed, so that GRBL's inertia control doesn't slow down
@@ -219,20 +219,20 @@ def do(filename_in, dpmm=1, x_bleed=10, xcorr=0):
 
         #result += "G{:g} X{:g} Y{:g} R{:f} S0\n".format(arcmode, x_clear, middle_y * unit_length, arc_radius_out * unit_length)
         #result += "G{:g} X{:g} Y{:g} R{:f} S0\n".format(arcmode, (nxs + direction) * unit_length, ny * unit_length, arc_radius_in * unit_length)
-        result += ";_gerbil bleed begin\n"
-        result += "G0 X{:g} Y{:g} S0\n".format(x_clear, middle_y * unit_length)
+        result.append(";_gerbil bleed begin\n")
+        result.append("G0 X{:g} Y{:g} S0\n".format(x_clear, middle_y * unit_length))
         offset = 1 if direction == 1 else 0
-        result += "G0 X{:g} Y{:g} S0\n".format(direction * xcorr + (nxs + offset) * unit_length, ny * unit_length)
-        result += ";_gerbil bleed end\n"
+        result.append("G0 X{:g} Y{:g} S0\n".format(direction * xcorr + (nxs + offset) * unit_length, ny * unit_length))
+        result.append(";_gerbil bleed end\n")
         
         last_s = None # invalidate last S for next row processing
         last_x = None # invalidate last X for next row processing
         
-        result += "G1\n"
+        result.append("G1\n")
         
 
     # gcode postamble
     out_x = float(unit_length * last_x + direction * x_bleed)
-    result += "G0 X{:f} S0\n".format(out_x) # last easing out movement
+    result.append("G0 X{:f} S0\n".format(out_x)) # last easing out movement
     
-    return result.split('\n')
\ No newline at end of file
+    return "".join(result).split('\n')
\ No newline at end of file
@@ -0,0 +1,283 @@
+"""
+cnctoolbox - Copyright (c) 2016 Michael Franzl
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import numpy as np
+
+from . import gcodeparser
+from . import gcodetools
+
+
+# number of motion blocks grbl plans ahead (BLOCK_BUFFER_SIZE on the
+# ATmega328p, one of which is kept free)
+BLOCK_BUFFER_SIZE = 16
+
+# the slowest feed rate grbl executes, mm/min
+MINIMUM_FEED_RATE = 1.0
+
+# grbl's defaults of the settings used by estimate()
+DEFAULT_SETTINGS = {
+    "max_rates": (500, 500, 500),
+    "accelerations": (10, 10, 10),
+    "junction_deviation": 0.01,
+    "arc_tolerance": 0.002,
+    }
+
+
+def grbl_settings(settings):
+    '''
+    Picks the settings estimate() needs from grbl's settings as read by
+    Gerbil, a dict like {110: {"val": "500.000"}, ...}. Missing ones are
+    taken from DEFAULT_SETTINGS.
+
+    @returns
+    A dict of keyword arguments for estimate()
+    '''
+    def value(key, default):
+        if key in settings:
+            return float(settings[key]["val"])
+        return default
+
+    d = DEFAULT_SETTINGS
+    return {
+        "max_rates": [value(110 + i, d["max_rates"][i]) for i in range(3)],
+        "accelerations": [value(120 + i, d["accelerations"][i]) for i in range(3)],
+        "junction_deviation": value(11, d["junction_deviation"]),
+        "arc_tolerance": value(12, d["arc_tolerance"]),
+        }
+
+
+def estimate(gcode, max_rates=DEFAULT_SETTINGS["max_rates"], accelerations=DEFAULT_SETTINGS["accelerations"],
+             junction_deviation=DEFAULT_SETTINGS["junction_deviation"], arc_tolerance=DEFAULT_SETTINGS["arc_tolerance"],
+             block_buffer_size=BLOCK_BUFFER_SIZE, feed_override=None):
+    '''
+    Estimates how long grbl takes to execute each line of a program.
+
+    Like grbl's planner, every move is a block with a trapezoidal speed
+    profile. Speeds are limited per axis by the max rates ($110-$112),
+    changes of speed by the accelerations ($120-$122), and speeds at the
+    junctions between blocks by the junction deviation ($11). Arcs are
+    split into segments within the arc tolerance ($12). The planner only
+    looks `block_buffer_size` blocks ahead, and has to be able to stop at
+    the end of them.
+
+    The forward and backward passes of the planner, which grbl runs over
+    its buffer, are computed for the whole program at once: their
+    recurrences are cumulative minima of the squared speeds.
+
+    @param gcode
+    A list of lines or a ParsedGcode, whose state gives the starting
+    position
+
+    @param max_rates
+    mm/min of the X, Y and Z axes
+
+    @param accelerations
+    mm/s^2 of the X, Y and Z axes
+
+    @param feed_override
+    If given, the feed rate in mm/min of all G1/G2/G3 moves
+
+    @returns
+    Array of the times in seconds, one per line. G4 dwells are included.
+    '''
+    parsed = gcodeparser.parse(gcode)
+    count = len(parsed)
+
+    # arcs are executed as segments, as grbl does it. Relative (G91) arcs
+    # are estimated by their chords.
+    source = np.arange(count)
+    if len(parsed.arcs()) and not parsed.has_gcode([91]).any():
+        lines, source = gcodetools.linearize_arcs(parsed, arc_tolerance, precision=6)
+        parsed = gcodeparser.parse(lines, parsed.state)
+
+    line, length, nominal, acceleration, junction = _blocks(parsed, max_rates, accelerations, junction_deviation, feed_override)
+    entry = _plan(length, nominal, acceleration, junction, block_buffer_size)
+    exit = np.append(entry[1:], 0)
+    times = _block_times(length, nominal, acceleration, entry, exit)
+
+    result = np.bincount(source[line], weights=times, minlength=count)
+
+    # dwell times are given in seconds
+    dwell = parsed.has_gcode([4])
+    if dwell.any():
+        seconds = np.nan_to_num(parsed.column("P"))
+        result[source[np.flatnonzero(dwell)]] += seconds[dwell]
+    return result
+
+
+class TimeIndex:
+    '''
+    Cumulative execution times of the lines of a job, so that the elapsed
+    and remaining time and the progress at any line are looked up
+    directly. The estimates are scaled by a factor which calibrate()
+    fits to the time actually observed.
+
+    @param times
+    Estimated seconds per line, e.g. the result of estimate()
+
+    @param start
+    The line at which the job was started
+    '''
+    def __init__(self, times, start=0):
+        self.cumulative = np.concatenate(([0], np.cumsum(times)))
+        self.start = start
+        self.factor = 1.0
+
+
+    def _done(self, line):
+        # the estimated seconds from the start through the given line
+        i = min(max(line + 1, self.start), len(self.cumulative) - 1)
+        return self.cumulative[i] - self.cumulative[self.start]
+
+
+    def total(self):
+        '''
+        Returns the seconds the job takes from its start line.
+        '''
+        return (self.cumulative[-1] - self.cumulative[self.start]) * self.factor
+
+
+    def remaining(self, line):
+        '''
+        Returns the seconds left after `line` has been executed.
+        '''
+        return self.total() - self._done(line) * self.factor
+
+
+    def progress(self, line):
+        '''
+        Returns the percentage of the job time spent when `line` has been
+        executed.
+        '''
+        total = self.cumulative[-1] - self.cumulative[self.start]
+        if total <= 0:
+            return 100.0
+        return 100.0 * self._done(line) / total
+
+
+    def calibrate(self, line, elapsed, min_estimate=10):
+        '''
+        Scales the estimates by how long the job actually took up to `line`.
+        Nothing changes until at least `min_estimate` estimated seconds are
+        done, so that the start does not distort the factor.
+        '''
+        done = self._done(line)
+        if done >= min_estimate and elapsed > 0:
+            self.factor = elapsed / done
+
+
+def _blocks(parsed, max_rates, accelerations, junction_deviation, feed_override):
+    '''
+    Returns for each move its line, length (mm), nominal speed (mm/s),
+    acceleration (mm/s^2) and the squared maximal speed at the junction
+    with the move before it.
+    '''
+    state = parsed.state
+    positions = parsed.positions()
+    previous = np.vstack(([state.position], positions[:-1]))
+    delta = positions - previous
+    length = np.linalg.norm(delta, axis=1)
+    motion = parsed.modal_gcode(gcodeparser.MOTION_GCODES, state.motion)
+    moves = (length > 0) & np.isin(motion, [0, 1, 2, 3]) & ~parsed.non_positional()
+
+    line = np.flatnonzero(moves)
+    length = length[line]
+    unit = delta[line] / length[:, None]
+    max_rates = np.asarray(max_rates, dtype=np.float64) / 60
+    accelerations = np.asarray(accelerations, dtype=np.float64)
+
+    # no axis may exceed its limit
+    rapid_rate = _limit_by_axes(unit, max_rates)
+    acceleration = _limit_by_axes(unit, accelerations)
+
+    feed = gcodeparser.ffill(parsed.column("F"), state.feed)[line]
+    if feed_override is not None:
+        feed = np.full(len(line), float(feed_override))
+    inverse_time = parsed.modal_gcode([93, 94], state.feedmode)[line] == 93
+    # in inverse time mode, F is the number of moves per minute
+    feed = np.where(inverse_time, feed * length, feed)
+    feed = np.maximum(feed, MINIMUM_FEED_RATE) / 60
+    rapid = motion[line] == 0
+    nominal = np.where(rapid, rapid_rate, np.minimum(feed, rapid_rate))
+
+    # junction speeds as in grbl's plan_buffer_line(): the speed at which
+    # the centripetal acceleration through a circle touching both moves,
+    # at junction_deviation from the corner, is the acceleration limit
+    junction = np.zeros(len(line))
+    if len(line) > 1:
+        cos_theta = -np.einsum("ij,ij->i", unit[:-1], unit[1:])
+        junction_unit = unit[1:] - unit[:-1]
+        norm = np.linalg.norm(junction_unit, axis=1)
+        junction_unit = junction_unit / np.where(norm > 0, norm, 1)[:, None]
+        junction_acceleration = _limit_by_axes(junction_unit, accelerations)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            sin_half = np.sqrt(np.maximum(0.5 * (1 - np.clip(cos_theta, -1, 1)), 0))
+            speed2 = junction_acceleration * junction_deviation * sin_half / (1 - sin_half)
+        speed2 = np.where(cos_theta > 0.999999, 0, speed2)
+        speed2 = np.where(cos_theta < -0.999999, np.inf, speed2)
+        junction[1:] = np.minimum(speed2, np.minimum(nominal[:-1], nominal[1:]) ** 2)
+
+    # moves which do not follow each other directly start from standstill
+    junction[np.flatnonzero(np.diff(line) > 1) + 1] = 0
+    return line, length, nominal, acceleration, junction
+
+
+def _limit_by_axes(unit, limits):
+    # the largest value along the unit vectors which no axis exceeds
+    with np.errstate(divide="ignore"):
+        ratios = limits / np.abs(unit)
+    return ratios.min(axis=1)
+
+
+def _plan(length, nominal, acceleration, junction, block_buffer_size):
+    '''
+    Returns the entry speeds (mm/s) of the blocks.
+    '''
+    if len(length) == 0:
+        return np.zeros(0)
+    # twice the acceleration times length, and its running sum
+    reach = 2 * acceleration * length
+    total = np.concatenate(([0], np.cumsum(reach)))
+
+    # grbl has to be able to stop at the end of its buffer
+    window = np.minimum(np.arange(len(length)) + block_buffer_size - 1, len(length))
+    limit = np.minimum(junction, total[window] - total[:-1])
+
+    # backward pass: v[k]^2 <= v[k+1]^2 + reach[k], and the program ends
+    # in standstill, i.e. v[k]^2 = min over j >= k of (limit[j] + total[j]) - total[k]
+    ends = np.append(limit, 0) + total
+    backward = np.minimum.accumulate(ends[::-1])[::-1][:-1] - total[:-1]
+    # forward pass: v[k+1]^2 <= v[k]^2 + reach[k]
+    forward = np.minimum.accumulate(backward - total[:-1]) + total[:-1]
+    return np.sqrt(np.maximum(np.minimum(backward, forward), 0))
+
+
+def _block_times(length, nominal, acceleration, entry, exit):
+    '''
+    Returns the time (s) of trapezoidal or triangular speed profiles.
+    '''
+    accelerate = (nominal ** 2 - entry ** 2) / (2 * acceleration)
+    decelerate = (nominal ** 2 - exit ** 2) / (2 * acceleration)
+    cruise = length - accelerate - decelerate
+    trapezoid = cruise >= 0
+    peak = np.where(trapezoid, nominal, np.sqrt(np.maximum((2 * acceleration * length + entry ** 2 + exit ** 2) / 2, 0)))
+    return (peak - entry) / acceleration + (peak - exit) / acceleration + np.where(trapezoid, cruise / nominal, 0)
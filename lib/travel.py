@@ -0,0 +1,233 @@
+"""
+cnctoolbox - Copyright (c) 2016 Michael Franzl
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import math
+
+import numpy as np
+
+
+def order_segments(starts, ends, reversible, origin=(0, 0), two_opt_passes=2, window=64):
+    '''
+    Finds an order of toolpath segments which keeps the travel between
+    them short.
+
+    A nearest neighbour tour is built first, using a uniform grid to find
+    the closest remaining segment end. It is then improved by 2-opt moves,
+    which reverse runs of up to `window` consecutive segments.
+
+    @param starts
+    Array of shape (n, 2) with the XY points at which the segments begin
+
+    @param ends
+    Array of shape (n, 2) with the XY points at which the segments end
+
+    @param reversible
+    Boolean array telling which segments may be run from end to start
+
+    @param origin
+    Where the machine is before the first segment
+
+    @returns
+    Tuple (order, flipped): the segment indices in the new order and for
+    each of them whether it is to be run reversed
+    '''
+    starts = np.asarray(starts, dtype=np.float64).reshape(-1, 2)
+    ends = np.asarray(ends, dtype=np.float64).reshape(-1, 2)
+    reversible = np.asarray(reversible, dtype=bool)
+    if len(starts) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=bool)
+
+    order, flipped = _nearest_neighbour(starts, ends, reversible, np.asarray(origin, dtype=np.float64))
+    for _ in range(two_opt_passes):
+        if not _two_opt(order, flipped, starts, ends, reversible, np.asarray(origin, dtype=np.float64), window):
+            break
+    return order, flipped
+
+
+def tour_length(order, flipped, starts, ends, origin=(0, 0)):
+    '''
+    Returns the total XY travel from `origin` through the segments in the
+    given order.
+    '''
+    entry, exit = _oriented(order, flipped, starts, ends)
+    previous = np.vstack((np.asarray(origin, dtype=np.float64).reshape(1, 2), exit[:-1]))
+    return float(np.sum(np.hypot(*(entry - previous).T)))
+
+
+def _oriented(order, flipped, starts, ends):
+    entry = np.where(flipped[:, None], ends[order], starts[order])
+    exit = np.where(flipped[:, None], starts[order], ends[order])
+    return entry, exit
+
+
+class _Grid:
+    '''
+    Uniform grid over candidate points, from which points are removed as
+    the tour visits their segments. When most points are gone, the grid
+    is rebuilt with bigger cells, so that searches stay local.
+    '''
+
+    def __init__(self, points, ids):
+        self.all_points = points
+        self.build(ids)
+
+
+    def build(self, ids):
+        points = self.all_points[ids]
+        self.count = len(ids)
+        self.low = points.min(axis=0)
+        extent = np.maximum(points.max(axis=0) - self.low, 1e-9)
+        # about two points per cell
+        self.cell = max(math.sqrt(extent[0] * extent[1] / max(len(ids) / 2, 1)), extent.max() / 1024, 1e-9)
+        self.dim = (extent // self.cell).astype(int) + 1
+        cells = self._cells(points)
+        self.cells = {}
+        for cell, i in zip(cells.tolist(), ids.tolist()):
+            self.cells.setdefault(cell, []).append(i)
+
+
+    def _cells(self, points):
+        c = np.clip(((points - self.low) // self.cell).astype(int), 0, self.dim - 1)
+        return c[:, 0] + c[:, 1] * self.dim[0]
+
+
+    def nearest(self, p, alive):
+        '''
+        Returns the id of the alive point closest to p, or -1.
+        '''
+        cx, cy = np.clip(((p - self.low) // self.cell).astype(int), 0, self.dim - 1).tolist()
+        best = -1
+        best_d = math.inf
+        r = 0
+        max_r = int(max(self.dim))
+        while r <= max_r:
+            for x, y in self._ring(cx, cy, r):
+                key = x + y * self.dim[0]
+                ids = self.cells.get(key)
+                if not ids:
+                    continue
+                ids = [i for i in ids if alive[i]]
+                if ids:
+                    self.cells[key] = ids
+                else:
+                    del self.cells[key]
+                    continue
+                for i in ids:
+                    q = self.all_points[i]
+                    d = math.hypot(q[0] - p[0], q[1] - p[1])
+                    if d < best_d:
+                        best_d = d
+                        best = i
+            # everything in further rings is at least r * cell away
+            if best >= 0 and best_d <= r * self.cell:
+                break
+            r += 1
+        return best
+
+
+    def _ring(self, cx, cy, r):
+        if r == 0:
+            yield cx, cy
+            return
+        x0, x1, y0, y1 = cx - r, cx + r, cy - r, cy + r
+        nx, ny = self.dim
+        for x in range(max(x0, 0), min(x1, nx - 1) + 1):
+            if y0 >= 0:
+                yield x, y0
+            if y1 < ny:
+                yield x, y1
+        for y in range(max(y0 + 1, 0), min(y1 - 1, ny - 1) + 1):
+            if x0 >= 0:
+                yield x0, y
+            if x1 < nx:
+                yield x1, y
+
+
+def _nearest_neighbour(starts, ends, reversible, origin):
+    n = len(starts)
+    # candidate points: every start, and the ends of reversible segments
+    rev = np.nonzero(reversible)[0]
+    points = np.vstack((starts, ends[rev]))
+    point_segment = np.concatenate((np.arange(n), rev))
+    point_flipped = np.concatenate((np.zeros(n, dtype=bool), np.ones(len(rev), dtype=bool)))
+    alive = np.ones(len(points), dtype=bool)
+    # the indices of the candidate points of every segment
+    other = np.full(n, -1)
+    other[rev] = n + np.arange(len(rev))
+
+    grid = _Grid(points, np.arange(len(points)))
+    order = np.empty(n, dtype=int)
+    flipped = np.empty(n, dtype=bool)
+    p = origin
+    remaining = len(points)
+    for k in range(n):
+        if remaining * 4 < grid.count and remaining > 64:
+            grid.build(np.nonzero(alive)[0])
+        i = grid.nearest(p, alive)
+        seg = point_segment[i]
+        order[k] = seg
+        flipped[k] = point_flipped[i]
+        alive[seg] = False
+        remaining -= 1
+        if other[seg] >= 0:
+            alive[other[seg]] = False
+            remaining -= 1
+        p = starts[seg] if flipped[k] else ends[seg]
+    return order, flipped
+
+
+def _two_opt(order, flipped, starts, ends, reversible, origin, window):
+    '''
+    One pass of 2-opt moves on an open tour, in place. Returns whether
+    anything was improved.
+    '''
+    n = len(order)
+    entry, exit = _oriented(order, flipped, starts, ends)
+    rev = reversible[order]
+    improved = False
+    for i in range(n):
+        stop = min(i + window, n)
+        # only runs of reversible segments can be reversed
+        fixed = np.nonzero(~rev[i:stop])[0]
+        if len(fixed):
+            stop = i + fixed[0]
+        if stop - i < 1:
+            continue
+        j = np.arange(i, stop)
+        before = exit[i - 1] if i > 0 else origin
+        # cost of the edges into i and out of j, before and after reversing i..j
+        old_in = math.hypot(*(entry[i] - before))
+        new_in = np.hypot(*(exit[j] - before).T)
+        has_next = j + 1 < n
+        nxt = entry[np.minimum(j + 1, n - 1)]
+        old_out = np.where(has_next, np.hypot(*(nxt - exit[j]).T), 0)
+        new_out = np.where(has_next, np.hypot(*(nxt - entry[i]).T), 0)
+        gain = old_in + old_out - new_in - new_out
+        best = int(np.argmax(gain))
+        if gain[best] > 1e-9:
+            k = i + best
+            order[i:k + 1] = order[i:k + 1][::-1]
+            flipped[i:k + 1] = ~flipped[i:k + 1][::-1]
+            entry[i:k + 1], exit[i:k + 1] = exit[i:k + 1][::-1].copy(), entry[i:k + 1][::-1].copy()
+            rev[i:k + 1] = rev[i:k + 1][::-1]
+            improved = True
+    return improved
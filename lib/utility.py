@@ -1,5 +1,7 @@
 # simple shared file utility functions
 
+import os
+
 def read_file_to_linearray(filename):
     lines = []
     with open(filename, "r") as f:
@@ -10,4 +12,51 @@ def read_file_to_linearray(filename):
 def write_file_from_linearray(array, filename):
     with open(filename, "w") as f:
         for line in array:
-            f.write(line)
\ No newline at end of file
+            f.write(line)
+
+def read_file_in_chunks(filename, chunk_size=100000):
+    '''
+    Generator yielding lists of at most `chunk_size` lines, so that only
+    one chunk of a file is in memory at a time. The lines are stripped of
+    their line breaks, see write_file_from_chunks().
+    '''
+    with open(filename, "r") as f:
+        chunk = []
+        for line in f:
+            chunk.append(line.rstrip("\n"))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
+
+def write_file_from_chunks(chunks, filename):
+    '''
+    Writes the lines of all chunks, each with a line break of its own.
+
+    The file is written under a temporary name and only renamed to
+    `filename` when all chunks were written. A chunk of None aborts the
+    stream (see gcodetools.stream_translate()), which leaves no output
+    file behind.
+
+    @returns
+    True if the file was written, False if the stream was aborted
+    '''
+    tmp_filename = filename + ".tmp"
+    aborted = False
+    try:
+        with open(tmp_filename, "w") as f:
+            for chunk in chunks:
+                if chunk is None:
+                    aborted = True
+                    break
+                for line in chunk:
+                    f.write(line + "\n")
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+    if aborted:
+        os.remove(tmp_filename)
+        return False
+    os.replace(tmp_filename, filename)
+    return True
@@ -0,0 +1,313 @@
+"""
+cnctoolbox - Copyright (c) 2016 Michael Franzl
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import numpy as np
+
+from . import gcodeparser
+
+
+# grbl 1.1 error codes of the G-code parser
+ERROR_MESSAGES = {
+    1: "G-code words consist of a letter and a value. Letter was not found.",
+    2: "Numeric value format is not valid or missing an expected value.",
+    4: "Negative value received for an expected positive value.",
+    11: "Max characters per line exceeded. Line was not processed and executed.",
+    20: "Unsupported or invalid g-code command found in block.",
+    21: "More than one g-code command from same modal group found in block.",
+    22: "Feed rate has not yet been set or is undefined.",
+    23: "G-code command in block requires an integer value.",
+    24: "Two G-code commands that both require the use of the XYZ axis words were detected in the block.",
+    25: "A G-code word was repeated in the block.",
+    26: "A G-code command implicitly or explicitly requires XYZ axis words in the block, but none were detected.",
+    27: "N line number value is not within the valid range of 1 - 9,999,999.",
+    28: "A G-code command was sent, but is missing some required P or L value words in the line.",
+    29: "Grbl supports six work coordinate systems G54-G59. G59.1, G59.2, and G59.3 are not supported.",
+    30: "The G53 G-code command requires either a G0 seek or G1 feed motion mode to be active. A different motion was active.",
+    31: "There are unused axis words in the block and G80 motion mode cancel is active.",
+    32: "A G2 or G3 arc was commanded but there are no XYZ axis words in the selected plane to trace the arc.",
+    33: "The motion command has an invalid target. G2, G3, and G38.2 generates this error, if the arc is impossible to generate or if the probe target is the current position.",
+    34: "A G2 or G3 arc, traced with the radius definition, had a mathematical error when computing the arc geometry.",
+    35: "A G2 or G3 arc, traced with the offset definition, is missing the IJK offset word in the selected plane to trace the arc.",
+    36: "There are unused, leftover G-code words that aren't used by any command in the block.",
+    38: "Tool number greater than max supported value.",
+    }
+
+# grbl's serial line buffer, including the terminating character
+LINE_BUFFER_SIZE = 80
+
+MAX_LINE_NUMBER = 10000000
+
+MAX_TOOL_NUMBER = 255
+
+SUPPORTED_LETTERS = "FGIJKLMNPRSTXYZ"
+
+SUPPORTED_GCODES = [0, 1, 2, 3, 4, 10, 17, 18, 19, 20, 21, 28, 28.1, 30, 30.1, 38.2, 38.3, 38.4, 38.5,
+                    40, 43.1, 49, 53, 54, 55, 56, 57, 58, 59, 61, 80, 90, 91, 91.1, 92, 92.1, 93, 94]
+
+SUPPORTED_MCODES = [0, 1, 2, 3, 4, 5, 7, 8, 9, 30]
+
+# modal groups, a block may contain only one command of each
+GCODE_GROUPS = [
+    [4, 10, 28, 28.1, 30, 30.1, 53, 92, 92.1],
+    [0, 1, 2, 3, 38.2, 38.3, 38.4, 38.5, 80],
+    [17, 18, 19],
+    [90, 91],
+    [91.1],
+    [93, 94],
+    [20, 21],
+    [40],
+    [43.1, 49],
+    [54, 55, 56, 57, 58, 59],
+    [61],
+    ]
+
+MCODE_GROUPS = [
+    [0, 1, 2, 30],
+    [3, 4, 5],
+    [7, 8, 9],
+    ]
+
+# commands which use the axis words for something else than motion
+NON_MODAL_AXIS_GCODES = [10, 28, 30, 92]
+
+# when a line has several errors, grbl reports the one it checks first
+_PRIORITY = [11, 1, 2, 20, 23, 25, 4, 21, 24, 27, 38, 22, 28, 29, 30, 31, 26, 32, 33, 34, 35, 36]
+
+
+def validate(gcode, state=None, max_passes=32):
+    '''
+    Checks a program for the errors grbl's G-code parser would report,
+    without sending it to the machine ($C check mode). As grbl stops at
+    the first problem of a line, at most one error is reported per line.
+    Lines starting with $ (system commands) are not checked.
+
+    grbl discards lines with errors, so their modal words and targets
+    have no effect on the lines after them. All lines are checked at
+    once, the lines found to be wrong up to the first one which would
+    have changed the state of the lines after it are blanked, and the
+    program is checked again. After `max_passes` passes, the remaining errors are
+    reported as found.
+
+    @param state
+    The ModalState before the first line, e.g. to tell whether a feed
+    rate has been set already
+
+    @returns
+    A list of (line index, error code, message) tuples, ordered by line
+    '''
+    parsed = gcodeparser.parse(gcode, state)
+    lines = list(parsed.lines)
+    result = {}
+    for _ in range(max_passes):
+        errors, changes = _check(gcodeparser.parse(lines, parsed.state))
+        new = [i for i in sorted(errors) if i not in result]
+        if not new:
+            break
+        for i in new:
+            result[i] = errors[i]
+            lines[i] = ""
+            if changes[i]:
+                break
+    else:
+        result.update(errors)
+
+    return [(i, result[i], ERROR_MESSAGES[result[i]]) for i in sorted(result)]
+
+
+def _check(parsed):
+    '''
+    Returns a dict of the lines with errors and the error codes grbl would
+    report for them, taking every line as executed, and a boolean mask of
+    the lines which change the state that the checks of later lines use.
+    '''
+    count = len(parsed)
+    state = parsed.state
+    letter = parsed.word_letter
+    value = parsed.word_value
+    line = parsed.word_line
+    is_g = parsed.words("G")
+    is_m = parsed.words("M")
+    errors = {}
+
+    def flag(code, lines):
+        # lines is a boolean mask or an array of line indices
+        lines = np.asarray(lines)
+        if lines.dtype == bool:
+            lines = np.flatnonzero(lines)
+        for i in lines.tolist():
+            errors.setdefault(i, []).append(code)
+
+    def lines_with(words):
+        return np.bincount(line[words], minlength=count) > 0
+
+    system = np.array([text.lstrip().startswith("$") for text in parsed.lines], dtype=bool)
+
+    # the line buffer holds the line without whitespace and comments,
+    # whitespace inside of words (e.g. "X 10") is only counted out for
+    # the lines which are too long with it
+    word_chars = np.bincount(line, weights=parsed.word_end - parsed.word_start, minlength=count)
+    for w in np.flatnonzero(word_chars[line] > LINE_BUFFER_SIZE - 1).tolist():
+        text = parsed.lines[line[w]][parsed.word_start[w]:parsed.word_end[w]]
+        word_chars[line[w]] -= len(text) - len("".join(text.split()))
+    flag(11, word_chars > LINE_BUFFER_SIZE - 1)
+
+    # text which is not a word: a letter without a proper number, or no letter
+    for i in np.flatnonzero(parsed.unparsed() & ~system).tolist():
+        leftover = gcodeparser._re_token.sub(" ", parsed.lines[i]).split()
+        flag(2 if leftover[0][0].isalpha() else 1, [i])
+
+    supported_letter = np.isin(letter, [ord(l) for l in SUPPORTED_LETTERS])
+    flag(20, lines_with(~supported_letter))
+
+    # G and M codes, the integer part of a code decides whether it exists
+    integer = np.trunc(value)
+    unsupported_g = is_g & ~np.isin(value, SUPPORTED_GCODES)
+    known_integer = np.isin(integer, [c for c in SUPPORTED_GCODES if c == int(c)]) & (integer != 38)
+    flag(23, lines_with(unsupported_g & known_integer))
+    flag(20, lines_with(unsupported_g & ~known_integer))
+    flag(23, lines_with(is_m & (value != integer)))
+    flag(20, lines_with(is_m & (value == integer) & ~np.isin(value, SUPPORTED_MCODES)))
+
+    # repeated words and modal group conflicts
+    for code in range(ord("A"), ord("Z") + 1):
+        if chr(code) in "GM":
+            continue
+        words = letter == code
+        if words.any():
+            flag(25, np.bincount(line[words], minlength=count) > 1)
+    for groups, words in ((GCODE_GROUPS, is_g), (MCODE_GROUPS, is_m)):
+        for codes in groups:
+            in_group = words & np.isin(value, codes)
+            flag(21, np.bincount(line[in_group], minlength=count) > 1)
+
+    for l in "FNPST":
+        flag(4, lines_with(parsed.words(l) & (value < 0)))
+    flag(27, lines_with(parsed.words("N") & (value > MAX_LINE_NUMBER)))
+    flag(38, lines_with(parsed.words("T") & (value > MAX_TOOL_NUMBER)))
+
+    # which command uses the axis words of each line
+    has_axis = parsed.has("X") | parsed.has("Y") | parsed.has("Z")
+    non_modal_axis = parsed.has_gcode(NON_MODAL_AXIS_GCODES)
+    tool_length_axis = parsed.has_gcode([43.1])
+    explicit_motion = parsed.has_gcode(gcodeparser.MOTION_GCODES)
+    flag(24, (non_modal_axis.astype(int) + tool_length_axis + explicit_motion) > 1)
+    motion = parsed.modal_gcode(gcodeparser.MOTION_GCODES, state.motion)
+    motion_command = explicit_motion | (has_axis & ~non_modal_axis & ~tool_length_axis)
+
+    # feed rate: in inverse time mode it has to be on every move, and it
+    # is forgotten when the feed rate mode changes
+    feedmode = parsed.modal_gcode([93, 94], state.feedmode)
+    previous_feedmode = np.concatenate(([state.feedmode], feedmode[:-1]))
+    has_f = parsed.has("F")
+    feed = parsed.column("F")
+    feed[(feedmode != previous_feedmode) & ~has_f] = 0
+    feed = gcodeparser.ffill(feed, state.feed)
+    feeding = motion_command & np.isin(motion, [1, 2, 3, 38.2, 38.3, 38.4, 38.5])
+    flag(22, feeding & np.where(feedmode == 93, ~has_f, feed <= 0))
+
+    dwell = parsed.has_gcode([4])
+    set_offsets = parsed.has_gcode([10])
+    flag(28, (dwell & ~parsed.has("P")) | (set_offsets & ~(parsed.has("P") & parsed.has("L"))))
+    coordinate_system = parsed.column("P")
+    flag(29, set_offsets & (coordinate_system > 9))
+    flag(20, set_offsets & parsed.has("L") & ~np.isin(parsed.column("L"), [2, 20]))
+    flag(30, parsed.has_gcode([53]) & ~np.isin(motion, [0, 1]))
+    flag(31, (motion == 80) & has_axis & ~non_modal_axis)
+
+    # arcs
+    arc = motion_command & np.isin(motion, [2, 3])
+    flag(26, arc & ~has_axis)
+    plane = parsed.modal_gcode([17, 18, 19], state.plane)
+    in_plane = np.zeros(count, dtype=bool)
+    offsets_in_plane = np.zeros(count, dtype=bool)
+    for p, axes, offsets in ((17, "XY", "IJ"), (18, "ZX", "KI"), (19, "YZ", "JK")):
+        on_plane = plane == p
+        in_plane |= on_plane & (parsed.has(axes[0]) | parsed.has(axes[1]))
+        offsets_in_plane |= on_plane & (parsed.has(offsets[0]) | parsed.has(offsets[1]))
+    flag(32, arc & has_axis & ~in_plane)
+    radius_format = parsed.has("R")
+    flag(35, arc & has_axis & in_plane & ~radius_format & ~offsets_in_plane)
+    _check_arcs(parsed, arc & has_axis & in_plane & (radius_format | offsets_in_plane), radius_format, flag)
+
+    # probing to where the machine already is
+    positions = parsed.positions()
+    previous = np.vstack(([state.position], positions[:-1]))
+    probe = motion_command & np.isin(motion, [38.2, 38.3, 38.4, 38.5])
+    flag(33, probe & np.all(positions == previous, axis=1))
+
+    # words which no command of the line uses
+    flag(36, ~arc & (parsed.has("I") | parsed.has("J") | parsed.has("K") | radius_format))
+    flag(36, ~(dwell | set_offsets) & parsed.has("P"))
+    flag(36, ~set_offsets & parsed.has("L"))
+
+    # a modal word matters when lines follow which do not restate it
+    has_words = np.bincount(line, minlength=count) > 0
+    words_before = np.concatenate(([0], np.cumsum(has_words)))
+    following = np.minimum(np.arange(count) + 1, count)
+
+    def relied_on(explicit):
+        restated = np.where(explicit, np.arange(count), count)
+        restated = np.append(np.minimum.accumulate(restated[::-1])[::-1][1:], count)
+        return explicit & (words_before[restated] > words_before[following])
+
+    # switching the feed rate mode resets the feed rate
+    changes = parsed.unparsed() | relied_on(has_f) | parsed.has_gcode([93, 94])
+    for codes in GCODE_GROUPS[1:]:
+        changes |= relied_on(parsed.has_gcode(codes))
+    if arc.any() or probe.any():
+        changes |= np.any(positions != previous, axis=1) | parsed.has_gcode(GCODE_GROUPS[0])
+
+    errors = {i: min(codes, key=_PRIORITY.index) for i, codes in errors.items() if not system[i]}
+    return errors, changes
+
+
+def _check_arcs(parsed, valid, radius_format, flag):
+    '''
+    Checks the geometry of arcs like grbl's gc_execute_line() does.
+    '''
+    arcs = parsed.arcs()
+    lines = arcs.line
+    select = valid[lines]
+    arcs = arcs.select(select)
+    lines = lines[select]
+    if len(lines) == 0:
+        return
+    rows = np.arange(len(lines))
+    s0 = arcs.start[rows, arcs.axes[:, 0]]
+    s1 = arcs.start[rows, arcs.axes[:, 1]]
+    e0 = arcs.end[rows, arcs.axes[:, 0]]
+    e1 = arcs.end[rows, arcs.axes[:, 1]]
+    c0 = arcs.center[rows, arcs.axes[:, 0]]
+    c1 = arcs.center[rows, arcs.axes[:, 1]]
+
+    radius = radius_format[lines]
+    r = parsed.column("R")[lines]
+    x = e0 - s0
+    y = e1 - s1
+    same_point = (x == 0) & (y == 0)
+    flag(33, lines[radius & same_point])
+    flag(34, lines[radius & ~same_point & (4 * r * r - x * x - y * y < 0)])
+
+    # the end point has to be at the same distance from the center
+    delta = np.abs(np.hypot(e0 - c0, e1 - c1) - arcs.radius)
+    bad = (delta > 0.005) & ((delta > 0.5) | (delta > 0.001 * arcs.radius))
+    flag(33, lines[~radius & bad])
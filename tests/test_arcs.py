@@ -0,0 +1,16 @@
+import warnings
+
+import numpy as np
+
+from lib import gcodeparser
+
+
+def test_radius_arc_to_its_start_point_is_invalid():
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        arcs = gcodeparser.parse(["G0 X1 Y2", "G2 X1 Y2 R5", "G3 X11 Y2 R5"]).arcs()
+    assert arcs.invalid.tolist() == [True, False]
+    assert np.isfinite(arcs.center).all()
+    assert arcs.radius[0] == 0 and arcs.travel[0] == 0
+    assert np.allclose(arcs.center[1], [6, 2, 0])
+    assert arcs.select(np.array([True, False])).invalid.tolist() == [True]
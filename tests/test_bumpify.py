@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from lib import gcodeparser
+from lib import gcodetools
+from lib import heightmap
+
+
+PROBE_POINTS = [[0, 0], [100, 0], [100, 100], [0, 100], [50, 50]]
+PROBE_VALUES = [0, 1, 2, 1, 5]
+LINES = ["G0 X0 Y0 Z1", "G1 Z-1 F100", "G1 X100 Y100", "G0 Z1"]
+
+
+def test_bumpify_keeps_one_line_per_line_by_default():
+    result = gcodetools.bumpify(LINES, [0, 0, 0], PROBE_POINTS, PROBE_VALUES)
+    assert len(result) == len(LINES)
+
+
+def test_subdivision_is_opt_in():
+    default = gcodetools.bumpify(LINES, [0, 0, 0], PROBE_POINTS, PROBE_VALUES)
+    assert default == gcodetools.bumpify(LINES, [0, 0, 0], PROBE_POINTS, PROBE_VALUES, tolerance=None)
+    # segments shorter than twice min_length are not split
+    long_pieces = gcodetools.bumpify(LINES, [0, 0, 0], PROBE_POINTS, PROBE_VALUES, tolerance=0.02, min_length=100)
+    assert long_pieces == default
+
+
+def subdivided(min_length):
+    result = gcodetools.bumpify(LINES, [0, 0, 0], PROBE_POINTS, PROBE_VALUES, tolerance=0.02, min_length=min_length)
+    parsed = gcodeparser.parse(result)
+    # the points of the G1 X100 Y100 move, after the plunge
+    points = parsed.positions()[2:-1]
+    return result, points
+
+
+@pytest.mark.parametrize("min_length", [0.5, 5])
+def test_subdivided_points_follow_the_surface(min_length):
+    result, points = subdivided(min_length)
+    assert len(result) > len(LINES)
+    surface = heightmap.get(PROBE_POINTS, PROBE_VALUES)
+    expected = -1 + surface(points[:, :2]) - surface.z_at(0, 0)
+    assert np.allclose(points[:, 2], expected, atol=0.001)
+    assert np.allclose(points[:, 0], points[:, 1])
+
+
+@pytest.mark.parametrize("min_length", [0.5, 5])
+def test_subdivided_points_keep_min_length_apart(min_length):
+    result, points = subdivided(min_length)
+    steps = np.hypot(*np.diff(np.vstack(([[0, 0, 0]], points))[:, :2], axis=0).T)
+    assert steps.min() >= min_length
+
+
+def test_bumpify_beyond_the_probed_area_fails(caplog):
+    lines = LINES + ["G1 X150 Y50"]
+    assert gcodetools.bumpify(lines, [0, 0, 0], PROBE_POINTS, PROBE_VALUES) is None
+    assert "X150 Y50 is outside of the probed area" in caplog.text
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from lib import gcodeparser
+from lib import gcodewriter
+
+
+@pytest.mark.parametrize("precision", [0, 3, 4])
+def test_batches_format_like_single_values(precision):
+    rng = np.random.default_rng(0)
+    values = np.concatenate((
+        rng.uniform(-1000, 1000, 20000),
+        # ties at the last decimal
+        np.round(rng.uniform(-100, 100, 20000), precision) + 0.5 * 10.0 ** -precision,
+        [0, -0.0, 0.5, 1.5, 2.5, -0.5, -0.0004],
+        ))
+    expected = [gcodeparser.format_value(v, precision) for v in values.tolist()]
+    assert gcodewriter.format_numbers(values, precision) == expected
+    assert gcodeparser.format_values(values, precision) == expected
+
+
+def test_large_values_take_the_slow_path():
+    values = np.full(100, 1e17)
+    assert gcodeparser.format_values(values) == [gcodeparser.format_value(1e17)] * 100
+
+
+@pytest.mark.parametrize("count", [1, 100])
+def test_non_finite_values_are_rejected(count):
+    values = np.zeros(count)
+    values[-1] = np.nan
+    with pytest.raises(ValueError):
+        gcodeparser.format_values(values)
+    values[-1] = np.inf
+    with pytest.raises(ValueError):
+        gcodeparser.format_values(values)
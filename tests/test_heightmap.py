@@ -0,0 +1,38 @@
+import numpy as np
+
+from lib import heightmap
+
+
+def surface(x, y):
+    return 0.01 * x + 0.02 * y
+
+
+def make(extent, step):
+    xs = np.arange(0, extent + 1e-9, step)
+    xs[-1] = extent
+    points = np.array([[x, y] for x in xs for y in xs])
+    return points, surface(points[:, 0], points[:, 1])
+
+
+def test_points_on_the_edge_of_the_probed_area():
+    points, values = make(100, 10)
+    hm = heightmap.HeightMap(points, values)
+    edge = np.array([[100, 50], [50, 100], [100, 100], [99.9, 0], [0, 0]])
+    z = hm(edge)
+    assert not np.isnan(z).any()
+    assert np.allclose(z, surface(edge[:, 0], edge[:, 1]))
+
+
+def test_points_near_an_edge_between_grid_nodes():
+    points, values = make(99.5, 9.95)
+    hm = heightmap.HeightMap(points, values)
+    near = np.array([[99.2, 30], [30, 99.2], [99.5, 99.5], [99.2, 99.4]])
+    z = hm(near)
+    assert not np.isnan(z).any()
+    assert np.allclose(z, heightmap.HeightMap(points, values, method="cubic")(near))
+
+
+def test_points_outside_are_not_extrapolated():
+    points, values = make(100, 10)
+    hm = heightmap.HeightMap(points, values)
+    assert np.isnan(hm([[100.5, 50], [-0.5, 50], [50, 101]])).all()
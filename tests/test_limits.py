@@ -0,0 +1,26 @@
+from lib import gcodetools
+
+
+CS_OFFSETS = {"G54": (-100, -10, -10), "G55": (-200, -300, -10)}
+MAX_TRAVEL = [400, 305, 100]
+
+
+def test_unmoved_axes_keep_their_machine_position_across_cs_switch():
+    # Y stays at machine -20 after switching to G55, not 10 - 300
+    gcode = ["G0 X0 Y-10 Z0", "G55 G0 X0", "G0 X10 Y10"]
+    assert gcodetools.check_limits(gcode, MAX_TRAVEL, CS_OFFSETS) == []
+
+
+def test_moves_beyond_the_travel_are_reported():
+    gcode = ["G0 X0 Y-10 Z0", "G55 G0 X0", "G0 X10 Y-10"]
+    problems = gcodetools.check_limits(gcode, MAX_TRAVEL, CS_OFFSETS)
+    assert [i for i, _ in problems] == [2]
+    assert "Y -310.000" in problems[0][1]
+
+
+def test_bbox_across_cs_switch():
+    # in G54: X -100 after switching, Y stays at -10, then X -90 Y -280
+    gcode = ["G0 X0 Y-10 Z0", "G55 G0 X0", "G0 X10 Y10"]
+    expected = [[-100.0, 0.0], [-280.0, -10.0], [0.0, 0.0]]
+    assert gcodetools.bbox(gcode, CS_OFFSETS) == expected
+    assert gcodetools.stream_bbox([[line] for line in gcode], CS_OFFSETS) == expected
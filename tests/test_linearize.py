@@ -0,0 +1,24 @@
+from lib import gcodetools
+
+
+def test_arcs_without_z_do_not_move_z():
+    lines, source = gcodetools.linearize_arcs(["G0 X0 Y0", "G2 X10 Y0 I5 J0 F100"], 0.5)
+    assert len(lines) > 2
+    assert not any("Z" in line for line in lines)
+    assert lines[1].endswith(" F100")
+    assert lines[-1] == "G1 X10 Y0"
+    assert source.tolist() == [0] + [1] * (len(lines) - 1)
+
+
+def test_helical_arcs_move_z():
+    lines, source = gcodetools.linearize_arcs(["G0 X0 Y0 Z0", "G2 X10 Y0 Z-1 I5 J0"], 1)
+    assert all("Z" in line for line in lines[1:])
+    assert lines[-1] == "G1 X10 Y0 Z-1"
+
+
+def test_other_words_take_effect_before_the_segments():
+    lines, source = gcodetools.linearize_arcs(["G0 X0 Y0", "G20 M3 G2 X1 Y0 I0.5 J0 S1000 F10 (arc)"], 0.05)
+    assert lines[1] == "G20 M3 G1 X0.146 Y0.354 S1000 F10 (arc)"
+    assert lines[-1] == "G1 X1 Y0"
+    assert all(line.startswith("G1 X") and line.count(" ") == 2 for line in lines[2:])
+    assert source.tolist() == [0] + [1] * (len(lines) - 1)
@@ -0,0 +1,36 @@
+import math
+import random
+
+from lib import gcodetools
+from lib import validator
+
+
+def random_arcs(count):
+    rng = random.Random(0)
+    gcode = ["G0 X0 Y0 F100"]
+    for _ in range(count):
+        x, y = rng.uniform(-10, 10), rng.uniform(-10, 10)
+        i, j = rng.uniform(-5, 5), rng.uniform(-5, 5)
+        angle = math.atan2(-j, -i) + rng.uniform(0.2, 6)
+        radius = math.hypot(i, j)
+        end = (x + i + radius * math.cos(angle), y + j + radius * math.sin(angle))
+        gcode.append("G0 X{:.4f} Y{:.4f}".format(x, y))
+        gcode.append("G{} X{:.4f} Y{:.4f} I{:.4f} J{:.4f}".format(rng.choice([2, 3]), end[0], end[1], i, j))
+    return gcode
+
+
+def test_minified_arcs_stay_valid():
+    gcode = random_arcs(200)
+    assert validator.validate(gcode) == []
+    lines, report = gcodetools.minify(gcode, [80, 80, 80])
+    assert validator.validate(lines) == []
+
+
+def test_straight_moves_are_rounded_to_steps():
+    lines, report = gcodetools.minify(["G0 X1.004 Y2", "G1 X2.0061 F100"], [80, 80, 80])
+    assert lines == ["G0X1Y2", "G1X2F100"]
+
+
+def test_arc_start_points_are_not_rounded():
+    lines, report = gcodetools.minify(["G0 X1.004 Y2", "G1 X2.0061 F100", "G2 X4.0061 I1"], [80, 80, 80])
+    assert lines == ["G0X1Y2", "G1X2.006F100", "G2X4.006I1"]
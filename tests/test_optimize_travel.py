@@ -0,0 +1,30 @@
+from lib import gcodeparser
+from lib import gcodetools
+
+
+PROGRAM = [
+    "G0 Z5", "G0 X0 Y0", "G1 Z-1 F100", "G1 X10 Y0",
+    "G0 Z5", "G0 X100 Y50", "G1 Z-1", "G1 X70 Y50",
+    "G0 Z5", "G0 X20 Y0", "G1 Z-1", "G1 X30 Y0",
+    "G0 Z5", "G0 X0 Y0", "M5",
+    ]
+
+
+def test_segments_are_reordered():
+    lines, report = gcodetools.optimize_travel(PROGRAM)
+    assert report["travel_after"] < report["travel_before"]
+    assert lines.index("G0 X20 Y0") < lines.index("G0 X100 Y50")
+
+
+def test_no_rapid_below_safe_height():
+    lines, report = gcodetools.optimize_travel(PROGRAM)
+    parsed = gcodeparser.parse(lines)
+    motion = parsed.modal_gcode(gcodeparser.MOTION_GCODES, 0)
+    rapid_z = parsed.column("Z")[(motion == 0) & parsed.has("Z")]
+    assert (rapid_z >= 5).all()
+
+
+def test_entry_travel_of_first_segment_is_kept():
+    # the machine may be anywhere before the first move
+    lines, report = gcodetools.optimize_travel(PROGRAM)
+    assert lines[:3] == ["G0 Z5", "G0 X0 Y0", "G1 Z-1 F100"]
@@ -0,0 +1,10 @@
+from lib import gcodetools
+
+
+def test_read_returns_a_list(tmp_path):
+    path = tmp_path / "job.ngc"
+    path.write_text("G0 X1 \n  G1 Y2\n")
+    lines = gcodetools.read(str(path))
+    assert lines == ["G0 X1", "G1 Y2"]
+    assert lines + ["M2"] == ["G0 X1", "G1 Y2", "M2"]
+
@@ -0,0 +1,52 @@
+import os
+
+from lib import gcodetools
+from lib import parallel
+from lib import utility
+
+
+ARC_FILE = os.path.join(os.path.dirname(__file__), "..", "examples", "gcode", "speedtest.ngc")
+
+# X and Y scaled differently, so that the arcs are linearized
+FACTS = [0.5, 0.8, 1]
+
+
+def expected():
+    with open(ARC_FILE, "r") as f:
+        lines = f.read().splitlines()
+    return gcodetools.Transform().scale(FACTS).apply(lines, "_zclear")
+
+
+def test_stream_scale_factor_keeps_linearized_lines_apart(tmp_path):
+    outfile = str(tmp_path / "out.ngc")
+    chunks = utility.read_file_in_chunks(ARC_FILE, 7)
+    utility.write_file_from_chunks(gcodetools.stream_scale_factor(chunks, FACTS), outfile)
+    with open(outfile, "r") as f:
+        result = f.read().splitlines()
+    assert len(result) > len(open(ARC_FILE).read().splitlines())
+    assert result == expected()
+
+
+def test_parallel_scale_factor_keeps_linearized_lines_apart():
+    with open(ARC_FILE, "r") as f:
+        lines = f.readlines()
+    result = parallel.scale_factor(lines, FACTS, chunksize=7, processes=2)
+    assert result == expected()
+
+
+def test_aborted_stream_leaves_no_output(tmp_path):
+    infile = tmp_path / "in.ngc"
+    infile.write_text("G0 X1 Y1\nG1 X2 Y2\nG91\nG1 X1\n")
+    outfile = tmp_path / "out.ngc"
+    chunks = utility.read_file_in_chunks(str(infile), 2)
+    assert not utility.write_file_from_chunks(gcodetools.stream_translate(chunks, [1, 1, 0]), str(outfile))
+    assert os.listdir(str(tmp_path)) == ["in.ngc"]
+
+
+def test_aborted_stream_keeps_previous_output(tmp_path):
+    outfile = tmp_path / "out.ngc"
+    outfile.write_text("G0 X0\n")
+    assert not utility.write_file_from_chunks([["G0 X1"], None], str(outfile))
+    assert outfile.read_text() == "G0 X0\n"
+    assert utility.write_file_from_chunks([["G0 X1"], ["G0 X2"]], str(outfile))
+    assert outfile.read_text() == "G0 X1\nG0 X2\n"
@@ -0,0 +1,29 @@
+from lib import validator
+
+
+def line_of(length):
+    # a rapid move with the X value padded by leading zeros
+    return "G0X" + "0" * (length - 4) + "1"
+
+
+def codes(gcode):
+    return [code for _, code, _ in validator.validate(gcode)]
+
+
+def test_79_characters_fit_into_the_line_buffer():
+    assert codes([line_of(79)]) == []
+
+
+def test_80_characters_exceed_the_line_buffer():
+    assert codes([line_of(80)]) == [11]
+
+
+def test_whitespace_and_comments_do_not_count():
+    assert codes(["G0 X " + line_of(79)[3:]]) == []
+    assert codes(["  " + line_of(79) + "  (comment)"]) == []
+    assert codes(["G0 X " + line_of(80)[3:]]) == [11]
+
+
+def test_radius_arcs_grbl_cannot_trace():
+    gcode = ["G0 X0 Y0 F100", "G2 X0 Y0 R5", "G2 X10 Y0 R2", "G2 X10 Y0 R5"]
+    assert codes(gcode) == [33, 34]